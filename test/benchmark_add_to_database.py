@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+
+"""
+Compares the rows per second added to a history database by
+errorutils.add_to_database, one row at a time and in a batch.
+
+Usage::
+
+  ./benchmark_add_to_database.py [--steps N] [--codes N] [--sites N]
+
+A fake errors file is written to a temporary directory and added twice
+to a new database for each mode, so that the second pass measures
+how fast duplicate rows are skipped.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+from workflowwebtools import serverconfig
+serverconfig.LOCATION = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'config.yml')
+
+from workflowwebtools import errorutils
+
+
+def make_errors(steps, codes, sites):
+    return {
+        '/workflow_%i/step_%i' % (step // 4, step): {
+            str(8000 + code): {'T2_SITE_%i' % site: 1 + (step + code + site) % 5
+                               for site in range(sites)}
+            for code in range(codes)
+            }
+        for step in range(steps)
+        }
+
+
+def run(data_file, path, batch):
+    conn = sqlite3.connect(path)
+    curs = conn.cursor()
+    errorutils.create_table(curs)
+
+    times = []
+    for _ in range(2):
+        start = time.time()
+        errorutils.add_to_database(curs, data_file, batch=batch)
+        conn.commit()
+        times.append(time.time() - start)
+
+    rows = list(curs.execute('SELECT COUNT(*) FROM workflows'))[0][0]
+    conn.close()
+
+    return rows, times
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--steps', type=int, default=2000)
+    parser.add_argument('--codes', type=int, default=10)
+    parser.add_argument('--sites', type=int, default=10)
+    opts = parser.parse_args(args)
+
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+        data_file = os.path.join(tmpdir, 'all_errors.json')
+        with open(data_file, 'w') as output:
+            json.dump(make_errors(opts.steps, opts.codes, opts.sites), output)
+
+        for name, batch in [('row by row', False), ('batch', True)]:
+            rows, (first, second) = run(data_file, os.path.join(tmpdir, '%s.db' % batch), batch)
+            print('%-12s %8i rows: %10.0f rows/s new, %10.0f rows/s duplicate' %
+                  (name, rows, rows/first, rows/second))
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
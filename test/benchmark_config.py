@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+
+"""
+Compares the time taken to read the server configuration
+when config.yml is parsed for every call and when the parsed configuration is kept.
+
+Usage::
+
+  ./benchmark_config.py [--calls N]
+
+Each call reads the same values that a typical page does:
+the actions history length, the workspace, and the cache timeouts.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+from workflowwebtools import serverconfig
+serverconfig.LOCATION = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'config.yml')
+
+
+def request():
+    serverconfig.get_history_length()
+    serverconfig.config_dict()['workspace']
+    serverconfig.config_dict()['cache_refresh'].get('errors')
+    serverconfig.config_dict().get('memory_cache', {})
+
+
+def run(calls, reparse):
+    cached = serverconfig.config_dict
+
+    def parse():
+        # Like the old config_dict, which parsed the file every time
+        serverconfig.reload_config()
+        return cached()
+
+    if reparse:
+        serverconfig.config_dict = parse
+
+    try:
+        start = time.time()
+        for _ in range(calls):
+            request()
+
+        return time.time() - start
+
+    finally:
+        serverconfig.config_dict = cached
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--calls', type=int, default=2000)
+    opts = parser.parse_args(args)
+
+    for name, reparse in [('parse every call', True), ('kept in memory', False)]:
+        seconds = run(opts.calls, reparse)
+        print('%-18s %10.1f us/request' % (name, seconds/opts.calls * 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
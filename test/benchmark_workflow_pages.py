@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+
+"""
+Load test of workflow pages served with different sizes of the CherryPy thread pool.
+
+Usage::
+
+  ./benchmark_workflow_pages.py [--requests N] [--workflows N] [--seconds S]
+
+A small CherryPy server mounting :py:class:`workflowtools.WorkflowTools`
+is started for each size of ``server.thread_pool``.
+The ``seeworkflow`` and ``submitaction`` handlers are the real ones,
+but the error info, site status, actions database, and templates they use are replaced,
+and each of these replacements sleeps for ``--seconds`` in place of the ToolBox calls.
+The pages are requested by as many clients as there are server threads,
+once with a single lock for every workflow, like the old ``seeworkflowlock``,
+and once with the :py:class:`keylocks.KeyedLocks` of the server.
+"""
+
+import sys
+import time
+import socket
+import argparse
+import threading
+import contextlib
+import concurrent.futures
+
+from urllib.request import urlopen
+
+import cherrypy
+
+from workflowwebtools import keylocks
+from workflowwebtools import sitestatus
+from workflowwebtools import globalerrors
+from workflowwebtools import manageactions
+from workflowwebtools import workflowtools
+
+
+class GlobalLock(object):
+    """Has the interface of KeyedLocks, but every key shares one lock"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def hold(self, *keys): # pylint: disable=unused-argument
+        with self.lock:
+            yield
+
+
+class SessionInfo(object):
+    """Stands in for the ErrorInfo of a session"""
+
+    readiness = {}
+
+    def __init__(self, workflows):
+        self.workflows = set(workflows)
+
+    def return_workflows(self):
+        return self.workflows
+
+    def get_workflow(self, workflow):
+        return workflow
+
+
+class Snapshot(object):
+    drain = {}
+
+
+def stub_data_sources(opts):
+    """Replaces everything the workflow pages fetch with a sleep"""
+
+    info = SessionInfo(['wf_%i' % num for num in range(opts.workflows)])
+
+    def fetch(*args, **kwargs): # pylint: disable=unused-argument
+        time.sleep(opts.seconds)
+        return {}
+
+    def submitaction(user, workflows, action, session, **kwargs): # pylint: disable=unused-argument
+        time.sleep(opts.seconds)
+        workflows = workflows if isinstance(workflows, list) else [workflows]
+        return workflows, [], {}
+
+    globalerrors.check_session = lambda session, can_refresh=False: info
+    globalerrors.see_workflow = fetch
+    sitestatus.get_snapshot = Snapshot
+    manageactions.get_datetime_submitted = lambda workflow: None
+    manageactions.submitaction = submitaction
+    manageactions.get_actions = lambda: {wf: {'Action': 'clone', 'Parameters': {}}
+                                         for wf in info.workflows}
+    workflowtools.render = lambda template, **kwargs: template
+
+
+def make_app(locks):
+    # Skips the constructor, which connects to the data sources and builds the error info
+    app = workflowtools.WorkflowTools.__new__(workflowtools.WorkflowTools)
+    app.workflowlocks = locks
+
+    return app
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+
+def run(pool, locks, opts):
+    # A new server for each run, since the thread pool is made when the server starts
+    server = cherrypy._cpserver.Server() # pylint: disable=protected-access
+    server.socket_host = '127.0.0.1'
+    server.socket_port = port = free_port()
+    server.thread_pool = pool
+    server.subscribe()
+
+    cherrypy.tree.apps.clear()
+    cherrypy.tree.mount(make_app(locks), '/', {'/': {'tools.sessions.on': True}})
+    cherrypy.engine.start()
+
+    def request(num):
+        workflow = 'wf_%i' % (num % opts.workflows)
+        page = 'submitaction?action=clone&workflows=' if num % 4 == 3 else 'seeworkflow?workflow='
+        return urlopen('http://127.0.0.1:%i/%s%s' % (port, page, workflow)).read()
+
+    try:
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(pool) as clients:
+            list(clients.map(request, range(opts.requests)))
+
+        return opts.requests/(time.time() - start)
+
+    finally:
+        cherrypy.engine.stop()
+        server.unsubscribe()
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--workflows', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=0.05)
+    parser.add_argument('--pools', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    opts = parser.parse_args(args)
+
+    stub_data_sources(opts)
+
+    cherrypy.config.update({'log.screen': False, 'checker.on': False,
+                            'engine.autoreload.on': False})
+    cherrypy.server.unsubscribe()
+
+    print('%12s %18s %18s' % ('thread_pool', 'global lock', 'per workflow'))
+    for pool in opts.pools:
+        print('%12i %12.1f req/s %12.1f req/s' %
+              (pool, run(pool, GlobalLock(), opts), run(pool, keylocks.KeyedLocks(), opts)))
+
+    cherrypy.engine.exit()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,89 @@
+#! /usr/bin/env python
+
+"""
+Test the columnar copy of the errors table
+"""
+
+import unittest
+
+import numpy
+
+from workflowwebtools import errorcube
+
+
+class TestErrorCube(unittest.TestCase):
+
+    rows = [
+        ('/wf_b/step_1', 8001, 'site_c', 4, 'red'),
+        ('/wf_a/step_1', 8001, 'site_b', 2, 'yellow'),
+        ('/wf_a/step_2', 50664, 'site_a', 1, 'green'),
+        ('/wf_a/step_1', 99999, 'site_a', 3, 'green'),
+        ('/wf_a/step_1', 8001, 'site_a', 5, 'green'),
+        ]
+
+    allmap = {
+        'stepname': ['/wf_a/step_1', '/wf_a/step_2', '/wf_b/step_1', '/wf_c/step_1'],
+        'errorcode': [8001, 50664, 99999],
+        'sitename': ['site_a', 'site_b', 'site_c'],
+        }
+
+    def setUp(self):
+        self.cube = errorcube.ErrorCube(self.rows, self.allmap)
+
+    def test_offsets(self):
+        self.assertEqual(self.cube.step_offsets.tolist(), [0, 3, 4, 5, 5])
+        self.assertEqual(self.cube.workflows, ['wf_a', 'wf_b', 'wf_c'])
+        self.assertEqual(self.cube.workflow_offsets.tolist(), [0, 4, 5, 5])
+
+    def test_step(self):
+        self.assertEqual(self.cube.triples('/wf_a/step_1'),
+                         [(5, 'site_a', 8001), (2, 'site_b', 8001), (3, 'site_a', 99999)])
+        self.assertEqual(self.cube.triples('/wf_a/step_1', ['yellow']),
+                         [(2, 'site_b', 8001)])
+        self.assertEqual(self.cube.triples('/wf_c/step_1'), [])
+        self.assertEqual(self.cube.triples('/not/there'), [])
+
+        self.assertEqual(self.cube.dense('/wf_a/step_1').tolist(),
+                         [[5, 2, 0], [0, 0, 0], [3, 0, 0]])
+        self.assertEqual(self.cube.dense('/wf_a/step_1', ['green', 'red']).tolist(),
+                         [[5, 0, 0], [0, 0, 0], [3, 0, 0]])
+
+        self.assertEqual(self.cube.sparse('/wf_a/step_1'),
+                         {'8001': {'site_a': 5, 'site_b': 2}, '99999': {'site_a': 3}})
+
+    def test_workflow_sums(self):
+        sums = self.cube.workflow_sums('errorcode', ['wf_b', 'wf_c', 'wf_a'])
+        self.assertEqual(sums.tolist(), [[4, 0, 0], [0, 0, 0], [7, 1, 3]])
+
+        # Sites not in the given labels are dropped
+        sums = self.cube.workflow_sums('sitename', ['wf_a', 'wf_b'], ['site_c', 'site_a'])
+        self.assertEqual(sums.tolist(), [[0, 9], [4, 0]])
+
+    def test_group(self):
+        self.assertEqual(self.cube.group('stepname', 'sitename', 'errorcode'), [
+            ('/wf_a/step_1', 'site_a', 8001, 5),
+            ('/wf_a/step_1', 'site_a', 99999, 3),
+            ('/wf_a/step_1', 'site_b', 8001, 2),
+            ('/wf_a/step_2', 'site_a', 50664, 1),
+            ('/wf_b/step_1', 'site_c', 8001, 4),
+            ])
+
+    def test_matching(self):
+        self.assertEqual(sorted(self.cube.matching('stepname', 'errorcode', '8001',
+                                                   'sitename', 'site_a')),
+                         [('/wf_a/step_1', 5)])
+        self.assertEqual(sorted(self.cube.matching('errorcode', 'stepname', '/wf_a/step_1',
+                                                   'sitename', 'site_a')),
+                         [(8001, 5), (99999, 3)])
+        self.assertEqual(self.cube.matching('errorcode', 'stepname', '/wf_a/step_1',
+                                            'sitename', 'site_z'), [])
+
+    def test_empty(self):
+        cube = errorcube.ErrorCube([], {'stepname': [], 'errorcode': [], 'sitename': []})
+        self.assertEqual(cube.triples('/wf_a/step_1'), [])
+        self.assertEqual(cube.workflow_sums('errorcode', ['wf_a']).shape, (1, 0))
+        self.assertTrue(numpy.array_equal(cube.dense('/wf_a/step_1'), numpy.zeros((0, 0))))
+
+
+if __name__ == '__main__':
+    unittest.main()
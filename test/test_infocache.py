@@ -0,0 +1,271 @@
+#! /usr/bin/env python
+
+"""
+Test the caches shared by the workflow information objects
+"""
+
+import os
+import copy
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from workflowwebtools import serverconfig
+serverconfig.LOCATION = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'config.yml')
+
+from workflowwebtools import infocache
+from workflowwebtools import workflowinfo
+
+
+class CountInfo(workflowinfo.Info):
+
+    def __init__(self):
+        workflowinfo.Info.__init__(self)
+        self.calls = 0
+        self.attempts = 0
+        self.fail = False
+
+    def __str__(self):
+        return 'countinfo_test'
+
+    @workflowinfo.cached_json('count', timeout=0.1)
+    def count(self):
+        self.attempts += 1
+        if self.fail:
+            raise ValueError('Failed fetch')
+        self.calls += 1
+        return {'calls': self.calls}
+
+
+class InlineRevalidator(infocache.Revalidator):
+    """Runs each refresh before schedule returns"""
+
+    def schedule(self, key, func, *args):
+        self._run(key, func, *args)
+        return True
+
+
+class TestMemoryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = infocache.MemoryCache(max_bytes=10, ttl=60)
+
+    def test_lru(self):
+        self.cache.set(('a', 'x'), 1, 4)
+        self.cache.set(('b', 'x'), 2, 4)
+        # Use 'a' so that 'b' is the oldest
+        self.assertEqual(self.cache.get(('a', 'x')), 1)
+        self.cache.set(('c', 'x'), 3, 4)
+
+        self.assertEqual(self.cache.get(('b', 'x')), None)
+        self.assertEqual(self.cache.get(('a', 'x')), 1)
+        self.assertEqual(self.cache.get(('c', 'x')), 3)
+
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (3, 1, 1))
+        self.assertEqual(stats['bytes'], 8)
+
+    def test_too_large(self):
+        self.cache.set(('a', 'x'), 1, 11)
+        self.assertEqual(self.cache.get(('a', 'x')), None)
+        self.assertEqual(self.cache.stats()['bytes'], 0)
+
+    def test_expires(self):
+        self.cache.set(('a', 'x'), 1, 1, time.time() - 1)
+        self.assertEqual(self.cache.get(('a', 'x')), None)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_invalidate(self):
+        self.cache.set(('a', 'x'), 1, 1)
+        self.cache.set(('a', 'y'), 2, 1)
+        self.cache.set(('b', 'x'), 3, 1)
+
+        self.assertEqual(sorted(self.cache.invalidate('a')), ['x', 'y'])
+        self.assertEqual(self.cache.get(('a', 'y')), None)
+        self.assertEqual(self.cache.get(('b', 'x')), 3)
+
+    def test_zero_ttl(self):
+        cache = infocache.MemoryCache(max_bytes=10, ttl=0)
+        self.assertEqual(cache.ttl, 0)
+
+        cache.set(('a', 'x'), 1, 1)
+        time.sleep(0.01)
+        self.assertEqual(cache.get(('a', 'x')), None)
+
+    def test_page_cache(self):
+        pages = infocache.get_page_cache()
+        self.assertIs(pages, infocache.get_page_cache())
+        self.assertIsNot(pages, infocache.get_memory_cache())
+        self.assertEqual(pages.ttl, 60)
+
+
+class TestSQLiteStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = infocache.SQLiteStore(os.path.join(self.tmpdir, 'cache.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_load(self):
+        self.assertEqual(self.store.load('workflowinfo_wf_1', 'errors'), None)
+
+        self.store.save('workflowinfo_wf_1', 'errors', '{"a": 1}', 100)
+        text, updated = self.store.load('workflowinfo_wf_1', 'errors', 100)
+        self.assertEqual(text, '{"a": 1}')
+        self.assertAlmostEqual(updated, time.time(), delta=5)
+
+        # Entries older than the timeout given when loading are not valid
+        self.assertEqual(self.store.load('workflowinfo_wf_1', 'errors', -1), None)
+
+    def test_reset(self):
+        for attribute in ['errors', 'jobdetail']:
+            self.store.save('workflowinfo_wf_1', attribute, '{}')
+        self.store.save('workflowinfo_wf_2', 'errors', '{}')
+
+        self.store.reset('workflowinfo_wf_1', [])
+        self.assertEqual(self.store.load('workflowinfo_wf_1', 'jobdetail'), None)
+        self.assertEqual(self.store.load('workflowinfo_wf_2', 'errors')[0], '{}')
+
+    def test_expire(self):
+        self.store.save('workflowinfo_wf_1', 'errors', '{}', -1)
+        self.store.save('workflowinfo_wf_2', 'errors', '{}', 100)
+        self.store.save('workflowinfo_wf_3', 'errors', '{}')
+
+        self.assertEqual(self.store.expire(), 1)
+
+    def test_no_separator(self):
+        self.store.save('countinfo', 'count', '{"a": 1}', 100)
+        self.assertEqual(self.store.load('countinfo', 'count')[0], '{"a": 1}')
+
+        self.store.reset('countinfo')
+        self.assertEqual(self.store.load('countinfo', 'count'), None)
+
+        self.assertEqual(str(workflowinfo.Info()), 'info')
+
+    def test_threads(self):
+        def save(num):
+            self.store.save('workflowinfo_wf_%i' % num, 'errors', '[%i]' % num)
+
+        threads = [threading.Thread(target=save, args=(num,)) for num in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        other = infocache.SQLiteStore(self.store.path)
+        for num in range(10):
+            self.assertEqual(other.load('workflowinfo_wf_%i' % num, 'errors')[0], '[%i]' % num)
+
+
+class TestServeStale(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = (infocache.STORE, infocache.MEMORY, infocache.REVALIDATOR,
+                      serverconfig.config_dict)
+
+        config = copy.deepcopy(serverconfig.config_dict())
+        config['cache_store'] = {'serve_stale': True, 'retry': 0.3}
+        serverconfig.config_dict = lambda: config
+
+        infocache.STORE = infocache.SQLiteStore(os.path.join(self.tmpdir, 'cache.db'))
+        infocache.MEMORY = infocache.MemoryCache()
+        infocache.REVALIDATOR = infocache.Revalidator(2)
+
+        self.info = CountInfo()
+
+    def tearDown(self):
+        infocache.STORE, infocache.MEMORY, infocache.REVALIDATOR, \
+            serverconfig.config_dict = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def wait_refresh(self):
+        for _ in range(100):
+            if not infocache.REVALIDATOR.inflight:
+                break
+            time.sleep(0.05)
+
+    def wait_and_expire(self):
+        self.wait_refresh()
+        time.sleep(0.4)
+
+    def test_stale(self):
+        self.assertEqual(self.info.count(), {'calls': 1})
+        self.wait_and_expire()
+
+        # The old value is given right away while the refresh runs
+        self.assertEqual(self.info.count(), {'calls': 1})
+        self.wait_and_expire()
+
+        self.assertEqual(self.info.calls, 2)
+        self.assertEqual(infocache.STORE.load('countinfo_test', 'count')[0], '{"calls": 2}')
+
+    def test_reopen(self):
+        infocache.STORE.save('countinfo_test', 'count', '{"calls": 1}', -1)
+
+        serverconfig.config_dict()['cache_store'].update(
+            {'backend': 'sqlite', 'path': infocache.STORE.path})
+        infocache.STORE = None
+
+        # The expired entry is kept to be served while it is refreshed
+        self.assertEqual(infocache.get_store().load('countinfo_test', 'count')[0],
+                         '{"calls": 1}')
+
+    def test_failure(self):
+        self.info.count()
+        self.info.fail = True
+        self.wait_and_expire()
+
+        self.assertEqual(self.info.count(), {'calls': 1})
+        self.wait_and_expire()
+
+        infocache.MEMORY.clear()
+        self.assertEqual(self.info.count(), {'calls': 1})
+
+    def test_fast_refresh(self):
+        infocache.REVALIDATOR = InlineRevalidator(1)
+        self.info.count()
+        time.sleep(0.2)
+
+        # The refresh finishes right away, after the stale value is in memory
+        self.assertEqual(self.info.count(), {'calls': 1})
+
+        value, _, expires = infocache.MEMORY.entries[('countinfo_test', 'count')]
+        self.assertEqual(value, {'calls': 2})
+        self.assertLess(expires, time.time() + 1)
+
+    def test_failed_refresh(self):
+        self.info.count()
+        self.info.fail = True
+        time.sleep(0.2)
+
+        self.assertEqual(self.info.count(), {'calls': 1})
+        self.wait_refresh()
+        self.assertEqual(self.info.attempts, 2)
+
+        # The stale value is only kept in memory until the retry
+        value, _, expires = infocache.MEMORY.entries[('countinfo_test', 'count')]
+        self.assertEqual(value, {'calls': 1})
+        self.assertLess(expires, time.time() + 1)
+
+        self.assertEqual(self.info.count(), {'calls': 1})
+        self.assertEqual(self.info.attempts, 2)
+
+        self.info.fail = False
+        time.sleep(0.3)
+
+        # After the retry interval, the store is checked and another refresh is started
+        self.assertEqual(self.info.count(), {'calls': 1})
+        self.wait_refresh()
+        self.assertEqual(self.info.attempts, 3)
+        self.assertEqual(infocache.STORE.load('countinfo_test', 'count')[0], '{"calls": 2}')
+
+
+if __name__ == '__main__':
+    unittest.main()
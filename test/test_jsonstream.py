@@ -0,0 +1,46 @@
+#! /usr/bin/env python
+
+"""
+Test reading JSON documents one member at a time
+"""
+
+import io
+import json
+import unittest
+
+from workflowwebtools import jsonstream
+
+
+class TestJsonStream(unittest.TestCase):
+
+    document = {
+        'result': [{'wf': {'/wf/step%i' % num: {'jobfailed': {'8001': {'T2_CH_CERN': num}}}
+                           for num in range(20)}}],
+        'values': [1, 2.5, -3e5, 'a"}]', None, True, {}],
+        'empty': {}
+        }
+
+    def items(self, path=(), chunk_size=7, text=None):
+        return list(jsonstream.iter_items(io.StringIO(text or json.dumps(self.document)),
+                                          path, chunk_size))
+
+    def test_top(self):
+        self.assertEqual(dict(self.items()), self.document)
+
+    def test_path(self):
+        self.assertEqual(dict(self.items(('result', 0, 'wf'))),
+                         self.document['result'][0]['wf'])
+        self.assertEqual(self.items(('values',)), list(enumerate(self.document['values'])))
+        self.assertEqual(self.items(('empty',)), [])
+        self.assertEqual(self.items(('missing',)), [])
+
+    def test_numbers(self):
+        # Numbers split across reads must not be cut short
+        self.assertEqual(self.items(chunk_size=1, text='[12345, 678]'), [(0, 12345), (1, 678)])
+
+    def test_truncated(self):
+        self.assertRaises(ValueError, self.items, text='{"a": [1, ')
+
+
+if __name__ == '__main__':
+    unittest.main()
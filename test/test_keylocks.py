@@ -0,0 +1,64 @@
+#! /usr/bin/env python
+
+"""
+Test the locks held for each workflow
+"""
+
+import time
+import unittest
+import threading
+
+from workflowwebtools import keylocks
+
+
+class TestKeyedLocks(unittest.TestCase):
+
+    def setUp(self):
+        self.locks = keylocks.KeyedLocks()
+
+    def run_threads(self, keys_list, seconds=0.2):
+        """Holds each set of keys in its own thread, and returns the time taken"""
+
+        def hold(keys):
+            with self.locks.hold(*keys):
+                time.sleep(seconds)
+
+        threads = [threading.Thread(target=hold, args=(keys,)) for keys in keys_list]
+
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return time.time() - start
+
+    def test_different_keys(self):
+        self.assertLess(self.run_threads([['wf_a'], ['wf_b'], ['wf_c'], ['wf_d']]), 0.5)
+        self.assertEqual(self.locks.in_use(), 0)
+
+    def test_same_key(self):
+        self.assertGreater(self.run_threads([['wf_a'], ['wf_a'], ['wf_b']]), 0.39)
+        self.assertEqual(self.locks.in_use(), 0)
+
+    def test_overlapping(self):
+        # Opposite orders would deadlock if the keys were not sorted
+        for _ in range(20):
+            self.run_threads([['wf_a', 'wf_b'], ['wf_b', 'wf_a'], ['wf_b', 'wf_b']], 0)
+
+        self.assertEqual(self.locks.in_use(), 0)
+
+    def test_exception(self):
+        with self.assertRaises(ValueError):
+            with self.locks.hold('wf_a', 'wf_b'):
+                self.assertEqual(self.locks.in_use(), 2)
+                raise ValueError('page failed')
+
+        self.assertEqual(self.locks.in_use(), 0)
+
+        with self.locks.hold('wf_a'):
+            pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+#! /usr/bin/env python
+
+"""
+Test the logins of users
+"""
+
+import os
+import copy
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import cherrypy
+
+from workflowwebtools import serverconfig
+serverconfig.LOCATION = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'config.yml')
+
+from workflowwebtools import manageusers
+
+
+class TestLogins(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+        os.mkdir('keys')
+        with open('keys/salt.txt', 'w') as salt_file:
+            salt_file.write('\n'.join('%02ia' % num * 7 + 'a' for num in range(5)))
+
+        self.saved = (manageusers.salt_hash, dict(manageusers.SALTS), manageusers.HASH_POOL,
+                      serverconfig.config_dict)
+
+        self.config = copy.deepcopy(serverconfig.config_dict())
+        self.config['users'] = {'hash_timeout': 1}
+        serverconfig.config_dict = lambda: self.config
+        manageusers.SALTS.clear()
+        manageusers.LOGINS.clear()
+
+        self.hashes = []
+
+        def count_hash(to_hash):
+            self.hashes.append(to_hash)
+            return 'hashed_' + to_hash
+
+        manageusers.salt_hash = count_hash
+
+        conn, curs = manageusers.get_user_db()
+        curs.execute('INSERT INTO users VALUES (?,?,?,?,?)',
+                     ('user', 'hashed_email', 'hashed_secret', 'hashed_code', 1))
+        conn.commit()
+
+    def tearDown(self):
+        manageusers.salt_hash, salts, manageusers.HASH_POOL, serverconfig.config_dict = self.saved
+        manageusers.SALTS.clear()
+        manageusers.SALTS.update(salts)
+        manageusers.LOGINS.clear()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_remember(self):
+        self.assertTrue(manageusers.validate_password('', 'user', 'secret'))
+        self.assertTrue(manageusers.validate_password('', 'user', 'secret'))
+        self.assertEqual(len(self.hashes), 1)
+
+        # Wrong passwords are always checked
+        self.assertFalse(manageusers.validate_password('', 'user', 'wrong'))
+        self.assertFalse(manageusers.validate_password('', 'user', 'wrong'))
+        self.assertEqual(len(self.hashes), 3)
+
+        # The password is not kept
+        self.assertFalse([value for value in manageusers.LOGINS.values()
+                          if b'secret' in value[0]])
+
+    def test_reset(self):
+        self.assertTrue(manageusers.validate_password('', 'user', 'secret'))
+        self.assertEqual(manageusers.resetpassword('code', 'new'), 'user')
+
+        self.assertFalse(manageusers.validate_password('', 'user', 'secret'))
+        self.assertTrue(manageusers.validate_password('', 'user', 'new'))
+
+    def test_confirmation(self):
+        self.assertEqual(manageusers.confirmation("' OR '1'='1", 'email'), '')
+        self.assertEqual(manageusers.confirmation('hashed_email', 'email'), 'user')
+        self.assertRaises(ValueError, manageusers.confirmation, 'user', 'username')
+
+        self.assertEqual(manageusers.confirmation('code'), 'user')
+        # The code only works once
+        self.assertEqual(manageusers.confirmation('code'), '')
+
+    def test_migration(self):
+        # The table made by older versions, without an index on the validator
+        conn = sqlite3.connect('old.db')
+        conn.execute('CREATE TABLE users (username varchar(31) PRIMARY KEY, '
+                     'email varchar(255) UNIQUE, password varchar(255), '
+                     'validator varchar(255), isvalid integer)')
+        conn.execute("INSERT INTO users VALUES ('old', 'e', 'p', 'v', 0)")
+        conn.commit()
+
+        curs = conn.cursor()
+        manageusers.migrate_user_db(curs)
+        manageusers.migrate_user_db(curs)
+
+        self.assertEqual(list(curs.execute('PRAGMA user_version')),
+                         [(manageusers.SCHEMA_VERSION,)])
+        self.assertEqual(list(curs.execute('SELECT username FROM users')), [('old',)])
+
+        plan = ' '.join(str(row) for row in curs.execute(
+            'EXPLAIN QUERY PLAN SELECT username FROM users WHERE validator=?', ('v',)))
+        self.assertTrue('users_validator' in plan, plan)
+        conn.close()
+
+    def test_hash_queue(self):
+        manageusers.salt_hash = self.saved[0]
+        manageusers.do_salt_hash, saved = (lambda to_hash: 'hashed_' + to_hash), \
+            manageusers.do_salt_hash
+        slots = threading.BoundedSemaphore(1)
+        manageusers.HASH_POOL = (None, slots)
+
+        try:
+            self.assertEqual(manageusers.salt_hash('a'), 'hashed_a')
+
+            # With the queue full, the hash waits for a place until the timeout
+            slots.acquire()
+            start = time.time()
+            self.assertRaises(cherrypy.HTTPError, manageusers.salt_hash, 'a')
+            self.assertGreater(time.time() - start, 0.9)
+            slots.release()
+
+            self.assertEqual(manageusers.salt_hash('b'), 'hashed_b')
+        finally:
+            manageusers.do_salt_hash = saved
+
+    def test_hash_processes(self):
+        self.config['users'] = {'hash_processes': 1, 'hash_queue': 1, 'hash_timeout': 30}
+        manageusers.HASH_POOL = None
+        pool, _ = manageusers.get_hash_pool()
+
+        try:
+            # The work is done in another process
+            self.assertNotEqual(manageusers._run_in_hash_pool(os.getpid), os.getpid())
+
+            self.config['users']['hash_timeout'] = 0.5
+            self.assertRaises(cherrypy.HTTPError,
+                              manageusers._run_in_hash_pool, time.sleep, 2)
+
+            # The place in the pool is held until the slow process is done
+            start = time.time()
+            self.assertRaises(cherrypy.HTTPError, manageusers._run_in_hash_pool, os.getpid)
+            self.assertGreater(time.time() - start, 0.4)
+
+            self.config['users']['hash_timeout'] = 30
+            self.assertNotEqual(manageusers._run_in_hash_pool(os.getpid), os.getpid())
+        finally:
+            pool.shutdown()
+
+    def test_start_hash_pool(self):
+        self.config['users'] = {'hash_processes': 2}
+        manageusers.HASH_POOL = None
+        manageusers.start_hash_pool()
+        pool, _ = manageusers.get_hash_pool()
+
+        try:
+            self.assertEqual(len(pool._processes), 2)
+        finally:
+            pool.shutdown()
+
+    def test_salts(self):
+        salts = manageusers.get_salts()
+        self.assertEqual(len(salts), 5)
+
+        # The salts are only read once
+        os.remove('keys/salt.txt')
+        self.assertIs(manageusers.get_salts(), salts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,6 +10,9 @@ import unittest
 
 import cmstoolbox.webtools
 cmstoolbox.webtools.get_json = lambda *a, **k: {}
+import workflowwebtools.webclient
+workflowwebtools.webclient.get_json = lambda *a, **k: {}
+workflowwebtools.webclient.iter_json = lambda *a, **k: iter(())
 
 from workflowwebtools import serverconfig
 serverconfig.LOCATION = os.path.join(
@@ -0,0 +1,50 @@
+#! /usr/bin/env python
+
+"""
+Test that the configuration is only parsed when it changes
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from workflowwebtools import serverconfig
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = serverconfig.LOCATION
+        serverconfig.LOCATION = os.path.join(self.tmpdir, 'config.yml')
+        self.write(2)
+
+    def tearDown(self):
+        serverconfig.LOCATION = self.saved
+        serverconfig.reload_config()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, days, mtime=1000):
+        with open(serverconfig.LOCATION, 'w') as config:
+            config.write('actions:\n  submithistory: %i\n' % days)
+        os.utime(serverconfig.LOCATION, (mtime, mtime))
+
+    def test_cached(self):
+        config = serverconfig.config_dict()
+        self.assertIs(serverconfig.config_dict(), config)
+        self.assertEqual(serverconfig.get_history_length(), 2)
+
+        # Changing the file changes the configuration
+        self.write(3, 2000)
+        self.assertEqual(serverconfig.get_history_length(), 3)
+
+        # Without a new modification time, it takes a reload
+        self.write(4, 2000)
+        self.assertEqual(serverconfig.get_history_length(), 3)
+        serverconfig.reload_config()
+        self.assertEqual(serverconfig.get_history_length(), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
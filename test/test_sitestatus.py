@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+
+"""
+Test the shared snapshot of site statuses
+"""
+
+import os
+import time
+import unittest
+
+from workflowwebtools import serverconfig
+serverconfig.LOCATION = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'config.yml')
+
+from workflowwebtools import sitestatus
+
+
+class TestSiteStatus(unittest.TestCase):
+
+    rows = [('T1_US_FNAL', 'green', 'enabled'),
+            ('T2_CH_CERN', 'yellow', 'drain')]
+
+    def fake_readiness(self):
+        self.calls += 1
+        if self.fail:
+            raise IOError('No connection')
+        return iter(self.rows)
+
+    def setUp(self):
+        self.calls = 0
+        self.fail = False
+        self.saved = (sitestatus.sitereadiness.i_site_readiness,
+                      sitestatus.sitereadiness.TIMESTAMP,
+                      sitestatus.SNAPSHOT, sitestatus.REFRESHER)
+
+        sitestatus.sitereadiness.i_site_readiness = self.fake_readiness
+        sitestatus.SNAPSHOT = None
+        sitestatus.REFRESHER = None
+
+    def tearDown(self):
+        sitestatus.sitereadiness.i_site_readiness, \
+            sitestatus.sitereadiness.TIMESTAMP, \
+            sitestatus.SNAPSHOT, sitestatus.REFRESHER = self.saved
+
+    def test_lookups(self):
+        self.assertEqual(sitestatus.site_readiness('T2_CH_CERN'), 'yellow')
+        self.assertEqual(sitestatus.site_readiness('T3_NOWHERE'), 'none')
+        self.assertEqual(sitestatus.site_drain_status('T1_US_FNAL'), 'enabled')
+        self.assertEqual(sitestatus.site_list(), ['T1_US_FNAL', 'T2_CH_CERN'])
+        self.assertEqual(list(sitestatus.i_site_readiness()), self.rows)
+
+        # Everything came from one snapshot
+        self.assertEqual(self.calls, 1)
+
+    def test_duplicates(self):
+        self.rows = self.rows + [('T1_US_FNAL', 'red', 'disabled')]
+
+        self.assertEqual(sitestatus.site_readiness('T1_US_FNAL'), 'green')
+        self.assertEqual(sitestatus.site_drain_status('T1_US_FNAL'), 'enabled')
+        self.assertEqual(sitestatus.site_list(), ['T1_US_FNAL', 'T2_CH_CERN'])
+
+    def test_toolbox_cache(self):
+        fresh = time.time()
+        sitestatus.sitereadiness.TIMESTAMP = fresh
+        sitestatus.load_snapshot()
+        self.assertEqual(sitestatus.sitereadiness.TIMESTAMP, fresh)
+
+        # A list older than the ttl is downloaded again by the ToolBox
+        sitestatus.sitereadiness.TIMESTAMP = fresh - sitestatus.ttl()
+        sitestatus.load_snapshot()
+        self.assertIsNone(sitestatus.sitereadiness.TIMESTAMP)
+
+    def test_keep_old(self):
+        snapshot = sitestatus.get_snapshot()
+        snapshot.timestamp = time.time() - 10 * sitestatus.ttl()
+
+        self.fail = True
+        self.assertIs(sitestatus.get_snapshot(), snapshot)
+        self.assertEqual(self.calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
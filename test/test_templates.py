@@ -0,0 +1,53 @@
+#! /usr/bin/env python
+
+"""
+Test the shared template lookup
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mako.lookup
+
+from workflowwebtools import serverconfig
+serverconfig.LOCATION = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'config.yml')
+
+from workflowwebtools.web import templates
+
+
+class TestTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = templates.LOOKUP
+        templates.LOOKUP = mako.lookup.TemplateLookup(
+            directories=[templates.TEMPLATES_DIR],
+            module_directory=self.tmpdir,
+            filesystem_checks=False)
+
+    def tearDown(self):
+        templates.LOOKUP = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def test_shared(self):
+        self.assertIs(templates.get_lookup(), templates.get_lookup())
+
+    def test_precompile(self):
+        report = templates.precompile()
+
+        self.assertEqual(sorted(name for name, _ in report),
+                         sorted(name for name in os.listdir(templates.TEMPLATES_DIR)
+                                if name.endswith('.html')))
+        self.assertFalse([name for name, seconds in report if seconds is None])
+
+        # Rendering uses the compiled template
+        self.assertTrue(os.listdir(self.tmpdir))
+        self.assertTrue(templates.render('404.html'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#! /usr/bin/env python
+
+"""
+Test the pooled web client against a local stub server
+"""
+
+import os
+import json
+import time
+import threading
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from workflowwebtools import serverconfig
+serverconfig.LOCATION = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'config.yml')
+
+from workflowwebtools import webclient
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.connections = 0
+        self.failures = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        status = 200
+        body = {'path': self.path}
+        if self.path.startswith('/nested'):
+            body['result'] = [{'wf_a': {'step_a': [1, 2], 'step_b': {'8001': 3}}}]
+
+        with self.server.lock:
+            self.server.active += 1
+            self.server.max_active = max(self.server.active, self.server.max_active)
+
+            if self.path.startswith('/fail') and self.server.failures:
+                self.server.failures -= 1
+                status = 503
+
+        if self.path.startswith('/slow'):
+            time.sleep(0.2)
+
+        with self.server.lock:
+            self.server.active -= 1
+
+        output = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+
+class TestWebClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.host = '127.0.0.1:%i' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.client = webclient.WebClient(pool_size=4, max_inflight=2,
+                                          retries=2, backoff=0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keepalive(self):
+        for _ in range(5):
+            self.assertEqual(self.client.get_json(self.host, '/data', {'name': 'wf'}),
+                             {'path': '/data?name=wf'})
+
+        self.assertEqual(self.server.connections, 1)
+
+    def test_list_params(self):
+        self.assertEqual(self.client.get_json(self.host, '/data', {'name': ['a', 'b']}),
+                         {'path': '/data?name=a&name=b'})
+
+    def test_retry(self):
+        self.server.failures = 2
+        self.assertEqual(self.client.get_json(self.host, '/fail'), {'path': '/fail'})
+
+    def test_give_up(self):
+        self.server.failures = 10
+        self.assertEqual(self.client.get_json(self.host, '/fail'), {})
+
+    def test_iter_json(self):
+        self.assertEqual(list(self.client.iter_json(self.host, '/nested')),
+                         [('path', '/nested'),
+                          ('result', [{'wf_a': {'step_a': [1, 2], 'step_b': {'8001': 3}}}])])
+        self.assertEqual(dict(self.client.iter_json(self.host, '/nested',
+                                                    path=('result', 0, 'wf_a'))),
+                         {'step_a': [1, 2], 'step_b': {'8001': 3}})
+
+    def test_iter_give_up(self):
+        self.server.failures = 10
+        self.assertEqual(list(self.client.iter_json(self.host, '/fail')), [])
+
+    def test_inflight(self):
+        threads = [threading.Thread(target=self.client.get_json, args=(self.host, '/slow'))
+                   for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.server.max_active, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
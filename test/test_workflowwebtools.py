@@ -5,9 +5,20 @@ import json
 import shutil
 import os
 import sys
+import time
+import gc
+import sqlite3
+import weakref
+import threading
+
+import cherrypy
+from cherrypy.lib import httputil
 
 import cmstoolbox.webtools
 cmstoolbox.webtools.get_json = lambda *a, **k: {}
+import workflowwebtools.webclient
+workflowwebtools.webclient.get_json = lambda *a, **k: {}
+workflowwebtools.webclient.iter_json = lambda *a, **k: iter(())
 
 import workflowwebtools.serverconfig as sc
 sc.LOCATION = os.path.join(
@@ -18,11 +29,18 @@ import cmstoolbox._loadtestpath
 
 import update_history as uh
 import workflowwebtools.reasonsmanip as rm
+import workflowwebtools.errorutils as eu
 import workflowwebtools.manageactions as ma
 import workflowwebtools.globalerrors as ge
+import workflowwebtools.fetchpipeline as fp
+import workflowwebtools.listpage as lp
+import workflowwebtools.infocache as ic
+import workflowwebtools.workflowtools as wt
 
 from workflowwebtools.paramsregression import convert_to_dense
 
+import workflowwebtools.workflowinfo as wi
+
 from workflowwebtools.workflowinfo import WorkflowInfo
 
 class TestGlobalError(unittest.TestCase):
@@ -59,6 +77,50 @@ class TestGlobalError(unittest.TestCase):
             }
         }
 
+    def test_batch_insert(self):
+        def ingest(batch):
+            conn = sqlite3.connect(':memory:')
+            curs = conn.cursor()
+            eu.create_table(curs)
+            for _ in range(2):
+                eu.add_to_database(curs, self.testdat, batch=batch)
+            return list(curs.execute('SELECT * FROM workflows ORDER BY fullkey'))
+
+        rows = ingest(True)
+        self.assertTrue(rows)
+        self.assertEqual(rows, ingest(False))
+
+    def test_indexes(self):
+        conn = sqlite3.connect(':memory:')
+        curs = conn.cursor()
+        eu.create_table(curs)
+        # Creating again, like for an existing database, changes nothing
+        eu.create_table(curs)
+
+        # Only the index for the unique fullkey, which is used to skip duplicates
+        indexes = [row[0] for row in curs.execute(
+            "SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name='workflows'")]
+        self.assertEqual(indexes, [None])
+
+        plan = ' '.join(str(row) for row in curs.execute(
+            'EXPLAIN QUERY PLAN SELECT EXISTS(SELECT 1 FROM workflows WHERE fullkey=? LIMIT 1)',
+            ('a', )))
+        self.assertTrue('INDEX' in plan, plan)
+
+    def test_listworkflows(self):
+        session = {'info': ge.ErrorInfo(self.testdat)}
+
+        self.assertEqual(lp.listworkflows('1', 'sitea', '', session),
+                         [('test1', 6), ('test2', 3)])
+        self.assertEqual(lp.listworkflows('', 'sitea', '/test1/a/1', session),
+                         [(1, 3), (423, 3)])
+        # Clicking on a workflow sums its steps
+        self.assertEqual(lp.listworkflows('', 'sitea', 'test1', session),
+                         [(1, 6), (423, 3)])
+        self.assertEqual(lp.listworkflows('1', '', 'test1', session),
+                         [('sitea', 6), ('siteb', 2)])
+        self.assertEqual(lp.listworkflows('1', 'sitea', 'test1', session), [])
+
     def test_grouping(self):
         group_by = lambda subtask: subtask.split('/')[1]
         check_this = ge.group_errors(self.dictionary, group_by)
@@ -70,6 +132,35 @@ class TestGlobalError(unittest.TestCase):
         self.assertEqual(check_this['test2']['errors'], {'row2': {'col1': 1}})
         self.assertEqual(check_this['test1']['sub']['/test1/a/1'], self.dictionary['/test1/a/1'])
 
+    def test_rollup(self):
+        session = {'info': ge.ErrorInfo(self.testdat)}
+        calls = []
+
+        def timestamp(workflow):
+            calls.append(workflow)
+            return len(workflow)
+
+        prep_id = lambda workflow: 'prep_' + workflow[-1]
+        for pievar in ['errorcode', 'sitename']:
+            del calls[:]
+            expected = ge.group_errors(
+                ge.group_errors(ge.get_errors(pievar, session),
+                                lambda step: step.split('/')[1], timestamp=timestamp),
+                prep_id)
+
+            del calls[:]
+            rollup = ge.rollup_errors(pievar, [
+                (lambda step: step.split('/')[1], {'timestamp': timestamp}),
+                (prep_id, {})], session)
+
+            self.assertEqual(json.loads(json.dumps(rollup)), json.loads(json.dumps(expected)))
+            # Attributes are only found once for each group
+            self.assertEqual(sorted(calls), ['test1', 'test2'])
+
+        # Without levels, it is the same as get_errors
+        self.assertEqual(json.loads(json.dumps(ge.rollup_errors('errorcode', [], session))),
+                         json.loads(json.dumps(ge.get_errors('errorcode', session))))
+
     def test_steplist(self):
         info = ge.ErrorInfo(self.testdat)
 
@@ -87,6 +178,166 @@ class TestGlobalError(unittest.TestCase):
         self.assertEqual(info.get_step_list('test3'), ['/test3/test/2'])
         self.assertFalse(info.get_step_list('test1'))
 
+    def test_shared_sessions(self):
+        session_1 = {}
+        session_2 = {}
+        self.assertIs(ge.check_session(session_1), ge.check_session(session_2))
+
+        # Sessions can still bring their own ErrorInfo
+        private = ge.ErrorInfo(self.testdat)
+        self.assertIs(ge.check_session({'info': private}, True), private)
+
+        old = ge.check_session(session_1)
+        ge.publish_info(ge.ErrorInfo(self.testdat))
+        # Sessions only move to the new generation when allowed to refresh
+        self.assertIs(ge.check_session(session_1), old)
+        self.assertIs(ge.check_session(session_1, True), ge.GLOBAL_INFO)
+        self.assertIsNot(ge.check_session(session_1), old)
+        self.assertEqual(ge.check_session(session_1).get_step_list('test2'), ['/test2/a/1'])
+
+    def test_freed(self):
+        gc.disable()
+        try:
+            session = {}
+            ge.publish_info(ge.ErrorInfo(self.testdat))
+            old = weakref.ref(ge.check_session(session, True))
+            self.assertEqual(old().get_step_list('test2'), ['/test2/a/1'])
+            old().get_cube()
+
+            # Without the cycle collector, the old generation is closed
+            # as soon as the last session moves to the new one
+            ge.publish_info(ge.ErrorInfo(self.testdat))
+            self.assertIsNotNone(old())
+            ge.check_session(session, True)
+            self.assertIsNone(old())
+        finally:
+            gc.enable()
+
+    def test_teardown_twice(self):
+        info = ge.ErrorInfo(self.testdat)
+        info.teardown()
+        self.assertIsNone(info.conn)
+        # Also what __del__ does when setup() failed before connecting
+        info.teardown()
+
+    def test_refresh_while_building(self):
+        current = ge.get_global_info()
+        self.assertEqual(ge.refresh_status()['generation'], current.generation)
+
+        # While another generation is being built, keep serving the current one
+        ge.BUILD_LOCK.acquire()
+        try:
+            self.assertIs(ge.refresh_info(wait=False), current)
+        finally:
+            ge.BUILD_LOCK.release()
+
+        self.assertEqual(ge.refresh_status()['generation'], current.generation)
+
+    def test_building_status(self):
+        ge.get_global_info()
+        changes = []
+
+        saved = ge._set_status
+
+        def set_status(**kwargs):
+            changes.extend(kwargs.items())
+            saved(**kwargs)
+
+        ge._set_status = set_status
+
+        # Another thread publishes while this one waits to build
+        ge.BUILD_LOCK.acquire()
+        try:
+            waiting = threading.Thread(target=ge.refresh_info)
+            waiting.start()
+            time.sleep(0.2)
+            ge.publish_info(ge.ErrorInfo(self.testdat))
+        finally:
+            ge.BUILD_LOCK.release()
+            waiting.join()
+            ge._set_status = saved
+
+        self.assertNotIn(('building', True), changes)
+
+    def test_status_snapshot(self):
+        status = ge.REFRESH_STATUS
+        ge._set_status(last_error='No connection')
+        try:
+            # Readers holding the old status never see it change
+            self.assertIsNone(status['last_error'])
+            self.assertEqual(ge.refresh_status()['last_error'], 'No connection')
+        finally:
+            ge._set_status(last_error=status['last_error'])
+
+
+class TestGlobalErrorPage(unittest.TestCase):
+
+    def setUp(self):
+        ge.publish_info(ge.ErrorInfo(TestGlobalError.testdat))
+        self.tools = wt.WorkflowTools.__new__(wt.WorkflowTools)
+        self.renders = []
+
+        def render(template, **kwargs):
+            self.renders.append(template)
+            return 'page %i' % len(self.renders)
+
+        # Patched only after everything that can fail, and always put back
+        self.patch(wt, 'render', render)
+        self.patch(ma, 'get_acted_workflows', lambda *args: [])
+        self.patch(ic, 'PAGES', ic.MemoryCache(ttl=3600))
+
+        cherrypy.session = {}
+        self.addCleanup(delattr, cherrypy, 'session')
+
+    def patch(self, module, name, value):
+        self.addCleanup(setattr, module, name, getattr(module, name))
+        setattr(module, name, value)
+
+    def get(self, etag=None):
+        request = cherrypy._cprequest.Request(httputil.Host('127.0.0.1', 80),
+                                              httputil.Host('127.0.0.1', 1234))
+        if etag:
+            request.headers['If-None-Match'] = etag
+        cherrypy.serving.load(request, cherrypy._cprequest.Response())
+
+        page = self.tools.globalerror('stepname')
+        response = cherrypy.serving.response
+
+        return page, response.status, response.headers['ETag']
+
+    def test_not_modified(self):
+        page, _, etag = self.get()
+        self.assertEqual(page, 'page 1')
+
+        page, status, same_etag = self.get(etag)
+        self.assertEqual((page, status, same_etag), ('', 304, etag))
+
+        # Other browsers get the shared page without rendering it again
+        self.assertEqual(self.get('"other"')[:2], ('page 1', None))
+        self.assertEqual(len(self.renders), 1)
+
+    def test_key_changes(self):
+        _, _, etag = self.get()
+
+        ma.changes_actions(lambda: None)()
+        page, status, actions_etag = self.get(etag)
+        self.assertEqual((page, status), ('page 2', None))
+        self.assertNotEqual(actions_etag, etag)
+
+        ge.publish_info(ge.ErrorInfo(TestGlobalError.testdat))
+        page, status, generation_etag = self.get(actions_etag)
+        self.assertEqual((page, status), ('page 3', None))
+        self.assertNotIn(generation_etag, [etag, actions_etag])
+
+    def test_no_page_cache(self):
+        ic.PAGES = ic.MemoryCache(ttl=0)
+
+        page, _, etag = self.get()
+        self.assertEqual(page, 'page 1')
+        self.assertEqual(self.get()[::2], ('page 2', etag))
+        self.assertEqual(self.get(etag)[:2], ('', 304))
+        self.assertEqual(ic.PAGES.stats()['entries'], 0)
+
 
 class TestClusteringAndReasons(unittest.TestCase):
 
@@ -207,6 +458,31 @@ class TestClusteringAndReasons(unittest.TestCase):
                     self.assertEqual(error_table[e_index][s_index],
                                      self.errors[step].get(str(error), {}).get(site, 0))
 
+    def test_readymatch(self):
+        allmap = ge.check_session(None).get_allmap()
+        readymatch = ['yellow', 'red']
+
+        for step in self.errors:
+            sparse = ge.get_step_table(step, readymatch=readymatch, sparse=True)
+            dense = ge.get_step_table(step, readymatch=readymatch)
+            for e_index, error in enumerate(allmap['errorcode']):
+                for s_index, site in enumerate(allmap['sitename']):
+                    self.assertEqual(dense[e_index][s_index],
+                                     sparse.get(str(error), {}).get(site, 0))
+
+    def test_seeworkflow(self):
+        allmap = ge.check_session(None).get_allmap()
+
+        for workflow in ge.check_session(None).return_workflows():
+            skips = ge.see_workflow(workflow)['skips']
+            for step in ge.check_session(None).get_step_list(workflow):
+                table = ge.get_step_table(step)
+                empty = [index for index in range(len(allmap['sitename']))
+                         if not sum(row[index] for row in table)]
+                self.assertEqual(skips[step]['index'], empty)
+                self.assertEqual(skips[step]['sites'],
+                                 [allmap['sitename'][index] for index in empty])
+
     def test_sparsetodense(self):
         dense = {}
         sparse = {}
@@ -220,6 +496,136 @@ class TestClusteringAndReasons(unittest.TestCase):
             self.assertEqual(dense[step], to_dense[step])
 
 
+class TestFetchPipeline(unittest.TestCase):
+
+    prep_ids = {
+        'wf_a1': 'prep_a',
+        'wf_a2': 'prep_a',
+        'wf_b1': 'prep_b'
+        }
+
+    class FakeInfo(object):
+        url = 'fake.host'
+
+        def __init__(self, name, test):
+            self.name = name
+            self.test = test
+
+        def get_prep_id(self):
+            return self.test.prep_ids[self.name]
+
+        def get_workflows(self):
+            self.test.calls.append(self.name)
+            return sorted(wkf for wkf, prep_id in self.test.prep_ids.items()
+                          if prep_id == self.name)
+
+        def get_errors(self, get_unreported=False):
+            return {'/%s/step' % self.name: {'1': {'site_a': 1}}}
+
+        def is_cached(self, attribute):
+            return self.name in self.test.cached
+
+        def set_cache(self, attribute, value):
+            self.test.cached[self.name] = value
+
+    def setUp(self):
+        self.calls = []
+        self.cached = {}
+        self.fetcher = fp.WorkflowFetcher(threads=4, per_host=2)
+        self.make = lambda name: self.FakeInfo(name, self)
+
+    def test_prep_id_workflows(self):
+        self.assertEqual(
+            sorted(self.fetcher.prep_id_workflows(['wf_a1', 'wf_a2'], self.make, self.make)),
+            ['wf_a1', 'wf_a2'])
+        # Both workflows have the same Prep ID, so it is only looked up once
+        self.assertEqual(self.calls, ['prep_a'])
+
+    def test_errors_from_list(self):
+        self.assertEqual(self.fetcher.errors_from_list(['wf_a1', 'wf_b1'], self.make, self.make),
+                         {'/%s/step' % wkf: {'1': {'site_a': 1}} for wkf in self.prep_ids})
+
+    def test_load_parameters(self):
+        def get_params(workflows, url):
+            self.calls.append(sorted(workflows))
+            return {wkf: {'PrepID': self.prep_ids[wkf]} for wkf in workflows}
+
+        get_workflow_parameters = fp.workflowinfo.get_workflow_parameters
+        fp.workflowinfo.get_workflow_parameters = get_params
+
+        try:
+            self.cached['wf_a1'] = {}
+            fetcher = fp.WorkflowFetcher(threads=4, per_host=2, chunk_size=1)
+            self.assertEqual(fetcher.load_parameters(list(self.prep_ids), self.make), 2)
+        finally:
+            fp.workflowinfo.get_workflow_parameters = get_workflow_parameters
+
+        self.assertEqual(sorted(self.calls), [['wf_a2'], ['wf_b1']])
+        self.assertEqual(self.cached['wf_b1'], {'PrepID': 'prep_b'})
+        self.assertEqual(self.cached['wf_a1'], {})
+
+    def test_inflight(self):
+        release = threading.Event()
+        first = self.fetcher.submit(('test', 1), 'fake.host', release.wait)
+        self.assertIs(self.fetcher.submit(('test', 1), 'fake.host', release.wait), first)
+        release.set()
+        first.result()
+        self.assertFalse(self.fetcher.inflight)
+
+
+class TestJobDetail(unittest.TestCase):
+
+    workflow = 'test_jobdetail_workflow'
+
+    jobdetail = {'result': [{workflow: {
+        '/%s/step' % workflow: {'jobfailed': {'8001': {
+            'site_a': {'errorCount': 3, 'samples': [
+                {'errors': {'cmsRun1': [{'type': 'Fatal', 'exitCode': 8001,
+                                         'details': 'Bad'}]}}
+                ]}
+            }}}
+        }}]}
+
+    def fake_get_json(self, host, request, params=None, **kwargs):
+        self.requests.append(request)
+        return {'rows': []}
+
+    def fake_iter_json(self, host, request, params=None, path=(), **kwargs):
+        self.requests.append(request)
+        document = self.jobdetail
+        for key in path:
+            document = document[key]
+        return iter(document.items())
+
+    def setUp(self):
+        self.requests = []
+        self.get_json = wi.get_json
+        self.iter_json = wi.iter_json
+        wi.get_json = self.fake_get_json
+        wi.iter_json = self.fake_iter_json
+
+        self.info = WorkflowInfo(self.workflow)
+        self.info.reset()
+
+    def tearDown(self):
+        self.info.reset()
+        wi.get_json = self.get_json
+        wi.iter_json = self.iter_json
+
+    def test_one_fetch(self):
+        self.assertEqual(self.info.get_errors(),
+                         {'/%s/step' % self.workflow: {'8001': {'site_a': 3}}})
+        self.assertEqual(len(self.info.get_explanation('8001')), 1)
+        self.assertEqual(len(wi.explain_errors(self.workflow, '8001')), 1)
+
+        self.assertEqual(self.requests, ['/wmstatsserver/data/jobdetail/%s' % self.workflow])
+
+    def test_no_jobdetail(self):
+        self.jobdetail = {'result': [{self.workflow: {}}]}
+        self.assertEqual(self.info._get_jobdetail(), {}) # pylint: disable=protected-access
+        self.assertEqual(self.info.get_errors(), {})
+
+
 class TestReasons(unittest.TestCase):
 
     reasons = [
@@ -257,6 +663,123 @@ class TestReasons(unittest.TestCase):
                          (rm.reasons_list(), {reas['short']: reas['long'] for reas in self.reasons}))
 
 
+    def test_cache(self):
+        first = rm.reasons_list()
+        self.assertEqual(rm.reasons_list(), first)
+        self.assertIsNot(rm.reasons_list(), first)
+
+        # A short reason that exists keeps its old long reason
+        rm.update_reasons([{'short': 'short reason 1', 'long': 'changed'},
+                           {'short': 'short reason 3', 'long': 'new reason'}])
+        reasons = rm.reasons_list()
+        self.assertEqual(reasons['short reason 1'], 'secretly long reason')
+        self.assertEqual(reasons['short reason 3'], 'new reason')
+
+        # Changes from other processes are seen too
+        conn = sqlite3.connect('reasons.db')
+        conn.execute("DELETE FROM reasons WHERE shortreason='short reason 3'")
+        conn.commit()
+        conn.close()
+        self.assertEqual(sorted(rm.short_reasons_list()), ['short reason 1', 'short reason 2'])
+
+
+class TestActionsVersion(unittest.TestCase):
+
+    def test_changes(self):
+        @ma.changes_actions
+        def write(fail):
+            if fail:
+                raise IOError('No connection')
+            return 'done'
+
+        version = ma.actions_version()
+        self.assertEqual(write(False), 'done')
+        self.assertEqual(ma.actions_version(), version + 1)
+
+        # Failed writes could have changed some actions too
+        self.assertRaises(IOError, write, True)
+        self.assertEqual(ma.actions_version(), version + 2)
+
+    def test_status_cache(self):
+        records = [{'workflow': 'wf_a', 'acted': 0, 'timestamp': 1},
+                   {'workflow': 'wf_b', 'acted': 1, 'timestamp': int(time.time())}]
+        finds = []
+
+        class FakeCollection(object):
+            def find(self, *args):
+                finds.append(args)
+                return [dict(record) for record in records]
+
+        saved = ma.get_actions_collection
+        ma.get_actions_collection = FakeCollection
+        ma.STATUSES = None
+
+        try:
+            self.assertEqual(ma.get_statuses(), {'wf_a': 0, 'wf_b': 1})
+            self.assertEqual(ma.get_acted_workflows(2), ['wf_b'])
+            self.assertEqual(len(finds), 1)
+
+            # Writes throw away the cached statuses
+            records.append({'workflow': 'wf_c', 'acted': 0, 'timestamp': int(time.time())})
+            ma.changes_actions(lambda: None)()
+            self.assertEqual(sorted(ma.get_acted_workflows(2)), ['wf_b', 'wf_c'])
+            self.assertEqual(len(finds), 2)
+
+        finally:
+            ma.get_actions_collection = saved
+            ma.STATUSES = None
+
+    def test_client(self):
+        clients = []
+        indexed = []
+
+        class FakeCollection(object):
+            def estimated_document_count(self):
+                return 0
+
+            def create_index(self, keys, **kwargs):
+                indexed.append(kwargs['name'])
+
+        class FakeClient(object):
+            def __init__(self, *args, **kwargs):
+                self.closed = False
+                clients.append(self)
+
+            def close(self):
+                self.closed = True
+
+            def __getitem__(self, database):
+                return type('Database', (object, ), {'actions': FakeCollection()})()
+
+        config = json.loads(json.dumps(sc.config_dict()))
+        config['actions'].update({'uri': 'mongodb://one', 'database': 'actions'})
+
+        saved = (ma.pymongo.MongoClient, sc.config_dict, ma.CLIENT, set(ma.INDEXED))
+        ma.pymongo.MongoClient = FakeClient
+        sc.config_dict = lambda: config
+        ma.CLIENT = None
+        ma.INDEXED.clear()
+
+        try:
+            ma.get_actions_collection()
+            ma.get_actions_collection()
+            self.assertEqual(len(clients), 1)
+            self.assertEqual(indexed, ['workflowid', 'workflow', 'timestamp'])
+
+            # A database with the same name on another server gets its own indexes
+            config['actions']['uri'] = 'mongodb://two'
+            ma.get_actions_collection()
+            self.assertEqual(len(clients), 2)
+            self.assertTrue(clients[0].closed)
+            self.assertFalse(clients[1].closed)
+            self.assertEqual(len(indexed), 6)
+
+        finally:
+            ma.pymongo.MongoClient, sc.config_dict, ma.CLIENT, indexed_before = saved
+            ma.INDEXED.clear()
+            ma.INDEXED.update(indexed_before)
+
+
 class TestActions(unittest.TestCase):
 
     reasons1 = [
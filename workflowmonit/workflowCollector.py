@@ -8,13 +8,14 @@ import json
 import time
 import gzip
 import shutil
-import threading
 from collections import defaultdict
 
 import yaml
 import cx_Oracle
 from workflowwebtools import workflowinfo
 from workflowwebtools import errorutils
+from workflowwebtools import fetchpipeline
+from workflowwebtools.infocache import get_memory_cache, get_store
 
 
 def save_json(json_obj, filename='tmp', gzipped=False):
@@ -84,6 +85,9 @@ def invalidate_caches(cacheDir=None):
     except:
         pass
 
+    get_store().clear()
+    get_memory_cache().clear()
+
 
 def get_workflowlist_from_db(config, queryCmd):
     '''
@@ -298,7 +302,7 @@ def error_logs(workflow):
     )
 
     wf_jobdetail = workflow._get_jobdetail()
-    wf_stepinfo = wf_jobdetail['result'][0].get(workflow.workflow, {})
+    wf_stepinfo = (wf_jobdetail.get('result') or [{}])[0].get(workflow.workflow, {})
 
     if not wf_stepinfo:
         return error_logs
@@ -605,17 +609,26 @@ def _get_acdc_response(wfstr):
     return response
 
 
-def filter_n_collector(res, q, minFailureRate=0.2):
+def filter_n_collect(wf, minFailureRate=0.2):
+    """
+    Given a :py:class:`WorkflowInfo`, build its error summary with
+    :py:func:`populate_error_for_workflow` if its failure rate is high enough.
+
+    :param wf: A :py:class:`WorkflowInfo` object
+    :param float minFailureRate: minimum failure rate
+    :returns: A dict representing all available error info,
+              or None if the failure rate is too low or the fetch fails
+
+    :rtype: dict
+    """
+
+    try:
+        if wf.get_failure_rate() > minFailureRate:
+            return populate_error_for_workflow(wf)
+    except:
+        pass
 
-    while not q.empty():
-        wf = q.get()
-        try:
-            if wf.get_failure_rate() > minFailureRate:
-                res.append(populate_error_for_workflow(wf))
-        except:
-            pass
-        q.task_done()
-    return True
+    return None
 
 
 def main():
@@ -632,22 +645,10 @@ def main():
     print("Number of workflows retrieved from Oracle DB: ", len(wfs))
     invalidate_caches()
 
-    try:
-        from Queue import Queue
-    except ImportError:
-        from queue import Queue # pylint: disable=import-error
-    q = Queue()
-    num_threads = min(150, len(wfs))
-
-    for wf in wfs:
-        q.put(wf)
-    results = list()
-    for _ in range(num_threads):
-        t = threading.Thread(target=filter_n_collector, args=(results, q, ))
-        t.daemon = True  # seting threads as "daemon" allows main program to exit
-        # eventually even if these dont finish correctly.
-        t.start()
-    q.join()
+    num_threads = max(1, min(150, len(wfs)))
+    fetcher = fetchpipeline.WorkflowFetcher(threads=num_threads, per_host=num_threads)
+
+    results = [doc for doc in fetcher.map(filter_n_collect, wfs) if doc]
     print("Number of workflows that has >20% failure rate: ", len(results))
 
     elasped_time = time.time() - start_time
@@ -67,7 +67,7 @@ def get_workflow_vectors(workflows, session=None, allmap=None):
     :return: a list of numpy arrays of errors for the workflow
     :rtype: list of numpy.array
     """
-    curs = globalerrors.check_session(session, can_refresh=True)
+    cube = globalerrors.check_session(session, can_refresh=True).get_cube()
     if not allmap:
         allmap = globalerrors.check_session(session).get_allmap()
 
@@ -75,30 +75,9 @@ def get_workflow_vectors(workflows, session=None, allmap=None):
     column_output = {}
 
     for column in columns:
-        # Initialize with all zeros
         settings = serverconfig.config_dict()['cluster'][column]
-        column_output[column] = [numpy.zeros(len(allmap[column])) for _ in workflows]
-
-        cherrypy.log('Getting db_lock: 3')
-        curs.db_lock.acquire()
-        curs.curs.execute("SELECT SUM(numbererrors), {0}, stepname "
-                          "FROM workflows "
-                          "GROUP BY stepname, {0} "
-                          "ORDER BY {0} ASC, stepname ASC;".format(column))
-
-        numerrors, colval, stepname = curs.curs.fetchone() or (0, '', '')
-        wfname = stepname.split('/')[1] if stepname else ''
-
-        for icol, value in enumerate(allmap[column]):
-            for iwkf, workflow in enumerate(workflows):
-                while colval == value and workflow == wfname:
-                    column_output[column][iwkf][icol] += numerrors
-                    numerrors, colval, stepname = curs.curs.fetchone() or (0, '', '')
-                    if stepname:
-                        wfname = stepname.split('/')[1]
-
-        cherrypy.log('releasing db_lock: 3')
-        curs.db_lock.release()
+        # One row for each workflow, with zeros for workflows without errors
+        column_output[column] = cube.workflow_sums(column, workflows, allmap[column])
 
         # Preprocessing here
         for output in column_output[column]:
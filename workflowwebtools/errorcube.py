@@ -0,0 +1,337 @@
+"""
+A columnar copy of the errors table of an :py:class:`globalerrors.ErrorInfo`.
+
+The pages that show errors all read the same table and aggregate it in different ways.
+An :py:class:`ErrorCube` reads the table once, when a generation is built,
+and stores each column as a NumPy array of integer codes into the lists of
+the ErrorInfo's allmap.
+The entries are sorted by step, so the entries of each step, and each workflow,
+are a contiguous slice found through offset arrays.
+
+:author: Daniel Abercrombie <dabercro@mit.edu>
+"""
+
+import numpy
+
+
+VARIABLES = ('stepname', 'errorcode', 'sitename')
+"""The variables that an entry is indexed by, in the order of the sort"""
+
+
+class ErrorCube(object):
+    """
+    Holds the number of errors for each step, error code, and site.
+    A cube is never changed after it is made.
+    """
+
+    def __init__(self, rows, allmap):
+        """
+        :param rows: Iterable of tuples of
+                     (stepname, errorcode, sitename, numbererrors, sitereadiness)
+        :param dict allmap: A globalerrors.ErrorInfo allmap with the lists of
+                            every step, error code, and site in the rows
+        """
+
+        self.labels = {var: list(allmap[var]) for var in VARIABLES}
+        self.index = {var: {value: idx for idx, value in enumerate(self.labels[var])}
+                      for var in VARIABLES}
+        # Error codes also come in as strings from the web pages
+        self.index['errorcode'].update(
+            {str(value): idx for idx, value in enumerate(self.labels['errorcode'])})
+
+        rows = list(rows)
+        readiness = sorted(set(row[4] for row in rows))
+        self.readiness = {ready: idx for idx, ready in enumerate(readiness)}
+
+        columns = {
+            var: numpy.array([self.index[var][row[col]] for row in rows], dtype=numpy.int32)
+            for col, var in enumerate(VARIABLES)
+        }
+        counts = numpy.array([row[3] for row in rows], dtype=numpy.int64)
+        ready = numpy.array([self.readiness[row[4]] for row in rows], dtype=numpy.int32)
+
+        order = numpy.lexsort((columns['sitename'], columns['errorcode'], columns['stepname']))
+
+        self.columns = {var: columns[var][order] for var in VARIABLES}
+        self.counts = counts[order]
+        self.ready = ready[order]
+
+        # Entries for step i are in the slice step_offsets[i]:step_offsets[i + 1]
+        self.step_offsets = numpy.searchsorted(
+            self.columns['stepname'], numpy.arange(len(self.labels['stepname']) + 1))
+
+        # Steps are sorted, so the steps of each workflow are next to each other
+        self.workflows = []
+        step_workflow = []
+        for step in self.labels['stepname']:
+            workflow = step.split('/')[1]
+            if not self.workflows or self.workflows[-1] != workflow:
+                self.workflows.append(workflow)
+            step_workflow.append(len(self.workflows) - 1)
+
+        self.workflow_index = {workflow: idx for idx, workflow in enumerate(self.workflows)}
+        self.step_workflow = numpy.array(step_workflow, dtype=numpy.int32)
+
+        # Entries for workflow i are in the slice workflow_offsets[i]:workflow_offsets[i + 1]
+        first_steps = numpy.searchsorted(self.step_workflow, numpy.arange(len(self.workflows) + 1))
+        self.workflow_offsets = self.step_offsets[first_steps]
+
+    def _select(self, step, readymatch=None):
+        """
+        :param str step: The name of the step
+        :param list readymatch: The site readiness statuses to keep, if set
+        :returns: The indices of the entries of the step
+        :rtype: numpy.ndarray
+        """
+
+        step_idx = self.index['stepname'].get(step)
+        if step_idx is None:
+            return numpy.arange(0)
+
+        entries = numpy.arange(self.step_offsets[step_idx], self.step_offsets[step_idx + 1])
+
+        if readymatch:
+            keep = [self.readiness[ready] for ready in readymatch if ready in self.readiness]
+            entries = entries[numpy.isin(self.ready[entries], keep)]
+
+        return entries
+
+    def triples(self, step, readymatch=None):
+        """
+        :param str step: The name of the step
+        :param list readymatch: The site readiness statuses to keep, if set
+        :returns: Tuples of ``(number of errors, site name, exit code)``,
+                  ordered by error code and then site
+        :rtype: list
+        """
+
+        entries = self._select(step, readymatch)
+        sites = self.labels['sitename']
+        codes = self.labels['errorcode']
+
+        return [(int(count), sites[site], codes[code]) for count, site, code in
+                zip(self.counts[entries], self.columns['sitename'][entries],
+                    self.columns['errorcode'][entries])]
+
+    def sparse(self, step, readymatch=None):
+        """
+        :param str step: The name of the step
+        :param list readymatch: The site readiness statuses to keep, if set
+        :returns: The errors of the step in the format ``{errorcode: {sitename: errors}}``
+        :rtype: dict
+        """
+
+        output = {}
+        for count, site, code in self.triples(step, readymatch):
+            output.setdefault(str(code), {})[site] = count
+
+        return output
+
+    def dense(self, step, readymatch=None):
+        """
+        :param str step: The name of the step
+        :param list readymatch: The site readiness statuses to keep, if set
+        :returns: The errors of the step with a row for each error code
+                  and a column for each site of the allmap
+        :rtype: numpy.ndarray
+        """
+
+        table = numpy.zeros((len(self.labels['errorcode']), len(self.labels['sitename'])),
+                            dtype=int)
+
+        entries = self._select(step, readymatch)
+        table[self.columns['errorcode'][entries],
+              self.columns['sitename'][entries]] = self.counts[entries]
+
+        return table
+
+    def workflow_sums(self, var, workflows, labels=None):
+        """
+        Sums the errors of each workflow for each value of one variable.
+
+        :param str var: Either ``'errorcode'`` or ``'sitename'``
+        :param list workflows: The workflows to make rows for.
+                               Workflows without errors get rows of zeros.
+        :param list labels: The values of ``var`` to make columns for.
+                            Defaults to the values in this cube.
+                            Errors for values not in the list are dropped.
+        :returns: A matrix with a row for each workflow and a column for each label
+        :rtype: numpy.ndarray
+        """
+
+        labels = self.labels[var] if labels is None else labels
+        label_index = {value: idx for idx, value in enumerate(labels)}
+        # Map the columns of this cube to the requested columns
+        remap = numpy.array([label_index.get(value, -1) for value in self.labels[var]] or [0],
+                            dtype=numpy.int32)
+
+        output = numpy.zeros((len(workflows), len(labels)))
+
+        for row, workflow in enumerate(workflows):
+            wkf_idx = self.workflow_index.get(workflow)
+            if wkf_idx is None:
+                continue
+
+            start, end = self.workflow_offsets[wkf_idx], self.workflow_offsets[wkf_idx + 1]
+            cols = remap[self.columns[var][start:end]]
+            keep = cols >= 0
+
+            numpy.add.at(output[row], cols[keep], self.counts[start:end][keep])
+
+        return output
+
+    def group(self, rowvar, colvar, pievar):
+        """
+        Groups the entries by three variables, in the order of the allmap.
+
+        :param str rowvar: The first variable to group by
+        :param str colvar: The second variable to group by
+        :param str pievar: The third variable to group by
+        :returns: Tuples of (row, column, pie variable, number of errors)
+        :rtype: list
+        """
+
+        order = numpy.lexsort((self.columns[pievar], self.columns[colvar], self.columns[rowvar]))
+
+        return [
+            (self.labels[rowvar][row], self.labels[colvar][col],
+             self.labels[pievar][pvar], int(count))
+            for row, col, pvar, count in zip(
+                self.columns[rowvar][order], self.columns[colvar][order],
+                self.columns[pievar][order], self.counts[order])
+        ]
+
+    def matching(self, pievar, rowvar, row, colvar, col):
+        """
+        Lists the errors for each value of one variable, where two others are fixed.
+
+        :param str pievar: The variable to list
+        :param str rowvar: The first variable to match
+        :param row: The value of ``rowvar`` to match
+        :param str colvar: The second variable to match
+        :param col: The value of ``colvar`` to match
+        :returns: Tuples of (value of pievar, number of errors)
+        :rtype: list
+        """
+
+        row_idx = self.index[rowvar].get(row)
+        col_idx = self.index[colvar].get(col)
+
+        if row_idx is None or col_idx is None:
+            return []
+
+        entries = numpy.flatnonzero((self.columns[rowvar] == row_idx) &
+                                    (self.columns[colvar] == col_idx))
+
+        return [(self.labels[pievar][pvar], int(count)) for pvar, count in
+                zip(self.columns[pievar][entries], self.counts[entries])]
+
+    def matching_sums(self, pievar, rowvar, rows, colvar, col):
+        """
+        Sums the errors for each value of one variable over many rows, where a column is fixed.
+
+        :param str pievar: The variable to list
+        :param str rowvar: The first variable to match
+        :param list rows: The values of ``rowvar`` to match any of
+        :param str colvar: The second variable to match
+        :param col: The value of ``colvar`` to match
+        :returns: Tuples of (value of pievar, number of errors), for each value with errors
+        :rtype: list
+        """
+
+        row_idx = [self.index[rowvar][row] for row in rows if row in self.index[rowvar]]
+        col_idx = self.index[colvar].get(col)
+
+        if not row_idx or col_idx is None:
+            return []
+
+        keep = numpy.isin(self.columns[rowvar], row_idx) & (self.columns[colvar] == col_idx)
+        sums = numpy.bincount(self.columns[pievar][keep], weights=self.counts[keep],
+                              minlength=len(self.labels[pievar]))
+
+        return [(self.labels[pievar][pvar], int(sums[pvar])) for pvar in numpy.flatnonzero(sums)]
+
+    def rollup(self, rowvar, colvar, pievar, levels=()):
+        """
+        Sums the errors into the format of :py:func:`globalerrors.default_errors_format`,
+        with a group for each value of ``rowvar``.
+        These groups are then rolled up into larger groups, one level at a time,
+        which gives the same result as calling :py:func:`globalerrors.group_errors`
+        once for each level.
+        The sums for every level are made from the arrays of the cube in one pass each.
+
+        :param str rowvar: The variable of the smallest groups
+        :param str colvar: The variable of the first key in ``'errors'``
+        :param str pievar: The variable of the second key in ``'errors'``
+        :param list levels: Tuples of ``(grouping_function, attributes)``,
+                            from the smallest groups to the largest.
+                            The grouping function takes the name of a group in the level below
+                            and returns the name of the group it belongs to in this level.
+                            The attributes are a dictionary of functions that take
+                            the name of a group. Each is called once for each group
+                            and its output is added to the group's dictionary.
+        :returns: The groups of the largest level
+        :rtype: dict
+        """
+
+        # The names of the groups in each level, the group of each entry,
+        # and the group in the next level of each group
+        names = [self.labels[rowvar]]
+        assign = [self.columns[rowvar]]
+        parents = []
+
+        for grouping_function, _ in levels:
+            lower = names[-1]
+            parent = numpy.zeros(len(lower), dtype=numpy.int32)
+            upper = []
+            index = {}
+
+            # The grouping function is only called once for each lower group with errors
+            for group in numpy.unique(assign[-1]).tolist():
+                name = grouping_function(lower[group])
+                if name not in index:
+                    index[name] = len(upper)
+                    upper.append(name)
+                parent[group] = index[name]
+
+            names.append(upper)
+            assign.append(parent[assign[-1]])
+            parents.append(parent)
+
+        num_pievars = len(self.labels[pievar])
+        num_cells = len(self.labels[colvar]) * num_pievars
+        cells = self.columns[colvar].astype(numpy.int64) * num_pievars + self.columns[pievar]
+
+        entries = {}
+
+        for level, (groups, group_of) in enumerate(zip(names, assign)):
+            keys, inverse = numpy.unique(group_of.astype(numpy.int64) * num_cells + cells,
+                                         return_inverse=True)
+            sums = numpy.bincount(inverse.ravel(), weights=self.counts)
+            totals = numpy.bincount(group_of, weights=self.counts, minlength=len(groups))
+
+            # Keyed by the index of each group in this level
+            current = {}
+            for key, numerrors in zip(keys.tolist(), sums.tolist()):
+                group, cell = divmod(key, num_cells)
+                col, pvar = divmod(cell, num_pievars)
+
+                entry = current.get(group)
+                if entry is None:
+                    entry = current[group] = {
+                        'errors': {}, 'sub': {}, 'total': int(totals[group])}
+                    if level:
+                        for attribute, func in levels[level - 1][1].items():
+                            entry[attribute] = func(groups[group])
+
+                entry['errors'].setdefault(self.labels[colvar][col], {})[
+                    self.labels[pievar][pvar]] = int(numerrors)
+
+            if level:
+                lower = names[level - 1]
+                for sub, sub_entry in entries.items():
+                    current[int(parents[level - 1][sub])]['sub'][lower[sub]] = sub_entry
+
+            entries = current
+
+        return {names[-1][group]: entry for group, entry in entries.items()}
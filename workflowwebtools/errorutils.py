@@ -8,8 +8,8 @@ to generate an ErrorInfo instance in other applications.
 
 
 import os
-import json
 import re
+import itertools
 try:
     import urlparse
 except ImportError:
@@ -19,29 +19,20 @@ import validators
 import cherrypy
 import cx_Oracle
 
-from cmstoolbox import sitereadiness
-from cmstoolbox.webtools import get_json
-
-from . import workflowinfo
+from . import fetchpipeline
+from . import jsonstream
 from . import serverconfig
+from . import sitestatus
+from . import webclient
 
 def errors_from_list(workflows):
     """
     :param list workflows: A list of workflows that are in assistance-manual
-    :returns: The errors for the workflows
+    :returns: The errors for the workflows and all other workflows with the same Prep IDs
     :rtype: dict
     """
-    indict = {}
-
-    for workflow in workflows:
-        base = workflowinfo.WorkflowInfo(workflow)
-        prep_id = base.get_prep_id()
-        for wkf in set(workflowinfo.PrepIDInfo(prep_id).get_workflows()):
-            indict.update(
-                workflowinfo.WorkflowInfo(wkf).get_errors(get_unreported=True)
-                )
 
-    return indict
+    return fetchpipeline.get_fetcher().errors_from_list(workflows)
 
 
 def assistance_manual(key='assistance-manual'):
@@ -80,6 +71,22 @@ def open_location(data_location):
     :returns: information in the JSON file
     :rtype: dict
     """
+
+    return dict(iter_location(data_location))
+
+
+def iter_location(data_location):
+    """
+    Iterates over the errors of each step from a data location.
+    A local file or the response from a URL is read one step at a time
+    with :py:mod:`jsonstream`, so the whole document is never loaded at once.
+    If the location holds the statuses of workflows instead of errors,
+    the errors of the workflows in manual assistance are fetched.
+
+    :param str data_location: The location of the file or url
+    :returns: Generator of tuples of (stepname, {errorcode: {sitename: number_errors}})
+    :rtype: generator
+    """
     config_dict = serverconfig.config_dict()
 
     if 'oracle' in config_dict:
@@ -90,16 +97,20 @@ def open_location(data_location):
                 "SELECT NAME FROM CMS_UNIFIED_ADMIN.workflow WHERE lower(STATUS) LIKE '%manual%'")
             wkfs = [row for row, in oracle_cursor]
             oracle_db_conn.close()
-            return errors_from_list(wkfs)
+            raw = errors_from_list(wkfs)
 
         except cx_Oracle.DatabaseError:
-            return None
+            return
 
-    raw = None
+        for item in raw.items():
+            yield item
+
+        return
 
     if os.path.isfile(data_location):
         with open(data_location, 'r') as input_file:
-            raw = json.load(input_file)
+            for item in _errors_or_statuses(jsonstream.iter_items(input_file)):
+                yield item
 
     elif validators.url(data_location):
         components = urlparse.urlparse(data_location)
@@ -107,28 +118,53 @@ def open_location(data_location):
         # Anything we need for the Shibboleth cookie could be in the config file
         cookie_stuff = config_dict['data']
 
-        raw = get_json(components.netloc, components.path,
-                       use_https=True,
-                       cookie_file=cookie_stuff.get('cookie_file'),
-                       cookie_pem=cookie_stuff.get('cookie_pem'),
-                       cookie_key=cookie_stuff.get('cookie_key'))
+        items = webclient.iter_json(components.netloc, components.path,
+                                    use_https=True,
+                                    cookie_file=cookie_stuff.get('cookie_file'),
+                                    cookie_pem=cookie_stuff.get('cookie_pem'),
+                                    cookie_key=cookie_stuff.get('cookie_key'))
+
+        for item in _errors_or_statuses(items):
+            yield item
 
-    if raw is None:
-        return raw
 
-    if not (raw and isinstance(raw[list(raw)[0]], list)):
-        return raw
+def _errors_or_statuses(items):
+    """
+    Passes along the steps of an errors document.
+    If the document holds the statuses of workflows instead,
+    the errors of the workflows in manual assistance are fetched.
+
+    :param items: Iterator of the members of the document
+    :returns: Generator of tuples of (stepname, {errorcode: {sitename: number_errors}})
+    :rtype: generator
+    """
 
-    return errors_from_list([
-        workflow for workflow, statuses in raw.items()
+    first = next(items, None)
+
+    if first is None:
+        return
+
+    if not isinstance(first[1], list):
+        yield first
+        for item in items:
+            yield item
+
+        return
+
+    # This is a statuses document, so only keep the names of manual workflows
+    raw = errors_from_list([
+        workflow for workflow, statuses in itertools.chain([first], items)
         if True in ['manual' in status for status in statuses]
     ])
 
+    for item in raw.items():
+        yield item
+
 
 def get_list_info(status_list):
     """
-    Get the list of workflows that match the statuses listed
-    via :py:mod:`workflowinfo`.
+    Get the errors of a list of workflows via :py:mod:`workflowinfo`,
+    fetching the workflows concurrently.
 
     :param list status_list: The list of workflow statuses to get the info for
     :returns: The workflow info dictionary, which matches the format of
@@ -136,16 +172,39 @@ def get_list_info(status_list):
     :rtype: dict
     """
 
-    indict = {}
-    for workflow in status_list:
-        indict.update(
-            workflowinfo.WorkflowInfo(workflow).get_errors(get_unreported=True)
-            )
+    return fetchpipeline.get_fetcher().get_errors(status_list)
 
-    return indict
 
+def iter_cells(items):
+    """
+    Filters the errors of each step into the cells of the workflows table.
+    LogCollect and Cleanup steps, and error codes that are not numbers, are skipped.
 
-def add_to_database(curs, data_location):
+    :param items: Iterable of tuples of (stepname, {errorcode: {sitename: number_errors}})
+    :returns: Generator of tuples of (fullkey, stepname, errorcode, sitename, numbererrors)
+    :rtype: generator
+    """
+
+    for stepname, errorcodes in items:
+        if 'LogCollect' in stepname or 'Cleanup' in stepname:
+            continue
+
+        for errorcode, sitenames in errorcodes.items():
+            if errorcode == 'NotReported':
+                errorcode = '-1'
+
+            elif not re.match(r'\d+', errorcode):
+                continue
+
+            for sitename, numbererrors in sitenames.items():
+                numbererrors = numbererrors or int(errorcode == '-1')
+
+                if numbererrors:
+                    yield ('_'.join([stepname, sitename, errorcode]),
+                           stepname, errorcode, sitename, numbererrors)
+
+
+def add_to_database(curs, data_location, batch=True):
     """Add data from a file to a central database through the passed cursor
 
     :param sqlite3.Cursor curs: is the cursor to the database
@@ -157,38 +216,34 @@ def add_to_database(curs, data_location):
          an empty database will be returned.
          If a list, it's a list of status to get workflows from wmstats.
     :type data_location: str or list
+    :param bool batch: If True, all rows are inserted with a single ``executemany``,
+                       letting SQLite skip keys that are already in the table.
+                       If False, each row is checked and inserted separately.
     """
 
-    indict = get_list_info(data_location) \
+    items = get_list_info(data_location).items() \
         if isinstance(data_location, list) else \
-        (open_location(data_location) or {})
+        iter_location(data_location)
 
     number_added = 0
+    snapshot = sitestatus.get_snapshot()
 
-    for stepname, errorcodes in indict.items():
-        if 'LogCollect' in stepname or 'Cleanup' in stepname:
-            continue
-
-        for errorcode, sitenames in errorcodes.items():
-            if errorcode == 'NotReported':
-                errorcode = '-1'
-
-            elif not re.match(r'\d+', errorcode):
-                continue
+    if batch:
+        number_added = curs.executemany(
+            'INSERT OR IGNORE INTO workflows VALUES (?,?,?,?,?,?)',
+            (cell + (snapshot.site_readiness(cell[3]),) for cell in iter_cells(items))
+            ).rowcount
 
-            for sitename, numbererrors in sitenames.items():
-                numbererrors = numbererrors or int(errorcode == '-1')
-
-                if numbererrors:
-                    full_key = '_'.join([stepname, sitename, errorcode])
-                    if not list(curs.execute(
-                            'SELECT EXISTS(SELECT 1 FROM workflows WHERE fullkey=? LIMIT 1)',
-                            (full_key,)))[0][0]:
-                        number_added += 1
-                        curs.execute('INSERT INTO workflows VALUES (?,?,?,?,?,?)',
-                                     (full_key, stepname, errorcode,
-                                      sitename, numbererrors,
-                                      sitereadiness.site_readiness(sitename)))
+    else:
+        for full_key, stepname, errorcode, sitename, numbererrors in iter_cells(items):
+            if not list(curs.execute(
+                    'SELECT EXISTS(SELECT 1 FROM workflows WHERE fullkey=? LIMIT 1)',
+                    (full_key,)))[0][0]:
+                number_added += 1
+                curs.execute('INSERT INTO workflows VALUES (?,?,?,?,?,?)',
+                             (full_key, stepname, errorcode,
+                              sitename, numbererrors,
+                              snapshot.site_readiness(sitename)))
 
     # This is to prevent the ErrorInfo objects from locking the database
     if 'conn' in dir(curs):
@@ -199,14 +254,15 @@ def add_to_database(curs, data_location):
 
 
 def create_table(curs):
-    """Create the workflows error table with the proper format
+    """Create the workflows error table with the proper format.
+    The table has no indexes other than the one on ``fullkey``,
+    since the pages read the :py:class:`errorcube.ErrorCube` instead.
+
     :param sqlite3.Cursor curs: is the cursor to the database
     """
 
     curs.execute(
-        'CREATE TABLE workflows (fullkey varchar(1023) UNIQUE, '
+        'CREATE TABLE IF NOT EXISTS workflows (fullkey varchar(1023) UNIQUE, '
         'stepname varchar(255), errorcode int, '
         'sitename varchar(255), numbererrors int, '
         'sitereadiness varchar(15))')
-    # Hopefully this makes lookups faster
-    curs.execute('CREATE INDEX composite_index ON workflows (stepname, errorcode, sitename)')
@@ -0,0 +1,332 @@
+"""
+Fetches information about many workflows at once.
+
+Looking at the errors of a list of workflows means first getting
+the Prep ID of each workflow, then every workflow under each Prep ID,
+and then the errors of all of those workflows.
+Each of those is a separate round trip to cmsweb,
+so the :py:class:`WorkflowFetcher` runs them in a bounded thread pool.
+A new step is started as soon as the step it depends on finishes,
+there is a limit on how many calls can go to the same host at once,
+and a Prep ID or workflow that is already being fetched is not fetched again.
+
+The ReqMgr2 parameters of many workflows are fetched with
+one request for each chunk of workflows by :py:meth:`WorkflowFetcher.load_parameters`.
+
+The size of the pool, the limit per host, and the size of the chunks
+can be set in ``config.yml``::
+
+  fetch:
+    threads: 16
+    per_host: 8
+    chunk_size: 50
+
+:author: Daniel Abercrombie <dabercro@mit.edu>
+"""
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import workflowinfo
+from . import serverconfig
+
+
+class WorkflowFetcher(object):
+    """
+    Holds a thread pool to fetch workflow information concurrently.
+    Any function that takes a workflow name can be run on a list of workflows
+    with :py:meth:`map`, and the common chains of fetches have their own methods.
+    """
+
+    def __init__(self, threads=None, per_host=None, chunk_size=None):
+        """
+        :param int threads: The number of threads in the pool.
+                            Defaults to ``fetch: threads`` in the configuration, or 16.
+        :param int per_host: The maximum number of calls to a single host at once.
+                             Defaults to ``fetch: per_host`` in the configuration, or 8.
+        :param int chunk_size: The number of workflows in each request to ReqMgr2.
+                               Defaults to ``fetch: chunk_size`` in the configuration, or 50.
+        """
+
+        config = serverconfig.config_dict().get('fetch', {})
+
+        self.threads = int(threads or config.get('threads', 16))
+        self.per_host = int(per_host or config.get('per_host', 8))
+        self.chunk_size = int(chunk_size or config.get('chunk_size', 50))
+
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+
+        self.lock = threading.Lock()
+        # Semaphores limiting the calls to each host
+        self.hostlocks = {}
+        # Futures of fetches that are still running, to avoid duplicates
+        self.inflight = {}
+
+    def _host_lock(self, host):
+        """
+        :param str host: The host that is being called
+        :returns: The semaphore for that host
+        :rtype: threading.BoundedSemaphore
+        """
+
+        with self.lock:
+            if host not in self.hostlocks:
+                self.hostlocks[host] = threading.BoundedSemaphore(self.per_host)
+
+            return self.hostlocks[host]
+
+    def _run(self, host, func, *args):
+        """
+        Runs a function while holding the semaphore for a host.
+
+        :param str host: The host that the function calls
+        :param func func: The function to run
+        :param args: Arguments to pass to the function
+        :returns: The output of the function
+        """
+
+        with self._host_lock(host):
+            return func(*args)
+
+    def submit(self, key, host, func, *args):
+        """
+        Schedules a fetch, unless a fetch with the same key is still running.
+        In that case, the future of the running fetch is returned instead.
+
+        :param tuple key: Identifies the fetch, for example ``('prep_id', workflow)``
+        :param str host: The host that the function calls
+        :param func func: The function to run
+        :param args: Arguments to pass to the function
+        :returns: A future for the output of the function
+        :rtype: concurrent.futures.Future
+        """
+
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                return future
+
+            future = self.pool.submit(self._run, host, func, *args)
+            self.inflight[key] = future
+
+        # Outside of the lock, since this runs immediately if the future is already done
+        future.add_done_callback(lambda done: self._done(key, done))
+
+        return future
+
+    def _done(self, key, future):
+        """
+        Forget about a fetch that has finished.
+        The next fetch of the same thing will go through the caches in
+        :py:mod:`workflowinfo` instead.
+
+        :param tuple key: The key given to :py:meth:`submit`
+        :param concurrent.futures.Future future: The future that finished
+        """
+
+        with self.lock:
+            if self.inflight.get(key) is future:
+                self.inflight.pop(key)
+
+    def map(self, func, workflows, get_workflow=None):
+        """
+        Calls a function on the :py:class:`workflowinfo.WorkflowInfo`
+        of each workflow in a list, concurrently.
+
+        :param func func: Function that takes a :py:class:`workflowinfo.WorkflowInfo`
+        :param list workflows: Names of workflows, or WorkflowInfo objects
+        :param func get_workflow: Function that returns a WorkflowInfo from a name.
+                                  Defaults to making a new WorkflowInfo.
+        :returns: The outputs of the function, in the same order as ``workflows``
+        :rtype: list
+        """
+
+        get_workflow = get_workflow or workflowinfo.WorkflowInfo
+
+        infos = [
+            wkf if isinstance(wkf, workflowinfo.WorkflowInfo) else get_workflow(wkf)
+            for wkf in workflows
+        ]
+
+        futures = [self.pool.submit(self._run, info.url, func, info) for info in infos]
+
+        return [future.result() for future in futures]
+
+    def get_errors(self, workflows, get_workflow=None):
+        """
+        Gets the errors of many workflows.
+
+        :param list workflows: The names of the workflows
+        :param func get_workflow: Function that returns a WorkflowInfo from a name.
+                                  Defaults to making a new WorkflowInfo.
+        :returns: The errors of all of the workflows merged together in the format::
+
+                  {step: {errorcode: {site: number_errors}}}
+
+        :rtype: dict
+        """
+
+        indict = {}
+
+        for errors in self.map(lambda info: info.get_errors(get_unreported=True),
+                               workflows, get_workflow):
+            indict.update(errors)
+
+        return indict
+
+    def load_parameters(self, workflows, get_workflow=None):
+        """
+        Fills the ``workflow_params`` cache of many workflows at once.
+        Workflows that are already cached are skipped, and the rest are
+        requested from ReqMgr2 in chunks.
+
+        :param list workflows: The names of the workflows
+        :param func get_workflow: Function that returns a WorkflowInfo from a name.
+                                  Defaults to making a new WorkflowInfo.
+        :returns: The number of workflows that were fetched
+        :rtype: int
+        """
+
+        get_workflow = get_workflow or workflowinfo.WorkflowInfo
+
+        infos = {}
+        for workflow in set(workflows):
+            info = get_workflow(workflow)
+            if not info.is_cached('workflow_params'):
+                infos[workflow] = info
+
+        names = sorted(infos)
+        chunks = [names[start:start + self.chunk_size]
+                  for start in range(0, len(names), self.chunk_size)]
+
+        futures = [
+            self.pool.submit(self._run, infos[chunk[0]].url,
+                             workflowinfo.get_workflow_parameters, chunk, infos[chunk[0]].url)
+            for chunk in chunks
+        ]
+
+        for future in futures:
+            for workflow, params in future.result().items():
+                if workflow in infos:
+                    infos[workflow].set_cache('workflow_params', params)
+
+        return len(names)
+
+    def prep_id_workflows(self, workflows, get_workflow=None, get_prepid=None):
+        """
+        Gets all of the workflows sharing a Prep ID with any workflow in a list.
+
+        :param list workflows: The names of the workflows
+        :param func get_workflow: Function that returns a WorkflowInfo from a name.
+                                  Defaults to making a new WorkflowInfo.
+        :param func get_prepid: Function that returns a PrepIDInfo from a Prep ID.
+                                Defaults to making a new PrepIDInfo.
+        :returns: The names of the workflows, each only listed once
+        :rtype: list
+        """
+
+        output = []
+        self._chain(workflows, get_workflow, get_prepid, output.append)
+
+        return output
+
+    def errors_from_list(self, workflows, get_workflow=None, get_prepid=None):
+        """
+        Gets the errors of every workflow sharing a Prep ID with any workflow in a list.
+        Errors for a workflow are fetched as soon as its Prep ID has been looked up.
+
+        :param list workflows: The names of the workflows
+        :param func get_workflow: Function that returns a WorkflowInfo from a name.
+                                  Defaults to making a new WorkflowInfo.
+        :param func get_prepid: Function that returns a PrepIDInfo from a Prep ID.
+                                Defaults to making a new PrepIDInfo.
+        :returns: The errors of all of the workflows merged together in the format::
+
+                  {step: {errorcode: {site: number_errors}}}
+
+        :rtype: dict
+        """
+
+        get_workflow = get_workflow or workflowinfo.WorkflowInfo
+        error_futures = []
+
+        def fetch_errors(workflow):
+            """Start fetching the errors of a workflow"""
+            info = get_workflow(workflow)
+            error_futures.append(
+                self.submit(('errors', workflow), info.url,
+                            info.get_errors, True)
+                )
+
+        self._chain(workflows, get_workflow, get_prepid, fetch_errors)
+
+        indict = {}
+        for future in error_futures:
+            indict.update(future.result())
+
+        return indict
+
+    def _chain(self, workflows, get_workflow, get_prepid, callback):
+        """
+        Looks up the Prep ID of each workflow and then the workflows of each Prep ID.
+        The callback is called from this thread on each workflow found,
+        as soon as it is found.
+
+        :param list workflows: The names of the workflows
+        :param func get_workflow: Function that returns a WorkflowInfo from a name
+        :param func get_prepid: Function that returns a PrepIDInfo from a Prep ID
+        :param func callback: Function that is given the name of each workflow found
+        """
+
+        get_workflow = get_workflow or workflowinfo.WorkflowInfo
+        get_prepid = get_prepid or workflowinfo.PrepIDInfo
+
+        # Each running future points to the next step to take with its output
+        pending = {}
+        seen_prep_ids = set()
+        seen_workflows = set()
+
+        for workflow in set(workflows):
+            info = get_workflow(workflow)
+            pending[self.submit(('prep_id', workflow), info.url, info.get_prep_id)] = 'prep_id'
+
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                step = pending.pop(future)
+
+                if step == 'prep_id':
+                    prep_id = future.result()
+                    if prep_id not in seen_prep_ids:
+                        seen_prep_ids.add(prep_id)
+                        prep_info = get_prepid(prep_id)
+                        pending[self.submit(('workflows', prep_id), prep_info.url,
+                                            prep_info.get_workflows)] = 'workflows'
+
+                else:
+                    for workflow in future.result():
+                        if workflow not in seen_workflows:
+                            seen_workflows.add(workflow)
+                            callback(workflow)
+
+
+FETCHER = None
+FETCHER_LOCK = threading.Lock()
+
+
+def get_fetcher():
+    """
+    :returns: The fetcher shared by everything in this process,
+              so that fetches already running are never repeated
+    :rtype: WorkflowFetcher
+    """
+
+    global FETCHER # pylint: disable=global-statement
+
+    with FETCHER_LOCK:
+        if FETCHER is None:
+            FETCHER = WorkflowFetcher()
+
+    return FETCHER
@@ -9,21 +9,24 @@ Generates the content for the errors pages
 import os
 import sqlite3
 import time
+import weakref
 import threading
 
 from collections import defaultdict
 
+import numpy
 import cherrypy
 
-from cmstoolbox import sitereadiness
-
 from . import workflowinfo
 from . import errorutils
+from . import errorcube
+from . import fetchpipeline
 from . import serverconfig
+from . import sitestatus
 from .reasonsmanip import reasons_list
 
 class ErrorInfo: # pylint: disable=too-many-instance-attributes
-    """Holds the information for any errors for a session"""
+    """Holds the information for any errors, shared by sessions through :py:func:`check_session`"""
 
     def __init__(self, data_location=''):
         """Initialization with a setup.
@@ -32,6 +35,9 @@ class ErrorInfo: # pylint: disable=too-many-instance-attributes
 
         self.data_location = data_location
 
+        # Set by publish_info() when this becomes a shared generation
+        self.generation = None
+
         # These are setup by setup()
         self.timestamp = None
         self.conn = None
@@ -47,8 +53,8 @@ class ErrorInfo: # pylint: disable=too-many-instance-attributes
         self.workflowinfos = {}
         # These are set in get_prepid()
         self.prepidinfos = {}
-        # Filled by _get_step_tables
-        self._step_tables = None
+        # Filled by get_cube
+        self._cube = None
         # Filled by get_step_list
         self._step_list = None
 
@@ -84,6 +90,27 @@ class ErrorInfo: # pylint: disable=too-many-instance-attributes
 
         return output
 
+    def executemany(self, query, seq_of_params):
+        """
+        Locks the internal database and runs a query for each set of parameters
+        in a single transaction.
+
+        :param str query: The query, which should include '?'
+        :param seq_of_params: Iterable of tuples to pass into the query
+        :returns: The cursor used, so that ``rowcount`` can be checked
+        :rtype: sqlite3.Cursor
+        """
+
+        self.db_lock.acquire()
+        curs = self.conn.cursor()
+        try:
+            curs.executemany(query, seq_of_params)
+            self.conn.commit()
+        finally:
+            self.db_lock.release()
+
+        return curs
+
 
     def setup(self):
         """Create an SQL database from the all_errors.json generated by production"""
@@ -113,15 +140,21 @@ class ErrorInfo: # pylint: disable=too-many-instance-attributes
 
 
         self.set_all_lists()
-        self.readiness = [sitereadiness.site_readiness(site) for site in self.info[3]]
+        snapshot = sitestatus.get_snapshot()
+        self.readiness = [snapshot.site_readiness(site) for site in self.info[3]]
 
         if not self.data_location:
             current_workflows = self.return_workflows()
+            fetcher = fetchpipeline.get_fetcher()
 
-            prep_ids = {self.get_workflow(wf).get_prep_id() for wf in current_workflows}
+            # The Prep IDs are in the parameters, so get them all at once
+            fetcher.load_parameters(current_workflows, self.get_workflow)
+            other_workflows = fetcher.prep_id_workflows(
+                current_workflows, self.get_workflow, self.get_prepid)
 
-            other_workflows = sum([self.get_prepid(prep_id).get_workflows() \
-                                       for prep_id in prep_ids], [])
+            # The requests for each Prep ID already hold the parameters of the other workflows
+            for prep_info in list(self.prepidinfos.values()):
+                prep_info.prime_workflows(self.get_workflow)
 
             errorutils.add_to_database(self, [new for new in other_workflows \
                                                   if new not in current_workflows])
@@ -134,7 +167,7 @@ class ErrorInfo: # pylint: disable=too-many-instance-attributes
                                           if zero not in current_workflows])
                 self.allsteps.sort()
 
-            self.readiness = [sitereadiness.site_readiness(site) for site in self.info[3]]
+            self.readiness = [snapshot.site_readiness(site) for site in self.info[3]]
 
         self.connection_log('opened')
 
@@ -175,17 +208,23 @@ class ErrorInfo: # pylint: disable=too-many-instance-attributes
         allerrors = get_all('errorcode')
         allerrors.sort(key=safe_int)
 
-        self.info = self, allsteps, allerrors, allsites
+        # A proxy, so that the object does not refer to itself and is freed
+        # as soon as the last session lets go of it
+        self.info = weakref.proxy(self), allsteps, allerrors, allsites
+        self._cube = None
 
         self.allsteps = allsteps
 
     def teardown(self):
         """Close the database when cache expires"""
-        self._step_tables = None
+        self._cube = None
         self._step_list = None
 
-        self.conn.close()
-        self.connection_log('closed')
+        # Nothing to close if setup() failed before connecting
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            self.connection_log('closed')
 
         if self.clusters:
             self.clusters = {}
@@ -261,39 +300,41 @@ class ErrorInfo: # pylint: disable=too-many-instance-attributes
         :rtype: list
         """
 
-        if self._step_list is None:
-            self._step_list = defaultdict(list)
-            cherrypy.log('Getting db_lock: 2')
-            self.db_lock.acquire()
-            self.curs.execute('SELECT DISTINCT(stepname) FROM workflows ORDER BY stepname')
-            for tup in self.curs.fetchall():
+        step_list = self._step_list
+        if step_list is None:
+            # Only shared once it is full, since pages for other workflows read it at the same time
+            step_list = defaultdict(list)
+            for tup in self.execute('SELECT DISTINCT(stepname) FROM workflows ORDER BY stepname'):
                 stepname = tup[0]
-                self._step_list[stepname.split('/')[1]].append(stepname)
-            cherrypy.log('Releasing db_lock: 2')
-            self.db_lock.release()
+                step_list[stepname.split('/')[1]].append(stepname)
+            self._step_list = step_list
+
+        return list(step_list.get(workflow, []))
 
-        return self._step_list[workflow]
+    def get_cube(self):
+        """
+        The cube is built from the database the first time it is needed,
+        and then shared by every page that reads this generation.
 
-    def _get_step_tables(self):
-        """Sets the internal step tables for fast fetching"""
+        :returns: The columnar copy of the errors table
+        :rtype: errorcube.ErrorCube
+        """
 
-        # The keys are stepname, then sitereadiness
-        self._step_tables = defaultdict(lambda: defaultdict(list))
+        cube = self._cube
+        if cube is None:
+            cherrypy.log('Building error cube')
+            cube = errorcube.ErrorCube(
+                self.execute('SELECT stepname, errorcode, sitename, numbererrors, '
+                             'sitereadiness FROM workflows'),
+                self.get_allmap())
+            self._cube = cube
 
-        for step, ready, errors, site, code in self.execute(
-                """
-                SELECT stepname, sitereadiness, numbererrors, sitename, errorcode FROM workflows
-                ORDER BY errorcode ASC, sitename ASC
-                """):
-            # Append everything to 'all' to keep the order
-            self._step_tables[step]['all'].append((errors, site, code))
-            # Order is not as important when we are getting sparse for different readiness
-            self._step_tables[step][ready].append((errors, site, code))
+        return cube
 
     def get_step_table(self, step, readymatch=None):
         """
         Get the sparse representation of the step table.
-        Fetches from an internal dictionary, so faster than database access
+        Fetches from the error cube, so faster than database access
 
         :param str step: The step name for the table
         :param list readymatch: The list of site readiness statuses to match
@@ -303,68 +344,246 @@ class ErrorInfo: # pylint: disable=too-many-instance-attributes
         :rtype: list of tuples
         """
 
-        if self._step_tables is None:
-            cherrypy.log('Setting up step tables')
-            self._get_step_tables()
+        return self.get_cube().triples(step, readymatch)
 
-        keys = readymatch or ['all']
 
-        output = []
-        for key in keys:
-            output.extend(self._step_tables[step][key])
+GLOBAL_INFO = None
+"""The current generation of :py:class:`ErrorInfo` shared by every session"""
+GLOBAL_LOCK = threading.Lock()
+BUILD_LOCK = threading.Lock()
+GENERATION = 0
 
-        return output
+REFRESHER = None
+"""The background thread started by :py:func:`start_refresher`"""
+REFRESH_EVENT = threading.Event()
+REFRESH_STATUS = {'building': False, 'last_build_time': None, 'last_error': None}
+"""Replaced as a whole by :py:func:`_set_status`, and never changed in place"""
+STATUS_LOCK = threading.Lock()
 
 
-GLOBAL_INFO = None
-GLOBAL_LOCK = threading.Lock()
+def _set_status(**changes):
+    """
+    Publishes a new copy of :py:data:`REFRESH_STATUS` with some keys changed,
+    so that readers never see a status that is partly updated.
+
+    :param changes: The keys of the status to change, and their new values
+    """
+
+    global REFRESH_STATUS
+
+    with STATUS_LOCK:
+        status = dict(REFRESH_STATUS)
+        status.update(changes)
+        REFRESH_STATUS = status
+
+
+def publish_info(info):
+    """
+    Atomically make an ErrorInfo the generation shared by all sessions.
+    The previous generation is not closed here.
+    Sessions still holding a reference keep reading from it until they
+    move to the new generation.
+    An ErrorInfo does not refer to itself, so it is torn down by
+    :py:meth:`ErrorInfo.teardown` as soon as the last reference is gone.
+
+    :param ErrorInfo info: A fully set up ErrorInfo
+    :returns: The generation number given to the ErrorInfo
+    :rtype: int
+    """
+
+    global GLOBAL_INFO
+    global GENERATION
+
+    with GLOBAL_LOCK:
+        GENERATION += 1
+        info.generation = GENERATION
+        GLOBAL_INFO = info
+
+    cherrypy.log('Published ErrorInfo generation %i' % info.generation)
+
+    return info.generation
+
+
+def refresh_info(wait=True):
+    """
+    Builds a new generation of the shared ErrorInfo off to the side
+    and publishes it when it is ready.
+    Only one generation is built at a time.
+
+    :param bool wait: If False, return immediately when another thread
+                      is already building a generation
+    :returns: The current shared ErrorInfo
+    :rtype: ErrorInfo
+    """
+
+    start_generation = GENERATION
+
+    if BUILD_LOCK.acquire(wait):
+        try:
+            # Someone else published while we were waiting for the lock
+            if GLOBAL_INFO is None or GENERATION == start_generation:
+                _set_status(building=True)
+                start = time.time()
+                publish_info(ErrorInfo())
+                _set_status(last_build_time=time.time() - start)
+        finally:
+            _set_status(building=False)
+            BUILD_LOCK.release()
+
+    return get_global_info()
+
+
+def info_age():
+    """
+    :returns: The age of the shared ErrorInfo in seconds, or None if there is none yet
+    :rtype: float
+    """
+
+    theinfo = GLOBAL_INFO
+    if theinfo is None:
+        return None
+
+    return time.time() - theinfo.timestamp
+
+
+def _refresh_loop():
+    """
+    Body of the refresher thread.
+    Builds a new generation whenever the current one is older than
+    ``refresh_period`` minutes, or when :py:func:`request_refresh` is called.
+    If a build fails, the old generation keeps being served
+    and the build is tried again after a minute.
+    """
+
+    while True:
+        period = 60 * serverconfig.config_dict()['refresh_period']
+        age = info_age()
+
+        if age is not None and age < period:
+            REFRESH_EVENT.wait(period - age)
+            if not REFRESH_EVENT.is_set() and info_age() < period:
+                continue
+
+        REFRESH_EVENT.clear()
+
+        try:
+            refresh_info()
+            _set_status(last_error=None)
+        except Exception as err: # pylint: disable=broad-except
+            cherrypy.log('Failed to build new ErrorInfo: %s' % err, traceback=True)
+            _set_status(last_error=str(err))
+            REFRESH_EVENT.wait(60)
+
+
+def start_refresher():
+    """
+    Starts the thread that keeps the shared ErrorInfo up to date.
+    Once it is running, requests never build a generation themselves.
+    Calling this more than once does nothing.
+    """
+
+    global REFRESHER
+
+    with GLOBAL_LOCK:
+        if REFRESHER is None:
+            REFRESHER = threading.Thread(target=_refresh_loop, name='ErrorInfoRefresher')
+            REFRESHER.daemon = True
+            REFRESHER.start()
+
+
+def request_refresh():
+    """
+    Asks for a new generation of the shared ErrorInfo without waiting for it.
+    If the refresher thread is not running, this builds the new generation
+    in a separate thread instead.
+    """
+
+    if REFRESHER is None:
+        thread = threading.Thread(target=refresh_info, kwargs={'wait': False})
+        thread.daemon = True
+        thread.start()
+    else:
+        REFRESH_EVENT.set()
+
+
+def refresh_status():
+    """
+    :returns: Information about the shared ErrorInfo and how it is refreshed.
+              The keys are the following:
+
+              - ``generation`` -- The number of the generation currently served
+              - ``timestamp`` -- When the generation started being built
+              - ``age`` -- Age of the generation in seconds
+              - ``refresh_period`` -- Maximum age in seconds before rebuilding
+              - ``refresher`` -- Whether the background refresher is running
+              - ``building`` -- Whether a new generation is being built right now
+              - ``last_build_time`` -- Seconds it took to build the last generation
+              - ``last_error`` -- Error message from the last failed build, if any
+
+    :rtype: dict
+    """
+
+    theinfo = GLOBAL_INFO
+
+    output = {
+        'generation': None if theinfo is None else theinfo.generation,
+        'timestamp': None if theinfo is None else theinfo.timestamp,
+        'age': info_age(),
+        'refresh_period': 60 * serverconfig.config_dict()['refresh_period'],
+        'refresher': REFRESHER is not None and REFRESHER.is_alive()
+        }
+
+    output.update(REFRESH_STATUS)
+
+    return output
+
+
+def get_global_info():
+    """
+    :returns: The current shared ErrorInfo, building the first generation if needed
+    :rtype: ErrorInfo
+    """
+
+    theinfo = GLOBAL_INFO
+    if theinfo is None:
+        theinfo = refresh_info()
+
+    return theinfo
 
 
 def check_session(session, can_refresh=False):
-    """If session is None, fills it.
+    """Get the ErrorInfo that a session should read from.
+
+    Every session shares the same generation of ErrorInfo and only keeps
+    a reference to it under the ``'info'`` key.
+    The session stays on that generation until it is allowed to refresh,
+    so that a single page sees consistent data.
+    If a caller places its own ErrorInfo in the session
+    (for example, to read the history database), that one is returned instead.
 
     :param cherrypy.Session session: the current session
-    :param bool can_refresh: tells the function if it is safe to refresh
-                             and close the old database
+    :param bool can_refresh: tells the function if it is safe to move
+                             the session to the newest generation
     :returns: ErrorInfo of the session
     :rtype: ErrorInfo
     """
 
-    if session:
-        cherrypy.log('Getting global lock: 1')
-        GLOBAL_LOCK.acquire()
-        if session.get('lock') is None:
-            session['lock'] = threading.Lock()
-        cherrypy.log('Releasing global lock: 1')
-        GLOBAL_LOCK.release()
+    theinfo = None if session is None else session.get('info')
 
-        cherrypy.log('Getting session lock')
-        session['lock'].acquire()
+    # Private ErrorInfo objects are managed by whoever made them
+    if theinfo is not None and theinfo.generation is None:
+        return theinfo
 
-        if session.get('info') is None:
-            session['info'] = ErrorInfo()
-        theinfo = session.get('info')
+    if can_refresh or theinfo is None:
+        theinfo = get_global_info()
 
-    else:
-        cherrypy.log('Getting global lock: 2')
-        GLOBAL_LOCK.acquire()
-        global GLOBAL_INFO
-        if GLOBAL_INFO is None:
-            GLOBAL_INFO = ErrorInfo()
-
-        theinfo = GLOBAL_INFO
-        cherrypy.log('Releasing global lock: 2')
-        GLOBAL_LOCK.release()
-
-    # If session ErrorInfo is old, set up another connection
-    if can_refresh and theinfo.timestamp < time.time() - \
-            60*serverconfig.config_dict()['refresh_period']:
-        theinfo.teardown()
-        theinfo.setup()
-
-    if session:
-        cherrypy.log('Releasing session lock')
-        session['lock'].release()
+        # Without the refresher thread, whoever notices old information builds a new generation
+        if can_refresh and REFRESHER is None and theinfo.timestamp < time.time() - \
+                60*serverconfig.config_dict()['refresh_period']:
+            theinfo = refresh_info(wait=False)
+
+        if session is not None:
+            session['info'] = theinfo
 
     return theinfo
 
@@ -424,53 +643,100 @@ def group_errors(input_errors, grouping_function, **kwargs):
     return output
 
 
-def get_step_table(step, session=None, allmap=None, readymatch=None,
-                   sparse=False):
-    """Gathers the errors for a step into a 2-D table of ints
+def rollup_errors(pievar, levels, session=None):
+    """
+    Gets the errors in the format of :py:func:`get_errors` and groups them into larger groups.
+    This gives the same result as passing the output of :py:func:`get_errors`
+    through :py:func:`group_errors` once for each level,
+    but every level is summed directly from the error cube,
+    and the attributes of each group are only found once.
+    For example, the steps can be grouped into workflows and then Prep IDs with::
+
+      rollup_errors('errorcode', [
+          (lambda step: step.split('/')[1], {'timestamp': get_timestamp}),
+          (get_prep_id, {})
+          ])
+
+    :param str pievar: The variable that each piechart is split into.
+    :param list levels: Tuples of ``(grouping_function, attributes)``,
+                        from the smallest groups to the largest.
+                        See :py:meth:`errorcube.ErrorCube.rollup`.
+    :param cherrypy.Session session: Stores the information for a session
+    :returns: A dictionary of the largest groups, each holding their subgroups under ``'sub'``
+    :rtype: dict
+    """
+
+    rowname, colname = get_row_col_names(pievar)
+
+    return check_session(session, True).get_cube().rollup(rowname, colname, pievar, levels)
+
+
+def index_maps(allmap):
+    """
+    :param dict allmap: A globalerrors.ErrorInfo allmap
+    :returns: Two dictionaries, mapping each error code to its row
+              and each site name to its column in a dense step table
+    :rtype: tuple
+    """
+
+    return ({code: index for index, code in enumerate(allmap['errorcode'])},
+            {site: index for index, site in enumerate(allmap['sitename'])})
+
+
+def get_step_array(step, session=None, allmap=None, readymatch=None):
+    """Gathers the errors for a step into a 2-D array of ints.
+    The rows are error codes and the columns are sites, both in the order of the allmap.
 
     :param str step: name of the step to get the table for
     :param cherrypy.Session session: Stores the information for a session
     :param dict allmap: a globalerrors.ErrorInfo allmap to override the
                         session's allmap
     :param tuple readymatch: Match the readiness statuses in this tuple, if set
-    :param bool sparse: Determines whether or not a sparse matrix is returned
-    :returns: A table (made of lists) of errors for the step or a sparse dictionary of entries
-    :rtype: list of lists or dict of dicts of ints
+    :returns: A table of errors for the step
+    :rtype: numpy.ndarray
     """
     info = check_session(session)
     if not allmap:
-        allmap = info.get_allmap()
-
-    contents = info.get_step_table(step, readymatch)
+        return info.get_cube().dense(step, readymatch)
 
-    if sparse:
-        output = defaultdict(lambda: defaultdict(lambda: 0))
+    code_index, site_index = index_maps(allmap)
 
-        for numbererrors, sitename, errorcode in contents:
-            output[str(errorcode)][sitename] = numbererrors
+    steptable = numpy.zeros((len(code_index), len(site_index)), dtype=int)
 
-        return output
+    contents = info.get_step_table(step, readymatch)
+    if contents:
+        numbererrors, sitenames, errorcodes = zip(*contents)
+        rows = numpy.array([code_index.get(code, -1) for code in errorcodes])
+        cols = numpy.array([site_index.get(site, -1) for site in sitenames])
+        keep = (rows >= 0) & (cols >= 0)
 
-    # If not sparse
+        steptable[rows[keep], cols[keep]] = numpy.array(numbererrors)[keep]
 
-    numbererrors, sitename, errorcode = contents.pop(0) if contents else (0, '', '')
-    steptable = []
+    return steptable
 
-    for error in allmap['errorcode']:
 
-        steprow = []
+def get_step_table(step, session=None, allmap=None, readymatch=None,
+                   sparse=False):
+    """Gathers the errors for a step into a 2-D table of ints
 
-        for site in allmap['sitename']:
+    :param str step: name of the step to get the table for
+    :param cherrypy.Session session: Stores the information for a session
+    :param dict allmap: a globalerrors.ErrorInfo allmap to override the
+                        session's allmap
+    :param tuple readymatch: Match the readiness statuses in this tuple, if set
+    :param bool sparse: Determines whether or not a sparse matrix is returned
+    :returns: A table (made of lists) of errors for the step or a sparse dictionary of entries
+    :rtype: list of lists or dict of dicts of ints
+    """
+    if not sparse:
+        return get_step_array(step, session, allmap, readymatch).tolist()
 
-            if error != errorcode or site != sitename:
-                steprow.append(0)
-            else:
-                steprow.append(numbererrors)
-                numbererrors, sitename, errorcode = contents.pop(0) if contents else (0, '', '')
+    output = defaultdict(lambda: defaultdict(lambda: 0))
 
-        steptable.append(steprow)
+    for errorcode, sites in check_session(session).get_cube().sparse(step, readymatch).items():
+        output[errorcode].update(sites)
 
-    return steptable
+    return output
 
 
 def see_workflow(workflow, session=None):
@@ -490,13 +756,11 @@ def see_workflow(workflow, session=None):
     skip_site = {}
 
     for step in steplist:
-        skip_site[step] = {'sites': [], 'index': []}
-        steptable = get_step_table(step, session)
-        tables.append(zip(steptable, allerrors))
-        for index, site in enumerate(allsites):
-            if sum([row[index] for row in steptable]) == 0:
-                skip_site[step]['index'].append(index)
-                skip_site[step]['sites'].append(site)
+        steptable = get_step_array(step, session)
+        tables.append(zip(steptable.tolist(), allerrors))
+
+        empty = numpy.flatnonzero(steptable.sum(axis=0) == 0).tolist()
+        skip_site[step] = {'sites': [allsites[index] for index in empty], 'index': empty}
 
     return {
         'steplist':  zip(steplist, tables),
@@ -546,19 +810,29 @@ def list_matching_pievars(pievar, row, col, session=None):
     :rtype: list
     """
 
-    curs = check_session(session, can_refresh=True)
     rowname, colname = get_row_col_names(pievar)
 
-    output = []
+    return check_session(session, can_refresh=True).get_cube().matching(
+        pievar, rowname, row, colname, col)
 
-    # Let's do this very carefully and stupid for now...
-    for name, num in  curs.execute(('SELECT {0}, numbererrors FROM workflows '
-                                    'WHERE {1}=? AND {2}=?'.
-                                    format(pievar, rowname, colname)),
-                                   (row, col)):
-        output.append((name, num))
 
-    return output
+def sum_matching_pievars(pievar, rows, col, session=None):
+    """
+    Sums the number of errors for each variable in pievar
+    over a list of rows, for a given colname
+
+    :param str pievar: The variable to return an iterator of
+    :param list rows: Names of the rows to match
+    :param str col: Name of the column to match
+    :param cherrypy.Session session: stores the session information
+    :returns: List of tuples containing name of pievar and number of errors
+    :rtype: list
+    """
+
+    rowname, colname = get_row_col_names(pievar)
+
+    return check_session(session, can_refresh=True).get_cube().matching_sums(
+        pievar, rowname, rows, colname, col)
 
 
 def get_errors(pievar, session=None):
@@ -580,15 +854,10 @@ def get_errors(pievar, session=None):
 
     rowname, colname = get_row_col_names(pievar)
 
-    query = 'SELECT numbererrors, {0}, {1}, {2} FROM workflows ' \
-        'ORDER BY {0} ASC, {1} ASC, {2} ASC;'.format(rowname, colname, pievar)
-
-    curs = check_session(session, True)
-    contents = curs.execute(query)
-
     output = default_errors_format()
 
-    for numerrors, row, col, pvar in contents:
+    for row, col, pvar, numerrors in \
+            check_session(session, True).get_cube().group(rowname, colname, pievar):
         output[row]['errors'][col][pvar] = numerrors
         output[row]['total'] += numerrors
 
@@ -0,0 +1,567 @@
+"""
+Caches shared by every :py:class:`workflowinfo.Info` object in a process.
+
+Decoded JSON from cmsweb is kept in a :py:class:`MemoryCache`
+in front of the files written by :py:func:`workflowinfo.cached_json`.
+The memory cache holds a limited number of bytes, dropping the least
+recently used entries first, and entries are also dropped after a maximum age.
+It can be tuned in ``config.yml``::
+
+  memory_cache:
+    max_mb: 256     # Size of the JSON held in memory, in megabytes
+    ttl: 3600       # Maximum age of an entry in memory, in seconds
+
+Behind the memory cache, the JSON is kept on disk by a store.
+The default :py:class:`FileStore` writes one file for each attribute of each object.
+The :py:class:`SQLiteStore` keeps everything compressed in a single database instead,
+which can be shared safely by the server, the collector, and ``wfwt-update-history``::
+
+  cache_store:
+    backend: sqlite                 # The default is 'files'
+    path: /tmp/workflowinfo.db      # The default is $TMPDIR/workflowinfo.db
+    serve_stale: true               # The default is false
+    retry: 60                       # Seconds before a failed refresh is tried again
+    refresh_threads: 4
+
+With ``serve_stale``, an entry older than its ``cache_refresh`` timeout
+is still returned right away, and the :py:class:`Revalidator` fetches
+a new value in the background.
+If that fetch fails, the old value keeps being served,
+and a new fetch is started by the first request after ``retry`` seconds.
+
+Rendered pages that are the same for every user are kept in a separate
+:py:class:`MemoryCache`, returned by :py:func:`get_page_cache`::
+
+  page_cache:
+    max_mb: 32      # Size of the pages held in memory, in megabytes
+    ttl: 60         # Maximum age of a page, in seconds
+
+:author: Daniel Abercrombie <dabercro@mit.edu>
+"""
+
+import os
+import time
+import zlib
+import shutil
+import sqlite3
+import logging
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import serverconfig
+
+
+class MemoryCache(object):
+    """
+    A least recently used cache bounded by the size of the JSON stored.
+    Keys are tuples of ``(name, attribute)``,
+    where ``name`` is the string of an :py:class:`workflowinfo.Info` object.
+    All methods are safe to call from many threads at once.
+    """
+
+    def __init__(self, max_bytes=None, ttl=None):
+        """
+        :param int max_bytes: The maximum size of the JSON stored.
+                              Defaults to ``memory_cache: max_mb`` in the configuration, or 256 MB.
+        :param int ttl: The maximum age of an entry in seconds.
+                        Defaults to ``memory_cache: ttl`` in the configuration, or one hour.
+        """
+
+        config = serverconfig.config_dict().get('memory_cache', {})
+
+        self.max_bytes = int(max_bytes if max_bytes is not None else
+                             config.get('max_mb', 256) * 1024 * 1024)
+        self.ttl = ttl if ttl is not None else config.get('ttl', 3600)
+
+        self.lock = threading.Lock()
+        # Values are tuples of (value, size, expiration time)
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remove(self, key):
+        """
+        Removes an entry. The lock must be held by the caller.
+
+        :param tuple key: The key of the entry
+        """
+
+        self.size -= self.entries.pop(key)[1]
+
+    def get(self, key):
+        """
+        :param tuple key: The key of the entry
+        :returns: The cached value, or ``None`` if missing or expired
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and entry[2] < time.time():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # Move to the back of the line for eviction
+            self.entries[key] = self.entries.pop(key)
+            self.hits += 1
+
+            return entry[0]
+
+    def set(self, key, value, size, expires=None):
+        """
+        Stores an entry, evicting the least recently used entries to make room.
+        Entries larger than the whole cache are not stored.
+
+        :param tuple key: The key of the entry
+        :param value: The decoded JSON to store
+        :param int size: The size of the JSON, in bytes
+        :param float expires: The time when the entry is no longer valid.
+                              The entry never lives longer than the ``ttl`` of the cache.
+        """
+
+        max_expires = time.time() + self.ttl
+        expires = max_expires if expires is None else min(expires, max_expires)
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, size, expires)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, name):
+        """
+        Removes all of the entries for one object.
+
+        :param str name: The first element of the keys to remove
+        :returns: The attributes that were removed
+        :rtype: list
+        """
+
+        with self.lock:
+            keys = [key for key in self.entries if key[0] == name]
+            for key in keys:
+                self._remove(key)
+
+        return [key[1] for key in keys]
+
+    def clear(self):
+        """
+        Removes every entry
+        """
+
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        :returns: The counters of the cache with the keys
+                  ``'hits'``, ``'misses'``, ``'evictions'``,
+                  ``'entries'``, ``'bytes'``, and ``'max_bytes'``
+        :rtype: dict
+        """
+
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes
+                }
+
+
+MEMORY = None
+MEMORY_LOCK = threading.Lock()
+
+
+def get_memory_cache():
+    """
+    :returns: The memory cache shared by everything in this process
+    :rtype: MemoryCache
+    """
+
+    global MEMORY # pylint: disable=global-statement
+
+    with MEMORY_LOCK:
+        if MEMORY is None:
+            MEMORY = MemoryCache()
+
+    return MEMORY
+
+
+PAGES = None
+PAGES_LOCK = threading.Lock()
+
+
+def get_page_cache():
+    """
+    The rendered pages are kept apart from the workflow information,
+    so that large pages do not push out JSON that is expensive to fetch.
+
+    :returns: The cache of rendered pages shared by everything in this process
+    :rtype: MemoryCache
+    """
+
+    global PAGES # pylint: disable=global-statement
+
+    with PAGES_LOCK:
+        if PAGES is None:
+            config = serverconfig.config_dict().get('page_cache', {})
+            PAGES = MemoryCache(config.get('max_mb', 32) * 1024 * 1024,
+                                config.get('ttl', 60))
+
+    return PAGES
+
+
+class FileStore(object):
+    """
+    Stores the JSON of each attribute of each object in a separate file.
+    The age of an entry is the modification time of its file.
+    """
+
+    def __init__(self, cache_dir=None):
+        """
+        :param str cache_dir: The directory to keep the files in.
+                              Defaults to ``$TMPDIR/workflowinfo``.
+        """
+
+        self.cache_dir = cache_dir or os.path.join(os.environ.get('TMPDIR', '/tmp'),
+                                                   'workflowinfo')
+        self.bak_dir = os.path.join(self.cache_dir, 'bak')
+
+    def filename(self, name, attribute):
+        """
+        :param str name: The string of the :py:class:`workflowinfo.Info` object
+        :param str attribute: The attribute being cached
+        :returns: The full file name to store the cache
+        :rtype: str
+        """
+
+        return os.path.join(self.cache_dir, '%s_%s.cache.json' % (name, attribute))
+
+    def load(self, name, attribute, timeout=None):
+        """
+        :param str name: The string of the :py:class:`workflowinfo.Info` object
+        :param str attribute: The attribute being cached
+        :param int timeout: The maximum age of the entry, in seconds.
+                            If ``None``, entries of any age are returned.
+        :returns: The JSON text and the time it was stored,
+                  or ``None`` if there is no valid entry
+        :rtype: tuple
+        """
+
+        file_name = self.filename(name, attribute)
+        if not os.path.exists(file_name):
+            return None
+
+        mtime = os.stat(file_name).st_mtime
+        if timeout is not None and time.time() - timeout >= mtime:
+            return None
+
+        with open(file_name, 'r') as cache_file:
+            return cache_file.read(), mtime
+
+    def save(self, name, attribute, text, timeout=None): # pylint: disable=unused-argument
+        """
+        :param str name: The string of the :py:class:`workflowinfo.Info` object
+        :param str attribute: The attribute being cached
+        :param str text: The JSON to store
+        :param int timeout: Ignored, since the age is checked when loading
+        """
+
+        if not os.path.exists(self.cache_dir):
+            os.mkdir(self.cache_dir)
+
+        with open(self.filename(name, attribute), 'w') as cache_file:
+            cache_file.write(text)
+
+    def delete(self, name, attribute):
+        """
+        Removes a single entry, for example if the JSON is corrupted.
+
+        :param str name: The string of the :py:class:`workflowinfo.Info` object
+        :param str attribute: The attribute being cached
+        """
+
+        file_name = self.filename(name, attribute)
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+    def reset(self, name, attributes):
+        """
+        Moves the files of an object into the ``bak`` directory.
+
+        :param str name: The string of the :py:class:`workflowinfo.Info` object
+        :param list attributes: The attributes to move
+        """
+
+        if not os.path.exists(self.bak_dir):
+            os.makedirs(self.bak_dir)
+
+        for attribute in attributes:
+            cache_file = self.filename(name, attribute)
+            if os.path.exists(cache_file):
+                os.rename(cache_file, cache_file.replace(self.cache_dir, self.bak_dir))
+
+    def expire(self):
+        """
+        Files are only checked when they are read, so this does nothing.
+        """
+
+    def clear(self):
+        """
+        Removes every file
+        """
+
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.mkdir(self.cache_dir)
+
+
+class SQLiteStore(object):
+    """
+    Stores compressed JSON in a single SQLite database,
+    keyed by the kind of object, its name, and the attribute.
+    The database uses write-ahead logging so that many processes
+    can read while one writes.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param str path: The location of the database.
+                         Defaults to ``$TMPDIR/workflowinfo.db``.
+        """
+
+        self.path = path or os.path.join(os.environ.get('TMPDIR', '/tmp'), 'workflowinfo.db')
+        # Connections cannot be shared between threads
+        self.local = threading.local()
+
+        self._connection().executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS cache (
+              kind TEXT, name TEXT, attribute TEXT,
+              updated REAL, expires REAL, payload BLOB,
+              PRIMARY KEY (kind, name, attribute));
+            CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires);
+            """)
+
+    def _connection(self):
+        """
+        :returns: The connection to the database for this thread
+        :rtype: sqlite3.Connection
+        """
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self.local.conn = conn
+
+        return conn
+
+    @staticmethod
+    def _key(name, attribute):
+        """
+        :param str name: The string of the :py:class:`workflowinfo.Info` object,
+                         which is ``<kind>_<name>``, or just ``<kind>``
+        :param str attribute: The attribute being cached
+        :returns: The primary key of the entry
+        :rtype: tuple
+        """
+
+        kind, _, name = name.partition('_')
+        return kind, name, attribute
+
+    def load(self, name, attribute, timeout=None):
+        """
+        See :py:meth:`FileStore.load`
+        """
+
+        row = self._connection().execute(
+            'SELECT updated, payload FROM cache WHERE kind=? AND name=? AND attribute=?',
+            self._key(name, attribute)).fetchone()
+
+        if row is None or (timeout is not None and time.time() - timeout >= row[0]):
+            return None
+
+        return zlib.decompress(row[1]).decode('utf-8'), row[0]
+
+    def save(self, name, attribute, text, timeout=None):
+        """
+        :param str name: The string of the :py:class:`workflowinfo.Info` object
+        :param str attribute: The attribute being cached
+        :param str text: The JSON to store
+        :param int timeout: The lifetime of the entry, used by :py:meth:`expire`.
+                            If ``None``, the entry never expires.
+        """
+
+        now = time.time()
+        self._connection().execute(
+            'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)',
+            self._key(name, attribute) + (
+                now, timeout and now + timeout,
+                sqlite3.Binary(zlib.compress(text.encode('utf-8'))))
+            )
+
+    def delete(self, name, attribute):
+        """
+        See :py:meth:`FileStore.delete`
+        """
+
+        self._connection().execute(
+            'DELETE FROM cache WHERE kind=? AND name=? AND attribute=?',
+            self._key(name, attribute))
+
+    def reset(self, name, attributes=None):
+        """
+        Removes every entry of an object.
+
+        :param str name: The string of the :py:class:`workflowinfo.Info` object
+        :param list attributes: Ignored, since all attributes are removed
+        """
+
+        self._connection().execute(
+            'DELETE FROM cache WHERE kind=? AND name=?', self._key(name, '')[:2])
+
+    def expire(self):
+        """
+        Removes every entry that has expired.
+
+        :returns: The number of entries removed
+        :rtype: int
+        """
+
+        return self._connection().execute(
+            'DELETE FROM cache WHERE expires < ?', (time.time(),)).rowcount
+
+    def clear(self):
+        """
+        Removes every entry
+        """
+
+        self._connection().execute('DELETE FROM cache')
+
+
+STORE = None
+STORE_LOCK = threading.Lock()
+
+
+def get_store():
+    """
+    Opens the store selected by ``cache_store: backend`` in the configuration.
+    Expired entries are removed when it is first opened,
+    unless ``cache_store: serve_stale`` is set,
+    since those entries are still served while they are refreshed.
+
+    :returns: The store shared by everything in this process
+    :rtype: FileStore or SQLiteStore
+    """
+
+    global STORE # pylint: disable=global-statement
+
+    with STORE_LOCK:
+        if STORE is None:
+            config = serverconfig.config_dict().get('cache_store', {})
+            if config.get('backend', 'files') == 'sqlite':
+                STORE = SQLiteStore(config.get('path'))
+            else:
+                STORE = FileStore()
+
+            if not config.get('serve_stale', False):
+                STORE.expire()
+
+    return STORE
+
+
+class Revalidator(object):
+    """
+    Runs refreshes of stale cache entries in a small thread pool.
+    Only one refresh of a given key is run at a time.
+    """
+
+    def __init__(self, threads=None):
+        """
+        :param int threads: The number of refreshes to run at once.
+                            Defaults to ``cache_store: refresh_threads``
+                            in the configuration, or 4.
+        """
+
+        config = serverconfig.config_dict().get('cache_store', {})
+
+        self.pool = ThreadPoolExecutor(
+            max_workers=int(threads or config.get('refresh_threads', 4)))
+        self.lock = threading.Lock()
+        self.inflight = set()
+
+    def schedule(self, key, func, *args):
+        """
+        Runs a refresh in the background, unless one for the same key is running.
+
+        :param tuple key: The key of the cache entry
+        :param func func: The function that refreshes the entry
+        :param args: Arguments to pass to the function
+        :returns: ``True`` if a new refresh was started
+        :rtype: bool
+        """
+
+        with self.lock:
+            if key in self.inflight:
+                return False
+            self.inflight.add(key)
+
+        self.pool.submit(self._run, key, func, *args)
+        return True
+
+    def _run(self, key, func, *args):
+        """
+        Runs a refresh, logging instead of raising any failure.
+
+        :param tuple key: The key of the cache entry
+        :param func func: The function that refreshes the entry
+        :param args: Arguments to pass to the function
+        """
+
+        try:
+            func(*args)
+        except Exception: # pylint: disable=broad-except
+            logging.exception('Failed to refresh %s %s, keeping the old value', *key)
+        finally:
+            with self.lock:
+                self.inflight.discard(key)
+
+
+REVALIDATOR = None
+REVALIDATOR_LOCK = threading.Lock()
+
+
+def get_revalidator():
+    """
+    :returns: The revalidator shared by everything in this process
+    :rtype: Revalidator
+    """
+
+    global REVALIDATOR # pylint: disable=global-statement
+
+    with REVALIDATOR_LOCK:
+        if REVALIDATOR is None:
+            REVALIDATOR = Revalidator()
+
+    return REVALIDATOR
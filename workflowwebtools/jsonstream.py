@@ -0,0 +1,192 @@
+"""
+Reads large JSON documents one piece at a time.
+
+Files like ``all_errors.json`` and ``statuses.json`` hold one large object.
+Instead of loading the whole document with :py:func:`json.load`,
+:py:func:`iter_items` decodes one member of an object (or one element of an array)
+at a time, so only a single member is ever held in memory.
+Members deeper in the document can be reached by giving a path of keys and indices.
+
+:author: Daniel Abercrombie <dabercro@mit.edu>
+"""
+
+import json
+
+
+class _Reader(object):
+    """
+    Holds a buffer of text read from a file and a position inside it.
+    The buffer is filled as needed, reading larger pieces if a single
+    value does not fit.
+    """
+
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, json_file, chunk_size):
+        """
+        :param file json_file: The file to read from
+        :param int chunk_size: The number of characters to read at once
+        """
+
+        self.file = json_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        """
+        Reads more from the file, dropping the part of the buffer already used.
+
+        :param int size: The number of characters to read
+        :returns: If anything was read
+        :rtype: bool
+        """
+
+        if self.eof:
+            return False
+
+        text = self.file.read(size)
+        if not text:
+            self.eof = True
+            return False
+
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        :returns: The next character that is not whitespace, without consuming it,
+                  or an empty string at the end of the file
+        :rtype: str
+        """
+
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in self.WHITESPACE:
+                self.pos += 1
+
+            if self.pos < len(self.buf) or not self._fill(self.chunk_size):
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        """
+        Consumes the next character that is not whitespace.
+
+        :param str chars: The characters that are allowed
+        :returns: The character that was consumed
+        :rtype: str
+        :raises ValueError: if the next character is not one of ``chars``
+        """
+
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expected one of %s at "%s"' %
+                             (chars, self.buf[self.pos:self.pos + 20]))
+
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        Decodes the next value.
+
+        :returns: The decoded JSON value
+        :raises ValueError: if the document ends before the value does
+        """
+
+        self.peek()
+        size = self.chunk_size
+
+        while True:
+            try:
+                output, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number could continue in the part of the file not read yet
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return output
+            except ValueError:
+                if self.eof:
+                    raise
+
+            self._fill(size)
+            size *= 2
+
+
+def _members(reader):
+    """
+    Iterates over the members of the object or array that is next in a reader.
+    The caller must consume each value before asking for the next member.
+
+    :param _Reader reader: The reader, positioned before a ``{`` or ``[``
+    :returns: Generator of keys (for objects) or indices (for arrays)
+    :rtype: generator
+    """
+
+    opening = reader.expect('{[')
+    closing = '}' if opening == '{' else ']'
+
+    if reader.peek() == closing:
+        reader.expect(closing)
+        return
+
+    index = 0
+    while True:
+        if opening == '{':
+            key = reader.value()
+            reader.expect(':')
+        else:
+            key = index
+            index += 1
+
+        yield key
+
+        if reader.expect(',' + closing) == closing:
+            return
+
+
+def _at_container(reader):
+    """
+    :param _Reader reader: The reader to check
+    :returns: If the next value in the reader is an object or array
+    :rtype: bool
+    """
+
+    char = reader.peek()
+    return bool(char) and char in '{['
+
+
+def iter_items(json_file, path=(), chunk_size=65536):
+    """
+    Yields the members of an object or array inside of a JSON document.
+
+    :param file json_file: The file containing the document
+    :param tuple path: The keys (for objects) and indices (for arrays)
+                       to follow to reach the object to iterate over.
+                       If empty, the whole document is iterated over.
+    :param int chunk_size: The number of characters to read from the file at once
+    :returns: Generator of tuples of (key, value) for objects or (index, value) for arrays.
+              Nothing is yielded if the path does not exist.
+    :rtype: generator
+    :raises ValueError: if the document is not valid JSON
+    """
+
+    reader = _Reader(json_file, chunk_size)
+
+    for step in path:
+        if not _at_container(reader):
+            return
+
+        for key in _members(reader):
+            if key == step:
+                break
+            reader.value()
+        else:
+            return
+
+    if not _at_container(reader):
+        return
+
+    for key in _members(reader):
+        yield key, reader.value()
@@ -0,0 +1,86 @@
+"""
+Locks for each of many keys, such as workflow names.
+
+Pages for different workflows can then be made at the same time,
+while two requests for the same workflow still wait for each other.
+
+:author: Daniel Abercrombie <dabercro@mit.edu>
+"""
+
+import threading
+import contextlib
+
+
+class KeyedLocks(object):
+    """
+    Holds a lock for each key that is in use.
+    A key's lock is removed once no thread holds it or waits for it,
+    so the number of locks does not grow with the number of keys ever used.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Values are lists of [lock, number of threads holding or waiting for it]
+        self.locks = {}
+
+    def _checkout(self, key):
+        """
+        :param key: The key to get the lock for
+        :returns: The lock for the key, counting this thread as a user
+        :rtype: threading.Lock
+        """
+
+        with self.lock:
+            entry = self.locks.get(key)
+            if entry is None:
+                entry = self.locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+
+            return entry[0]
+
+    def _checkin(self, key):
+        """
+        Stops counting this thread as a user of the lock for a key.
+
+        :param key: The key that was checked out
+        """
+
+        with self.lock:
+            entry = self.locks[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+    @contextlib.contextmanager
+    def hold(self, *keys):
+        """
+        Holds the locks for all of the keys until the context is left.
+        The locks are always taken in sorted order,
+        so two threads holding overlapping sets of keys cannot deadlock.
+
+        :param keys: The keys to lock
+        """
+
+        held = []
+
+        try:
+            for key in sorted(set(keys)):
+                lock = self._checkout(key)
+                held.append((key, lock))
+                lock.acquire()
+
+            yield
+
+        finally:
+            for key, lock in reversed(held):
+                lock.release()
+                self._checkin(key)
+
+    def in_use(self):
+        """
+        :returns: The number of keys with a thread holding or waiting for their lock
+        :rtype: int
+        """
+
+        with self.lock:
+            return len(self.locks)
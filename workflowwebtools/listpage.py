@@ -6,6 +6,7 @@ This module provides lists of errors per pie variable
 
 
 from .globalerrors import list_matching_pievars
+from .globalerrors import sum_matching_pievars
 from .globalerrors import check_session
 
 
@@ -30,33 +31,31 @@ def listworkflows(error_code, site_name, workflow, session=None):
             output_dict[wkf] = output_dict.get(wkf, 0) + numerrors
 
     else:
+        if not error_code:
+            pievar = 'errorcode'
+            col = site_name
+        elif not site_name:
+            pievar = 'sitename'
+            col = error_code
+        else:
+            return []
+
         # Click on step piechart
         if len(workflow.split('/')) > 1:
-
-            if not error_code:
-                pievar = 'errorcode'
-                col = site_name
-            elif not site_name:
-                pievar = 'sitename'
-                col = error_code
-            else:
-                return []
-
-            for key, numerrors in list_matching_pievars(pievar, workflow, col, session):
-                output_dict[key] = output_dict.get(key, 0) + numerrors
+            steps = [workflow]
 
         else:
             # Click on workflow (not step)
             info = check_session(session)
             if workflow in info.return_workflows():
-                nextlist = info.get_step_list(workflow)
+                workflows = [workflow]
             # Otherwise, is hopefully a PrepID
             else:
-                nextlist = info.get_prepid(workflow).get_workflows()
+                workflows = info.get_prepid(workflow).get_workflows()
 
-            for step in nextlist:
-                for key, numerrors in listworkflows(error_code, site_name, step, session):
-                    output_dict[key] = output_dict.get(key, 0) + numerrors
+            steps = [step for wkf in workflows for step in info.get_step_list(wkf)]
 
+        # All of the steps are summed in one pass
+        output_dict.update(sum_matching_pievars(pievar, steps, col, session))
 
     return sorted(output_dict.items(), key=lambda x: x[1], reverse=True)
@@ -10,6 +10,8 @@ from __future__ import print_function
 import time
 import datetime
 import ssl
+import functools
+import threading
 
 import cherrypy
 import pymongo
@@ -18,6 +20,45 @@ from . import serverconfig
 from . import reasonsmanip
 from .globalerrors import check_session
 
+
+ACTIONS_VERSION = 0
+ACTIONS_LOCK = threading.Lock()
+
+
+def actions_version():
+    """
+    :returns: A number that changes every time this process writes to the actions collection.
+              Pages showing acted workflows, and :py:func:`get_action_records`,
+              can be cached until it changes.
+    :rtype: int
+    """
+
+    return ACTIONS_VERSION
+
+
+def changes_actions(func):
+    """
+    A decorator for functions that write to the actions collection.
+    The :py:func:`actions_version` is changed after the function is done,
+    even if it fails part of the way through.
+
+    :param function func: The function that writes actions
+    :returns: The wrapped function
+    :rtype: function
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            global ACTIONS_VERSION, STATUSES # pylint: disable=global-statement
+            with ACTIONS_LOCK:
+                ACTIONS_VERSION += 1
+                STATUSES = None
+
+    return wrapper
+
 def extract_reasons_params(action, **kwargs):
     """Extracts the reasons and parameters for an action from kwargs
 
@@ -84,6 +125,7 @@ def extract_reasons_params(action, **kwargs):
     return reasons + notupdate, params
 
 
+@changes_actions
 def submitaction(user, workflows, action, session=None, **kwargs):
     """Writes the action to Unified and notifies the user that this happened
 
@@ -185,6 +227,7 @@ def submitaction(user, workflows, action, session=None, **kwargs):
 def get_workflowid(workflow):
     return workflow.replace('-', '_')
 
+@changes_actions
 def submit2(user, documents): # pylint: disable=missing-docstring
     coll,session = get_actions_collection(True)
 
@@ -299,9 +342,13 @@ def get_acted_workflows(num_days):
     :rtype: list
     """
 
-    return list(get_actions(num_days, acted=None))
+    age_to_compare = int(time.time()) - num_days * 24 * 3600 if num_days > 0 else 0
+
+    return [workflow for workflow, record in get_action_records().items()
+            if record.get('timestamp', 0) > age_to_compare]
 
 
+@changes_actions
 def report_actions(workflows, output=None):
     """Mark actions as acted on
 
@@ -326,6 +373,63 @@ def report_actions(workflows, output=None):
                      {'$set': {'acted': 1}})
 
 
+CLIENT = None
+"""Tuple of the settings used to make the shared MongoClient, and the client"""
+CLIENT_LOCK = threading.Lock()
+INDEXED = set()
+"""The URIs and names of the databases that have had their indexes checked by this process"""
+
+STATUSES = None
+"""Tuple of the actions version, expiration time, and records from :py:func:`get_action_records`"""
+
+
+def get_client():
+    """
+    The client is made once and shared by every thread of the process.
+    The size of its connection pool is set by ``actions: pool_size`` in the configuration.
+
+    :returns: the client connected to the actions database
+    :rtype: pymongo.MongoClient
+    """
+
+    global CLIENT # pylint: disable=global-statement
+
+    config_dict = serverconfig.config_dict()['actions']
+    settings = (config_dict.get('uri'), config_dict.get('pool_size', 100))
+
+    with CLIENT_LOCK:
+        if CLIENT is None or CLIENT[0] != settings:
+            uri, pool_size = settings
+            if uri:
+                client = pymongo.MongoClient(uri, ssl_cert_reqs=ssl.CERT_NONE,
+                                             maxPoolSize=pool_size)
+            else:
+                client = pymongo.MongoClient(maxPoolSize=pool_size)
+
+            # Stop the connections and monitor threads of the client being replaced
+            if CLIENT is not None:
+                CLIENT[1].close()
+
+            CLIENT = (settings, client)
+
+        return CLIENT[1]
+
+
+def ensure_indexes(coll):
+    """Creates the indexes of the actions collection.
+    This is done once per database by :py:func:`get_actions_collection`.
+
+    :param pymongo.collection.Collection coll: the actions collection
+    """
+
+    if coll.estimated_document_count() == 0 or 'workflowid' not in list(coll.index_information()):
+        coll.create_index([('workflowid', pymongo.TEXT)],
+                          name='workflowid', unique=True)
+
+    coll.create_index([('workflow', pymongo.ASCENDING)], name='workflow')
+    coll.create_index([('timestamp', pymongo.ASCENDING)], name='timestamp')
+
+
 def get_actions_collection(returnsession=False):
     """Gets the actions collection from MongoDB.
 
@@ -333,18 +437,19 @@ def get_actions_collection(returnsession=False):
     :rtype: pymongo.collection.Collection
     """
 
+    client = get_client()
     config_dict = serverconfig.config_dict()['actions']
-    uri = config_dict.get('uri')
-    if uri:
-        client = pymongo.MongoClient(uri, ssl_cert_reqs=ssl.CERT_NONE)
-    else:
-        client = pymongo.MongoClient()
+    database = config_dict['database']
 
-    coll = client[config_dict['database']].actions
+    coll = client[database].actions
 
-    if coll.count() == 0 or 'workflowid' not in list(coll.index_information()):
-        coll.create_index([('workflowid', pymongo.TEXT)],
-                          name='workflowid', unique=True)
+    # The same database name can be on different servers
+    indexed = (config_dict.get('uri'), database)
+    if indexed not in INDEXED:
+        with CLIENT_LOCK:
+            if indexed not in INDEXED:
+                ensure_indexes(coll)
+                INDEXED.add(indexed)
 
     if returnsession:
         return coll, client.start_session()
@@ -352,6 +457,46 @@ def get_actions_collection(returnsession=False):
         return coll
 
 
+def get_action_records():
+    """Gets the acted flag and the timestamp of every workflow with an action.
+    The records are kept until anything is written to the actions by this process,
+    or until ``actions: status_ttl`` seconds (default 60) pass,
+    to pick up changes made by other processes.
+
+    :returns: Dictionary of workflow names pointing to
+              dictionaries with the keys ``'acted'`` and ``'timestamp'``
+    :rtype: dict
+    """
+
+    global STATUSES # pylint: disable=global-statement
+
+    version = actions_version()
+    statuses = STATUSES
+
+    if statuses is None or statuses[0] != version or statuses[1] < time.time():
+        expires = time.time() + serverconfig.config_dict()['actions'].get('status_ttl', 60)
+
+        records = {}
+        for record in get_actions_collection().find(
+                {}, {'workflow': 1, 'acted': 1, 'timestamp': 1, '_id': 0}):
+            if 'workflow' in record:
+                records[record['workflow']] = record
+
+        statuses = (version, expires, records)
+        STATUSES = statuses
+
+    return statuses[2]
+
+
+def get_statuses():
+    """
+    :returns: Dictionary of workflows pointing to their acted flag
+    :rtype: dict
+    """
+
+    return {workflow: record.get('acted') for workflow, record in get_action_records().items()}
+
+
 def fix_sites(**kwargs):
     """Fix the site lists for tasks that had zero sites.
 
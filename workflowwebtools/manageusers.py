@@ -1,6 +1,26 @@
 """
 Module to manage users of WorkflowWebTools.
 
+Hashing a password with :py:func:`do_salt_hash` takes a long time on purpose.
+So that every request to a protected page does not pay for it,
+successful logins are remembered in memory for a short time.
+Only a keyed HMAC of the username and password is kept,
+using a key made randomly when the process starts.
+The hashing itself is done by a pool of processes,
+so that it does not hold up the threads serving other pages.
+The pool starts its processes fresh instead of forking the threaded server,
+and they should be started with :py:func:`start_hash_pool` before the server starts.
+Only a limited number of hashes can be running or waiting in the pool.
+A login beyond that waits for a place, and is turned away
+with a ``503`` error if none frees up within the timeout.
+These can be set in ``config.yml``::
+
+  users:
+    login_ttl: 300      # Seconds, 0 turns the cache off
+    hash_processes: 2   # 0 hashes in the server threads instead
+    hash_queue: 8       # Maximum number of hashes running or waiting in the pool
+    hash_timeout: 60    # Seconds to wait for a place in the pool and the hash
+
 :author: Daniel Abercrombie <dabercro@mit.edu>
 """
 
@@ -10,6 +30,14 @@ import uuid
 import urllib
 import re
 import os
+import time
+import hmac
+import hashlib
+import threading
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
 
 import cherrypy
 
@@ -18,27 +46,232 @@ from cmstoolbox.emailtools import send_email
 
 from . import serverconfig
 
+USERS_DB = threading.local()
+"""Holds the connections of each thread to each users database"""
+SCHEMA_VERSION = 1
+"""The version of the users table, stored in the database's user_version"""
+
+
+def migrate_user_db(curs):
+    """Brings the users database up to the current :py:data:`SCHEMA_VERSION`.
+    Databases that are already up to date are left alone.
+
+    :param sqlite3.Cursor curs: A cursor to the users database
+    """
+
+    curs.execute('PRAGMA user_version')
+    if curs.fetchone()[0] >= SCHEMA_VERSION:
+        return
+
+    # Note that the only un-encrypted value will be the username
+    # Email is kept (but hashed and salted) for password reset of a user
+    # The UNIQUE constraint on email also indexes it
+    curs.executescript(
+        """
+        BEGIN;
+        CREATE TABLE IF NOT EXISTS users (username varchar(31) PRIMARY KEY,
+          email varchar(255) UNIQUE, password varchar(255),
+          validator varchar(255), isvalid integer);
+        CREATE INDEX IF NOT EXISTS users_validator ON users (validator);
+        PRAGMA user_version = %i;
+        COMMIT;
+        """ % SCHEMA_VERSION)
+
+
 def get_user_db():
     """Gets the users database in the local directory.
+    Each thread keeps its connection open, so the connection should not be closed.
 
     :returns: the users connection, cursor
     :rtype: sqlite3.Connection, sqlite3.Cursor
     """
 
-    conn = sqlite3.connect(os.path.join(
-        serverconfig.config_dict()['workspace'],
-        'users.db'))
-    curs = conn.cursor()
-    curs.execute('SELECT name FROM sqlite_master WHERE type="table" and name="users"')
+    path = os.path.abspath(os.path.join(serverconfig.config_dict()['workspace'], 'users.db'))
+
+    if not hasattr(USERS_DB, 'conns'):
+        USERS_DB.conns = {}
+
+    conn = USERS_DB.conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=60)
+        migrate_user_db(conn.cursor())
+        USERS_DB.conns[path] = conn
+
+    return conn, conn.cursor()
 
-    if not curs.fetchone():
-        # Note that the only un-encrypted value will be the username
-        # Email is kept (but hashed and salted) for password reset of a user
-        curs.execute('CREATE TABLE users (username varchar(31) PRIMARY KEY, '
-                     'email varchar(255) UNIQUE, password varchar(255), '
-                     'validator varchar(255), isvalid integer)')
 
-    return conn, curs
+SALTS = {}
+"""The salts read from each salt file, so that each file is only read once"""
+
+LOGINS = {}
+"""Maps usernames to tuples of the HMAC of their last good login and its expiration time"""
+LOGINS_LOCK = threading.Lock()
+LOGINS_KEY = os.urandom(32)
+
+
+def get_salts(salt_file='keys/salt.txt'):
+    """
+    :param str salt_file: The file holding one salt per line
+    :returns: The list of salts
+    :rtype: list
+    """
+
+    salts = SALTS.get(salt_file)
+
+    if salts is None:
+        with open(salt_file, 'r') as salts_input:
+            salts = [line.strip() for line in salts_input.readlines()]
+
+        SALTS[salt_file] = salts
+
+    return salts
+
+
+def _login_mac(username, password):
+    """
+    :param str username: The attempted username
+    :param str password: The attempted password
+    :returns: The keyed HMAC of the username and password
+    :rtype: bytes
+    """
+
+    return hmac.new(LOGINS_KEY, ('%s\0%s' % (username, password)).encode('utf-8'),
+                    hashlib.sha256).digest()
+
+
+def remember_login(username, password):
+    """Remembers a good login for the ``users: login_ttl`` in the configuration.
+
+    :param str username: The username that logged in
+    :param str password: The password that was used
+    """
+
+    ttl = serverconfig.config_dict().get('users', {}).get('login_ttl', 300)
+
+    if ttl > 0:
+        with LOGINS_LOCK:
+            LOGINS[username] = (_login_mac(username, password), time.time() + ttl)
+
+
+def is_remembered(username, password):
+    """
+    :param str username: The attempted username
+    :param str password: The attempted password
+    :returns: If the same username and password logged in recently
+    :rtype: bool
+    """
+
+    login = LOGINS.get(username)
+
+    return login is not None and login[1] > time.time() and \
+        hmac.compare_digest(login[0], _login_mac(username, password))
+
+
+def forget_login(username):
+    """Makes the next login of a user check the password database again.
+    This must be called whenever a password or account changes.
+
+    :param str username: The user to forget
+    """
+
+    with LOGINS_LOCK:
+        LOGINS.pop(username, None)
+
+
+HASH_POOL = None
+"""Tuple of the pool of processes used by :py:func:`salt_hash`, and the slots of its queue"""
+HASH_LOCK = threading.Lock()
+
+
+def get_hash_pool():
+    """
+    :returns: The pool of processes for hashing, and a semaphore
+              limiting the number of hashes running or waiting.
+              The pool is ``None`` if ``users: hash_processes`` is 0.
+    :rtype: tuple
+    """
+
+    global HASH_POOL # pylint: disable=global-statement
+
+    with HASH_LOCK:
+        if HASH_POOL is None:
+            config = serverconfig.config_dict().get('users', {})
+            processes = config.get('hash_processes', 2)
+            # Forking a server with running threads could copy locks that are held
+            pool = ProcessPoolExecutor(
+                processes, mp_context=multiprocessing.get_context('spawn')) \
+                if processes > 0 else None
+            HASH_POOL = (pool, threading.BoundedSemaphore(config.get('hash_queue', 8)))
+
+    return HASH_POOL
+
+
+def start_hash_pool():
+    """
+    Makes the pool of processes for hashing and starts all of its processes.
+    The pool would otherwise only start a process when a hash is submitted,
+    so the first logins would wait for the new processes to import everything.
+    """
+
+    pool, _ = get_hash_pool()
+
+    if pool is not None:
+        processes = serverconfig.config_dict().get('users', {}).get('hash_processes', 2)
+        # The pool only starts another process while the ones it has are busy
+        for future in [pool.submit(time.sleep, 0.1) for _ in range(processes)]:
+            future.result()
+
+
+def _run_in_hash_pool(func, *args):
+    """Runs a function in the pool of processes and waits for the result.
+
+    :param func func: The function to run, which must be importable by the new processes
+    :param args: The arguments to pass to the function
+    :returns: The output of the function
+    :raises cherrypy.HTTPError: with status 503 if there is no place in the pool
+                                or the result is not ready within ``users: hash_timeout``
+    """
+
+    pool, slots = get_hash_pool()
+    deadline = time.time() + \
+        serverconfig.config_dict().get('users', {}).get('hash_timeout', 60)
+
+    if not slots.acquire(timeout=max(deadline - time.time(), 0)):
+        raise cherrypy.HTTPError(503, 'Too many logins at once, please try again')
+
+    if pool is None:
+        try:
+            return func(*args)
+        finally:
+            slots.release()
+
+    try:
+        future = pool.submit(func, *args)
+    except Exception:
+        slots.release()
+        raise
+
+    # The place is only free once the process is done, even after a timeout
+    future.add_done_callback(lambda _: slots.release())
+
+    try:
+        return future.result(max(deadline - time.time(), 0))
+    except FutureTimeout:
+        future.cancel()
+        raise cherrypy.HTTPError(503, 'Password check took too long, please try again')
+
+
+def salt_hash(to_hash):
+    """Runs :py:func:`do_salt_hash` in the pool of processes and waits for the result.
+
+    :param str to_hash: Alternate salt and hashing to get stored variable
+    :returns: A salty hash
+    :rtype: str
+    :raises cherrypy.HTTPError: with status 503 if the pool stays full
+                                or the hash takes longer than ``users: hash_timeout``
+    """
+
+    return _run_in_hash_pool(do_salt_hash, to_hash)
 
 
 def validate_password(_, username, password):
@@ -57,18 +290,25 @@ def validate_password(_, username, password):
     # confirmation because people are likely to have the same
     # 'password'
 
+    if is_remembered(username, password):
+        return True
+
     conn, curs = get_user_db()
 
     curs.execute('SELECT password, isvalid FROM users WHERE username=?',
                  (username,))
 
     passwords = list(curs.fetchall())
-    conn.close()
 
     if len(passwords) != 1:
         return False
 
-    return do_salt_hash(password) == passwords[0][0] and bool(passwords[0][1])
+    valid = salt_hash(password) == passwords[0][0] and bool(passwords[0][1])
+
+    if valid:
+        remember_login(username, password)
+
+    return valid
 
 
 def confirmation(code, lookup='validator', return_curs=False):
@@ -76,22 +316,24 @@ def confirmation(code, lookup='validator', return_curs=False):
 
     :param str code: the confirmation code for the user
     :param str lookup: The field to look up the username with
-    :param bool return_curs: If false, closes the connection
+    :param bool return_curs: If true, also returns the connection and cursor used
     :returns: the user name if valid code, or '' if not.
               Followed by conn, curs if return_curs is True
     :rtype: str [, sqlite3.Connection, sqlite3.Cursor]
+    :raises ValueError: if lookup is not 'validator' or 'email'
     """
 
+    if lookup not in ['validator', 'email']:
+        raise ValueError('Cannot look up users by %s' % lookup)
+
     conn, curs = get_user_db()
 
     if lookup == 'email':
         value = code
     else:
-        value = do_salt_hash(code)
+        value = salt_hash(code)
 
-    # Note that the sqlite ? doesn't seem to work for these hashes for some reason
-    curs.execute('SELECT username FROM users WHERE {0}=\'{1}\''.\
-                     format(lookup, value))
+    curs.execute('SELECT username FROM users WHERE {0}=?'.format(lookup), (value,))
 
     users = list(curs.fetchall())
 
@@ -109,7 +351,6 @@ def confirmation(code, lookup='validator', return_curs=False):
     if return_curs:
         return user, conn, curs
 
-    conn.close()
     return user
 
 
@@ -128,7 +369,7 @@ def send_reset_email(email, url):
         cherrypy.log('User is %s. Generating email.' % user)
 
         validation_string = uuid.uuid4().hex
-        stored_string = do_salt_hash(str(validation_string))
+        stored_string = salt_hash(str(validation_string))
 
         confirm_link = (url + '/confirmuser?' +
                         urllib.parse.urlencode({'code': str(validation_string)}))
@@ -158,8 +399,7 @@ def send_reset_email(email, url):
         curs.execute('UPDATE users SET validator=?, isvalid=? WHERE username=?',
                      (stored_string, 0, user))
         conn.commit()
-
-    conn.close()
+        forget_login(user)
 
 
 def resetpassword(code, password):
@@ -175,10 +415,10 @@ def resetpassword(code, password):
 
     if user:
         curs.execute('UPDATE users SET password=? WHERE username=?',
-                     (do_salt_hash(password), user))
+                     (salt_hash(password), user))
         conn.commit()
+        forget_login(user)
 
-    conn.close()
     return user
 
 
@@ -213,17 +453,17 @@ def add_user(email, username, password, url):
     if not (good_email and re.match(r'^[A-za-z0-9]+$', username)) or password == '':
         return 1
 
-    password = do_salt_hash(password)
+    password = salt_hash(password)
 
     validation_string = uuid.uuid4().hex
-    stored_string = do_salt_hash(str(validation_string))
+    stored_string = salt_hash(str(validation_string))
 
     confirm_link = (url + '/confirmuser?' +
                     urllib.parse.urlencode({'code': str(validation_string)}))
 
     wm_email = serverconfig.config_dict()['webmaster']['email']
 
-    store_email = do_salt_hash(email)
+    store_email = salt_hash(email)
 
     conn, curs = get_user_db()
 
@@ -231,10 +471,10 @@ def add_user(email, username, password, url):
         curs.execute('INSERT INTO users VALUES (?,?,?,?,?)',
                      (username, store_email, password, stored_string, 0))
     except sqlite3.IntegrityError:
+        conn.rollback()
         return 1
 
     conn.commit()
-    conn.close()
 
     message_text = (
         'Hello ' + username +',\n\n'
@@ -265,9 +505,7 @@ def do_salt_hash(to_hash):
     # https://bugs.python.org/issue27742
     randint_compat = lambda lo, hi: lo + int(random.random() * (hi + 1 - lo))
 
-    with open('keys/salt.txt', 'r') as salt_file:
-        salts = [line.strip() for line in salt_file.readlines()]
-
+    salts = get_salts()
     salt_len = len(salts)
 
     for _ in range(randint_compat(10, 30)):
@@ -1,16 +1,35 @@
 """Module for manipulating the database that stores past operator reasons.
 
+The reasons are read in one query and kept in memory.
+They are read again after :py:func:`update_reasons`,
+or if the database file is changed by another process.
+
 :author: Daniel Abercrombie <dabercro@mit.edu>
 """
 
 import os
 import sqlite3
+import threading
+
 import cherrypy
 
 from . import serverconfig
 
 DEFAULT_SHORT = '---- No Short Reason Given, Not Saved to Database! ----'
 
+REASONS = None
+"""Tuple of the stat of the database file and the reasons read from it"""
+REASONS_LOCK = threading.Lock()
+
+
+def reasons_path():
+    """
+    :returns: the location of the reasons database
+    :rtype: str
+    """
+
+    return os.path.join(serverconfig.config_dict()['workspace'], 'reasons.db')
+
 
 def get_reasons():
     """Gets the reasons database in the local directory.
@@ -19,7 +38,7 @@ def get_reasons():
     :rtype: (sqlite3.Connection, sqlite3.Cursor)
     """
 
-    conn = sqlite3.connect(os.path.join(serverconfig.config_dict()['workspace'], 'reasons.db'))
+    conn = sqlite3.connect(reasons_path())
     curs = conn.cursor()
     curs.execute('SELECT name FROM sqlite_master WHERE type="table" and name="reasons"')
 
@@ -40,23 +59,27 @@ def update_reasons(reasons):
     :raises KeyError: if the dictionaries in the list do not have the correct structure
     """
 
-    conn, curs = get_reasons()
+    global REASONS # pylint: disable=global-statement
 
     if not isinstance(reasons, list):
         raise TypeError('reasons is not a list')
 
     try:
-        for reason in reasons:
-            if reason['short'] == DEFAULT_SHORT:
-                continue
-            curs.execute('SELECT shortreason FROM reasons WHERE shortreason=?', (reason['short'],))
-            if not curs.fetchone():
-                curs.execute('INSERT INTO reasons VALUES (?,?)', (reason['short'], reason['long'],))
-        conn.commit()
+        rows = [(reason['short'], reason['long']) for reason in reasons
+                if reason['short'] != DEFAULT_SHORT]
     except KeyError:
         cherrypy.log('Parameter does not have correct keys.')
         raise
 
+    conn, _ = get_reasons()
+
+    with REASONS_LOCK:
+        # Existing short reasons keep their original long reason
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO reasons VALUES (?,?)', rows)
+
+        REASONS = None
+
     conn.close()
 
 
@@ -67,16 +90,22 @@ def short_reasons_list():
     :rtype: list of strs
     """
 
-    conn, curs = get_reasons()
+    return list(reasons_list())
 
-    curs.execute('SELECT shortreason FROM reasons')
-    short_list = []
-    for item, in curs.fetchall():
-        short_list.append(item)
 
-    conn.close()
+def _reasons_stat():
+    """
+    :returns: The inode, size, and modification time of the reasons database,
+              or ``None`` if it does not exist
+    :rtype: tuple
+    """
 
-    return short_list
+    try:
+        stat = os.stat(reasons_path())
+    except OSError:
+        return None
+
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
 
 
 def reasons_list():
@@ -86,20 +115,20 @@ def reasons_list():
     :rtype: dict
     """
 
-    short_list = short_reasons_list()
-
-    conn, curs = get_reasons()
+    global REASONS # pylint: disable=global-statement
 
-    reasons = {}
+    stat = _reasons_stat()
+    cached = REASONS
 
-    for short in short_list:
-        curs.execute('SELECT longreason FROM reasons WHERE shortreason=?', (short,))
-        longreason = ''
-        for item in curs.fetchall():
-            longreason += (item[0])
+    if cached is None or stat is None or cached[0] != stat:
+        with REASONS_LOCK:
+            conn, curs = get_reasons()
+            # Taken before reading, since get_reasons can create the database,
+            # and so that a change while reading is noticed next time
+            stat = _reasons_stat()
+            cached = (stat, dict(curs.execute('SELECT shortreason, longreason FROM reasons')))
+            conn.close()
 
-        reasons[short] = longreason
-
-    conn.close()
+            REASONS = cached
 
-    return reasons
+    return dict(cached[1])
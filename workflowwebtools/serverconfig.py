@@ -1,6 +1,11 @@
 """
 Small module to get information from the server config.
 
+The configuration is parsed once and kept in memory.
+It is parsed again if the modification time of the file changes,
+or after :py:func:`reload_config` is called
+(``workflowtool`` calls it when the server gets a ``SIGHUP``).
+
 :author: Daniel Abercrombie <dabercro@mit.edu>
 """
 
@@ -8,6 +13,7 @@ Small module to get information from the server config.
 import os
 import sys
 import shutil
+import threading
 
 import yaml
 
@@ -19,9 +25,14 @@ class NoConfig(Exception):
 
 LOCATION = None
 
-def config_dict():
+CONFIG = None
+"""Tuple of the location, modification time, and contents of the last configuration parsed"""
+CONFIG_LOCK = threading.Lock()
+
+
+def config_location():
     """
-    :returns: the configuration in a dict
+    :returns: the location of the configuration file
     :rtype: str
     :raises NoConfig: when it cannot find the configuration file
     """
@@ -50,14 +61,48 @@ def config_dict():
 
         LOCATION = os.path.join(default_loc)
 
-    output = {}
+    return LOCATION
+
+
+def config_dict():
+    """
+    The returned dictionary is shared by every caller, so it should not be changed.
+
+    :returns: the configuration in a dict
+    :rtype: str
+    :raises NoConfig: when it cannot find the configuration file
+    """
+
+    global CONFIG # pylint: disable=global-statement
+
+    location = config_location()
+    mtime = os.stat(location).st_mtime
+
+    config = CONFIG
+    if config is not None and config[0] == location and config[1] == mtime:
+        return config[2]
+
+    with CONFIG_LOCK:
+        with open(location, 'r') as config_file:
+            output = yaml.load(config_file, Loader=yaml.FullLoader)
 
-    with open(LOCATION, 'r') as config:
-        output = yaml.load(config, Loader=yaml.FullLoader)
+        CONFIG = (location, mtime, output)
 
     return output
 
 
+def reload_config():
+    """
+    Makes the next call to :py:func:`config_dict` parse the configuration again,
+    even if the file does not look like it changed.
+    """
+
+    global CONFIG # pylint: disable=global-statement
+
+    with CONFIG_LOCK:
+        CONFIG = None
+
+
 def get_valid_emails():
     """Get iterator for valid email patterns for this instance.
     This is configurable by the webmaster.
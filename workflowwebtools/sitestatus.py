@@ -0,0 +1,209 @@
+"""
+A shared snapshot of the readiness and drain status of every site.
+
+The functions in :py:mod:`cmstoolbox.sitereadiness` parse the whole status
+list every time a single site is looked up.
+A :py:class:`SiteSnapshot` parses the list once into dictionaries,
+and the module keeps one snapshot that every page and every ErrorInfo shares.
+The snapshot is replaced by a background thread,
+and the old snapshot keeps being used if the status list cannot be fetched.
+
+The age at which the snapshot is replaced can be set in ``config.yml``::
+
+  site_status:
+    ttl: 300    # Seconds
+
+The ToolBox keeps its own copy of the status list for half an hour,
+so that copy is dropped whenever it is older than the ``ttl``.
+
+The functions :py:func:`site_readiness`, :py:func:`site_drain_status`,
+:py:func:`site_list`, and :py:func:`i_site_readiness`
+can be used in place of the ToolBox functions with the same names.
+
+:author: Daniel Abercrombie <dabercro@mit.edu>
+"""
+
+import time
+import logging
+import threading
+
+from cmstoolbox import sitereadiness
+
+from . import serverconfig
+
+
+class SiteSnapshot(object):
+    """
+    The status of every site at one point in time.
+    A snapshot is never changed after it is made.
+    """
+
+    def __init__(self, rows):
+        """
+        :param list rows: Tuples of (site, readiness, drain status)
+        """
+
+        self.rows = rows
+        self.timestamp = time.time()
+
+        # Reversed so that the first row of a site is kept, like the ToolBox lookups
+        self.readiness = {site: ready for site, ready, _ in reversed(rows)}
+        self.drain = {site: drain for site, _, drain in reversed(rows)}
+        self.sites = sorted(self.readiness)
+
+    def site_readiness(self, site_name):
+        """
+        :param str site_name: Name of the site
+        :returns: The readiness of the site, or ``'none'`` if the site is not found.
+                  See :py:func:`cmstoolbox.sitereadiness.site_readiness`.
+        :rtype: str
+        """
+
+        return self.readiness.get(site_name, 'none')
+
+    def site_drain_status(self, site_name):
+        """
+        :param str site_name: Name of the site
+        :returns: The drain status of the site, or ``'none'`` if the site is not found.
+                  See :py:func:`cmstoolbox.sitereadiness.site_drain_status`.
+        :rtype: str
+        """
+
+        return self.drain.get(site_name, 'none')
+
+    def is_site(self, site_name):
+        """
+        :param str site_name: Name of the site
+        :returns: If the site is in the status list
+        :rtype: bool
+        """
+
+        return site_name in self.readiness
+
+
+SNAPSHOT = None
+SNAPSHOT_LOCK = threading.Lock()
+REFRESHER = None
+
+
+def ttl():
+    """
+    :returns: The number of seconds before the snapshot is replaced
+    :rtype: int
+    """
+
+    return serverconfig.config_dict().get('site_status', {}).get('ttl', 300)
+
+
+def load_snapshot():
+    """
+    Makes a new snapshot from the ToolBox and shares it.
+
+    :returns: The new snapshot
+    :rtype: SiteSnapshot
+    """
+
+    global SNAPSHOT # pylint: disable=global-statement
+
+    # Otherwise the ToolBox would give the same list for up to half an hour
+    if sitereadiness.TIMESTAMP and time.time() - sitereadiness.TIMESTAMP >= ttl():
+        sitereadiness.TIMESTAMP = None
+
+    snapshot = SiteSnapshot(list(sitereadiness.i_site_readiness()))
+    SNAPSHOT = snapshot
+
+    return snapshot
+
+
+def get_snapshot():
+    """
+    Gets the shared snapshot.
+    If there is no refresher thread, an old snapshot is replaced here.
+
+    :returns: The current snapshot
+    :rtype: SiteSnapshot
+    """
+
+    snapshot = SNAPSHOT
+
+    if snapshot is not None and \
+            (REFRESHER is not None or time.time() - snapshot.timestamp < ttl()):
+        return snapshot
+
+    with SNAPSHOT_LOCK:
+        # Another thread may have loaded it while this one waited for the lock
+        if SNAPSHOT is not snapshot:
+            return SNAPSHOT
+
+        try:
+            return load_snapshot()
+        except Exception: # pylint: disable=broad-except
+            if snapshot is None:
+                raise
+            logging.exception('Failed to load site status, keeping the old one')
+            return snapshot
+
+
+def _refresh_loop():
+    """
+    Body of the refresher thread.
+    If loading a snapshot fails, the old one is kept and loading is tried again after a minute.
+    """
+
+    while True:
+        try:
+            with SNAPSHOT_LOCK:
+                load_snapshot()
+            time.sleep(ttl())
+        except Exception: # pylint: disable=broad-except
+            logging.exception('Failed to load site status, keeping the old one')
+            time.sleep(60)
+
+
+def start_refresher():
+    """
+    Starts the thread that keeps the snapshot up to date.
+    Calling this more than once does nothing.
+    """
+
+    global REFRESHER # pylint: disable=global-statement
+
+    with SNAPSHOT_LOCK:
+        if REFRESHER is None:
+            REFRESHER = threading.Thread(target=_refresh_loop, name='SiteStatusRefresher')
+            REFRESHER.daemon = True
+            REFRESHER.start()
+
+
+def site_readiness(site_name):
+    """
+    See :py:meth:`SiteSnapshot.site_readiness`
+    """
+
+    return get_snapshot().site_readiness(site_name)
+
+
+def site_drain_status(site_name):
+    """
+    See :py:meth:`SiteSnapshot.site_drain_status`
+    """
+
+    return get_snapshot().site_drain_status(site_name)
+
+
+def site_list():
+    """
+    :returns: The sorted list of site names
+    :rtype: list
+    """
+
+    return list(get_snapshot().sites)
+
+
+def i_site_readiness():
+    """
+    :returns: iterator of tuples with site, readiness, and drain status
+    :rtype: iterator
+    """
+
+    return iter(get_snapshot().rows)
@@ -10,6 +10,8 @@ except ImportError:
 from cmstoolbox.webtools import get_json
 
 from workflowwebtools import serverconfig
+from workflowwebtools import jsonstream
+from workflowwebtools.webclient import iter_json
 
 def open_statuses(location):
     if os.path.isfile(location):
@@ -26,6 +28,31 @@ def open_statuses(location):
                     cookie_key=cookie_stuff.get('cookie_key'))
 
 
+def iter_statuses(location):
+    """
+    :param str location: Either the file location or the URL of statuses.json
+    :returns: Generator of tuples of (workflow, statuses).
+              The file or response is read one workflow at a time.
+    :rtype: generator
+    """
+
+    if os.path.isfile(location):
+        with open(location, 'r') as input_file:
+            for item in jsonstream.iter_items(input_file):
+                yield item
+
+    else:
+        components = urlparse.urlparse(location)
+        cookie_stuff = serverconfig.config_dict()['data']
+
+        for item in iter_json(components.netloc, components.path,
+                              use_https=True,
+                              cookie_file=cookie_stuff.get('cookie_file'),
+                              cookie_pem=cookie_stuff.get('cookie_pem'),
+                              cookie_key=cookie_stuff.get('cookie_key')):
+            yield item
+
+
 def get_manual_workflows(location):
     """
     :param str location: Either the file location or the URL of statuses.json
@@ -34,5 +61,5 @@ def get_manual_workflows(location):
     """
 
     return [workflow for workflow, statuses
-            in open_statuses(location).items()
+            in iter_statuses(location)
             if True in ['manual' in status for status in statuses]]
@@ -1,16 +1,90 @@
 """
 Generates Mako templates
+
+A single :py:class:`mako.lookup.TemplateLookup` is made the first time
+a template is rendered and shared by every request after that.
+By default, the lookup does not check if the template files have changed,
+so a change to a template needs a restart of the server.
+This can be changed in ``config.yml``::
+
+  templates:
+    filesystem_checks: true     # The default is false
+    precompile: false           # The default is true, see precompile()
 """
 
 import os
+import time
+import threading
 
 import mako.lookup
+import cherrypy
 
 from .. import serverconfig
 
 TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                              'templates')
 
+LOOKUP = None
+LOOKUP_LOCK = threading.Lock()
+
+
+def get_lookup():
+    """
+    :returns: The template lookup shared by the whole process
+    :rtype: mako.lookup.TemplateLookup
+    """
+
+    global LOOKUP # pylint: disable=global-statement
+
+    with LOOKUP_LOCK:
+        if LOOKUP is None:
+            config = serverconfig.config_dict()
+            LOOKUP = mako.lookup.TemplateLookup(
+                directories=[TEMPLATES_DIR],
+                module_directory=os.path.join(config['workspace'], 'mako_modules'),
+                filesystem_checks=config.get('templates', {}).get('filesystem_checks', False)
+                )
+
+    return LOOKUP
+
+
+def precompile():
+    """
+    Compiles every template in the templates directory,
+    so that no request has to wait for a template to be compiled.
+    The time taken for each template is written to the log.
+
+    :returns: Tuples of the template name and the seconds taken to compile it,
+              or ``None`` in place of the time if the template failed to compile
+    :rtype: list
+    """
+
+    lookup = get_lookup()
+    report = []
+
+    for name in sorted(os.listdir(TEMPLATES_DIR)):
+        if not name.endswith('.html'):
+            continue
+
+        start = time.time()
+        try:
+            lookup.get_template(name)
+            report.append((name, time.time() - start))
+        except Exception: # pylint: disable=broad-except
+            cherrypy.log('Failed to compile template %s' % name, traceback=True)
+            report.append((name, None))
+
+    for name, seconds in report:
+        cherrypy.log('Template %-30s %s' %
+                     (name, 'failed' if seconds is None else '%.3f s' % seconds))
+
+    cherrypy.log('Compiled %i templates in %.3f s' %
+                 (len([seconds for _, seconds in report if seconds is not None]),
+                  sum(seconds for _, seconds in report if seconds is not None)))
+
+    return report
+
+
 def render(template, **kwargs):
     """
     Function to generate mako template
@@ -21,8 +95,4 @@ def render(template, **kwargs):
     :rtype: str
     """
 
-    return mako.lookup.TemplateLookup(
-        directories=[TEMPLATES_DIR],
-        module_directory=os.path.join(
-            serverconfig.config_dict()['workspace'], 'mako_modules')
-        ).get_template(template).render(**kwargs)
+    return get_lookup().get_template(template).render(**kwargs)
@@ -0,0 +1,257 @@
+"""
+A shared HTTP client for the calls that :py:mod:`workflowinfo` makes to cmsweb.
+
+Each call of :py:func:`cmstoolbox.webtools.get_json` opens a new
+certificate authenticated connection.
+The :py:class:`WebClient` instead keeps a pool of connections alive for each host,
+retries failed calls with a backoff, and limits the number of calls
+in flight at once for the whole process.
+:py:func:`get_json` takes the same arguments as the ToolBox function,
+so it can be used as a drop-in replacement.
+:py:func:`iter_json` reads a large response one member at a time with
+:py:mod:`jsonstream`, instead of loading the whole body first.
+
+The client can be tuned in ``config.yml``::
+
+  webclient:
+    pool_size: 20       # Connections kept alive per host
+    max_inflight: 50    # Calls allowed at once in this process
+    retries: 3          # Retries for connection errors and 5xx responses
+    backoff: 0.5        # Backoff factor, in seconds, between retries
+    timeout: 300        # Timeout for each call, in seconds
+
+:author: Daniel Abercrombie <dabercro@mit.edu>
+"""
+
+import io
+import os
+import logging
+import threading
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode # pylint: disable=import-error
+
+import requests
+import urllib3
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cmstoolbox import webtools
+
+from . import jsonstream
+from . import serverconfig
+
+# Like the ToolBox, we do not verify the certificates of cmsweb
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+
+class WebClient(object):
+    """
+    Holds a :py:class:`requests.Session` with a connection pool for each host.
+    All methods are safe to call from many threads at once.
+    """
+
+    def __init__(self, pool_size=None, max_inflight=None,
+                 retries=None, backoff=None, timeout=None):
+        """
+        Each parameter defaults to the matching key under ``webclient``
+        in the server configuration.
+
+        :param int pool_size: The number of connections to keep alive for each host
+        :param int max_inflight: The number of calls allowed at once
+        :param int retries: The number of times to retry a call
+        :param float backoff: The backoff factor between retries, in seconds
+        :param float timeout: Time in seconds before giving up on a call
+        """
+
+        config = serverconfig.config_dict().get('webclient', {})
+
+        self.pool_size = int(pool_size or config.get('pool_size', 20))
+        self.max_inflight = int(max_inflight or config.get('max_inflight', 50))
+        self.retries = int(config.get('retries', 3) if retries is None else retries)
+        self.backoff = float(config.get('backoff', 0.5) if backoff is None else backoff)
+        self.timeout = timeout or config.get('timeout', 300)
+
+        self.inflight = threading.BoundedSemaphore(self.max_inflight)
+
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size,
+            max_retries=Retry(total=self.retries,
+                              backoff_factor=self.backoff,
+                              status_forcelist=(500, 502, 503, 504),
+                              allowed_methods=None,
+                              raise_on_status=False)
+            )
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _prepare(self, host, request, params, headers, port, kwargs):
+        """
+        Builds a call in the same way as :py:func:`cmstoolbox.webtools.get_json`.
+        See :py:meth:`get_json` for the parameters.
+
+        :returns: The URL, the headers, and the certificate to pass to the session
+        :rtype: tuple
+        """
+
+        check_for_port = host.split(':')
+        if len(check_for_port) == 2:
+            host = check_for_port[0]
+            port = int(check_for_port[1])
+
+        use_cert = kwargs.get('use_cert', False)
+        use_https = kwargs.get('use_https', use_cert or bool(kwargs.get('cookie_file')))
+
+        cert = None
+        if use_cert:
+            cert_file = kwargs.get(
+                'cert_file',
+                os.environ.get('X509_USER_PROXY',
+                               '/tmp/x509up_u%i' % os.geteuid())
+                )
+            cert = (cert_file, cert_file)
+
+        url = '%s://%s%s%s' % ('https' if use_https else 'http', host,
+                               ':%i' % port if port else '', request)
+
+        header = dict(headers or {'Accept': 'application/json'})
+        if webtools.USER_AGENT and 'User-Agent' not in header:
+            header['User-Agent'] = webtools.USER_AGENT
+
+        if kwargs.get('cookie_file'):
+            sso_url = 'https://%s:%i%s' % (host, port or 443, request)
+            if params:
+                sso_url += '?' + urlencode(params, doseq=True)
+
+            header['Cookie'] = webtools.get_cookie_header(
+                sso_url, kwargs['cookie_file'], kwargs.get('cookie_pem'),
+                kwargs.get('cookie_key'), kwargs.get('cookie_time'))[host]
+
+        return url, header, cert
+
+    def get_json(self, host, request, params=None, headers=None, port=None, **kwargs):
+        """
+        Get JSON from a URL through the connection pool.
+
+        :param str host: The name of the host to connect to, optionally with ``:port``
+        :param str request: The request to make to the host
+        :param dict params: The parameters to pass to the request.
+                            Values that are lists are passed once for each element.
+        :param dict headers: Headers to pass to request. If ``None``,
+                             ``{'Accept': 'application/json'}`` will be passed.
+        :param int port: The port to access, if a not default value
+        :param kwargs: Additional arguments that can be used to change
+                       the connection behavior.
+                       These are listed below:
+
+                       - use_https (bool) - Uses HTTP connection by default
+                       - use_cert (bool) - Does not pass a certificate by default
+                       - cert_file (str) - Default is ``$X509_USER_PROXY``.
+                       - cookie_file (str) - Location of a Shibboleth cookie to pass in header
+                       - cookie_pem (str) - Location of ``.pem`` file to generate cookie
+                       - cookie_key (str) - Location of ``.rsa`` key to generate cookie
+                       - cookie_time (float) - Time, in seconds, until generating a new cookie
+
+        :returns: The JSON from the query, or an empty dictionary
+                  if the server does not give a good response
+        :rtype: dict
+        """
+
+        url, header, cert = self._prepare(host, request, params, headers, port, kwargs)
+
+        with self.inflight:
+            res = self.session.get(url, params=params or None, headers=header,
+                                   cert=cert, verify=False, timeout=self.timeout)
+
+            if res.status_code == 200:
+                return res.json()
+
+        logging.warning('STATUS: %s, REASON: %s, URL: %s', res.status_code, res.reason, url)
+        return {}
+
+    def iter_json(self, host, request, params=None, headers=None, port=None,
+                  path=(), **kwargs):
+        """
+        Get the members of an object in the JSON from a URL,
+        decoding each one as it arrives instead of reading the whole response first.
+        The call counts against ``max_inflight`` until the generator is finished or closed.
+
+        :param tuple path: The keys and indices of the object to iterate over.
+                           See :py:func:`jsonstream.iter_items`.
+        :returns: Generator of tuples of (key, value).
+                  Nothing is yielded if the server does not give a good response.
+        :rtype: generator
+
+        See :py:meth:`get_json` for the other parameters.
+        """
+
+        url, header, cert = self._prepare(host, request, params, headers, port, kwargs)
+
+        with self.inflight:
+            res = self.session.get(url, params=params or None, headers=header, stream=True,
+                                   cert=cert, verify=False, timeout=self.timeout)
+
+            try:
+                if res.status_code != 200:
+                    logging.warning('STATUS: %s, REASON: %s, URL: %s',
+                                    res.status_code, res.reason, url)
+                    return
+
+                # Undo any gzip from the server while reading
+                res.raw.decode_content = True
+                text = io.TextIOWrapper(res.raw, encoding=res.encoding or 'utf-8')
+
+                for item in jsonstream.iter_items(text, path):
+                    yield item
+
+            finally:
+                res.close()
+
+
+CLIENT = None
+CLIENT_LOCK = threading.Lock()
+
+
+def get_client():
+    """
+    :returns: The client shared by everything in this process
+    :rtype: WebClient
+    """
+
+    global CLIENT # pylint: disable=global-statement
+
+    with CLIENT_LOCK:
+        if CLIENT is None:
+            CLIENT = WebClient()
+
+    return CLIENT
+
+
+def get_json(host, request, params=None, **kwargs):
+    """
+    Calls :py:meth:`WebClient.get_json` of the shared client.
+    See that method for the description of the parameters.
+
+    :returns: The JSON from the query
+    :rtype: dict
+    """
+
+    return get_client().get_json(host, request, params, **kwargs)
+
+
+def iter_json(host, request, params=None, **kwargs):
+    """
+    Calls :py:meth:`WebClient.iter_json` of the shared client.
+    See that method for the description of the parameters.
+
+    :returns: Generator of tuples of (key, value)
+    :rtype: generator
+    """
+
+    return get_client().iter_json(host, request, params, **kwargs)
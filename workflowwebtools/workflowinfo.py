@@ -18,18 +18,26 @@ import threading
 from collections import defaultdict
 from functools import wraps
 
-from cmstoolbox.webtools import get_json
-from cmstoolbox.sitereadiness import site_list
-
 from . import serverconfig
+from . import sitestatus
+from .webclient import get_json
+from .webclient import iter_json
+from .infocache import get_memory_cache, get_store, get_revalidator
 
-def cached_json(attribute, timeout=None):
+def cached_json(attribute, timeout=None, timeout_key=None):
     """
-    A decorator for caching dictionaries in local files.
+    A decorator for caching dictionaries in local files,
+    or the store selected in the configuration (see :py:func:`infocache.get_store`).
+    Decoded values are also kept in the :py:class:`infocache.MemoryCache`
+    shared by every :py:class:`Info` object.
+    If ``cache_store: serve_stale`` is set in the configuration,
+    expired values are returned immediately and refreshed in the background.
 
     :param str attribute: The key of the :py:class:`WorkflowInfo` cache to
                           set using the decorated function.
     :param int timeout: The amount of time before refreshing the JSON file, in seconds.
+    :param str timeout_key: The key under ``cache_refresh`` in the configuration
+                            to take the timeout from if ``attribute`` is not there.
     :returns: Function decorator
     :rtype: func
     """
@@ -43,6 +51,19 @@ def cached_json(attribute, timeout=None):
         :rtype: func
         """
 
+        def revalidate(self, key, tmout, args, kwargs):
+            """
+            Replaces a stale entry with the output of the original function.
+            This is run by the :py:class:`infocache.Revalidator`,
+            holding the same lock as a fetch in the foreground.
+            """
+
+            with self.cachelocks[attribute]:
+                check_var = func(self, *args, **kwargs)
+                text = json.dumps(check_var)
+                get_store().save(key[0], attribute, text, tmout)
+                get_memory_cache().set(key, check_var, len(text), tmout and time.time() + tmout)
+
         @wraps(func)
         def function_wrapper(self, *args, **kwargs):
             """
@@ -51,10 +72,12 @@ def cached_json(attribute, timeout=None):
             :returns: Output of the originally decorated function
             :rtype: dict
             """
-            tmout = timeout or serverconfig.config_dict()['cache_refresh'].get(attribute)
-
-            if not os.path.exists(self.cache_dir):
-                os.mkdir(self.cache_dir)
+            config = serverconfig.config_dict()
+            refresh = config['cache_refresh']
+            tmout = timeout or refresh.get(attribute, refresh.get(timeout_key))
+            stale = config.get('cache_store', {}).get('serve_stale', False)
+            retry = config.get('cache_store', {}).get('retry', 60)
+            revalidating = False
 
             self.cachelock.acquire()
             if attribute not in self.cachelocks:
@@ -63,28 +86,46 @@ def cached_json(attribute, timeout=None):
             self.cachelocks[attribute].acquire()
             self.cachelock.release()
 
-            check_var = self.cache.get(attribute)
-
-            if check_var is None:
-                file_name = self.cache_filename(attribute)
-                if os.path.exists(file_name) and \
-                        (tmout is None or time.time() - tmout < os.stat(file_name).st_mtime):
-                    try:
-                        with open(file_name, 'r') as cache_file:
-                            check_var = json.load(cache_file)
-                    except ValueError:
-                        print('JSON file no good. Deleting %s. Try again later.' % file_name)
-                        os.remove(file_name)
+            try:
+                key = (str(self), attribute)
+                memory = get_memory_cache()
+                check_var = memory.get(key)
 
-                # If still None, call the wrapped function
                 if check_var is None:
-                    check_var = func(self, *args, **kwargs)
-                    with open(file_name, 'w') as cache_file:
-                        json.dump(check_var, cache_file)
-
-                self.cache[attribute] = check_var
-
-            self.cachelocks[attribute].release()
+                    store = get_store()
+                    loaded = store.load(key[0], attribute, None if stale else tmout)
+                    if loaded is not None:
+                        text, updated = loaded
+                        expires = tmout and updated + tmout
+                        try:
+                            check_var = json.loads(text)
+                        except ValueError:
+                            print('JSON cache of %s %s no good. Deleting. Try again later.' % key)
+                            store.delete(key[0], attribute)
+
+                        # Serve a stale entry, and refresh it in the background.
+                        # The stale entry is only kept in memory until it is time
+                        # to check the store again, in case the refresh fails.
+                        if check_var is not None and stale and \
+                                expires and expires < time.time():
+                            revalidating = True
+                            expires = time.time() + retry
+
+                    # If still None, call the wrapped function
+                    if check_var is None:
+                        check_var = func(self, *args, **kwargs)
+                        text = json.dumps(check_var)
+                        store.save(key[0], attribute, text, tmout)
+                        expires = tmout and time.time() + tmout
+
+                    memory.set(key, check_var, len(text), expires)
+
+            finally:
+                self.cachelocks[attribute].release()
+
+            # Scheduled after the stale value is in memory, so it cannot replace the new one
+            if revalidating:
+                get_revalidator().schedule(key, revalidate, self, key, tmout, args, kwargs)
 
             return check_var or {}
 
@@ -111,12 +152,43 @@ def list_workflows(status):
     return request['result']
 
 
-def errors_for_workflow(workflow, url='cmsweb.cern.ch'):
+def get_workflow_parameters(workflows, url='cmsweb.cern.ch'):
     """
-    Get the useful status information from a workflow
+    Get the ReqMgr2 parameters of many workflows in a single request.
+    See :py:meth:`WorkflowInfo.get_workflow_parameters` for a single workflow.
 
-    :param str workflow: the name of the workflow request
+    :param list workflows: the names of the workflow requests
     :param str url: the base url to find the information at
+    :returns: the parameters of each workflow that was found, keyed by workflow name
+    :rtype: dict
+    """
+
+    output = {}
+
+    try:
+        result = get_json(url,
+                          '/reqmgr2/data/request',
+                          params={'name': list(workflows)},
+                          use_https=True, use_cert=True)
+
+        for params in result.get('result', []):
+            for key, item in params.items():
+                if key in workflows:
+                    output[key] = item
+
+    except Exception as error:
+        print('Failed to get from reqmgr', workflows)
+        print(str(error))
+
+    return output
+
+
+def errors_from_jobdetail(workflow, result):
+    """
+    Get the number of errors at each site from a jobdetail document
+
+    :param str workflow: the name of the workflow request
+    :param dict result: the jobdetail JSON from the wmstatsserver
     :returns: a dictionary containing error codes in the following format::
 
               {step: {errorcode: {site: number_errors}}}
@@ -124,13 +196,9 @@ def errors_for_workflow(workflow, url='cmsweb.cern.ch'):
     :rtype: dict
     """
 
-    result = get_json(url,
-                      '/wmstatsserver/data/jobdetail/%s' % workflow,
-                      use_cert=True)
-
     output = {}
 
-    if not result['result']:
+    if not result.get('result'):
         return output
 
     for step, stepdata in result['result'][0].get(workflow, {}).items():
@@ -149,9 +217,29 @@ def errors_for_workflow(workflow, url='cmsweb.cern.ch'):
 
     return output
 
+
+def errors_for_workflow(workflow, url='cmsweb.cern.ch'):
+    """
+    Get the useful status information from a workflow.
+    The jobdetail is shared with the cache of :py:class:`WorkflowInfo`.
+
+    :param str workflow: the name of the workflow request
+    :param str url: the base url to find the information at
+    :returns: a dictionary containing error codes in the following format::
+
+              {step: {errorcode: {site: number_errors}}}
+
+    :rtype: dict
+    """
+
+    jobdetail = WorkflowInfo(workflow, url)._get_jobdetail() # pylint: disable=protected-access
+    return errors_from_jobdetail(workflow, jobdetail)
+
+
 def explain_errors(workflow, errorcode):
     """
-    Get example errors for a given workflow and errorcode
+    Get example errors for a given workflow and errorcode.
+    The jobdetail is shared with the cache of :py:class:`WorkflowInfo`.
 
     :param str workflow: is the workflow name
     :param str errorcode: is the error code
@@ -159,13 +247,11 @@ def explain_errors(workflow, errorcode):
     :rtype: list
     """
 
-    result = get_json('cmsweb.cern.ch',
-                      '/wmstatsserver/data/jobdetail/%s' % workflow,
-                      use_cert=True)
+    result = WorkflowInfo(workflow)._get_jobdetail() # pylint: disable=protected-access
 
     output = []
 
-    if not result['results']:
+    if not result.get('result'):
         return output
 
     for stepdata in result['result'][0].get(workflow, {}).values():
@@ -183,19 +269,23 @@ class Info(object):
     """
 
     def __init__(self):
-        # Stores things using the cached_json decorator
-        self.cache = {}
         self.cache_dir = os.path.join(os.environ.get('TMPDIR', '/tmp'), 'workflowinfo')
-        self.bak_dir = os.path.join(self.cache_dir, 'bak')
         self.cachelock = threading.Lock()
         self.cachelocks = {}
 
     def __str__(self):
-        pass
+        """
+        :returns: The name used to key the caches.
+                  Subclasses return ``<kind>_<name>``.
+        :rtype: str
+        """
+
+        return type(self).__name__.lower()
 
     def cache_filename(self, attribute):
         """
         Return the name of the file for caching
+        when using the :py:class:`infocache.FileStore`
 
         :param str attribute: The information to store in the file
         :returns: The full file name to store the cache
@@ -203,21 +293,47 @@ class Info(object):
         """
         return os.path.join(self.cache_dir, '%s_%s.cache.json' % (self, attribute))
 
+    def is_cached(self, attribute):
+        """
+        Checks for a valid cached value without fetching anything.
+
+        :param str attribute: The key of the cache to check
+        :returns: True if the attribute is cached in memory or in the store
+        :rtype: bool
+        """
+
+        if get_memory_cache().get((str(self), attribute)) is not None:
+            return True
+
+        tmout = serverconfig.config_dict()['cache_refresh'].get(attribute)
+        return get_store().load(str(self), attribute, tmout) is not None
+
+    def set_cache(self, attribute, value):
+        """
+        Fills the cache with a value that was fetched elsewhere,
+        for example in a request for many workflows at once.
+
+        :param str attribute: The key of the cache to set
+        :param value: The JSON-serializable value to store
+        """
+
+        tmout = serverconfig.config_dict()['cache_refresh'].get(attribute)
+
+        text = json.dumps(value)
+        get_store().save(str(self), attribute, text, tmout)
+        get_memory_cache().set((str(self), attribute), value, len(text),
+                               tmout and time.time() + tmout)
+
     def reset(self):
         """
         Reset the cache for this object and clear out the files.
         """
         print('Reseting %s' % self)
 
-        if not os.path.exists(self.bak_dir):
-            os.mkdir(self.bak_dir)
-
-        for attribute in self.cache:
-            cache_file = self.cache_filename(attribute)
-            if os.path.exists(cache_file):
-                os.rename(cache_file, cache_file.replace(self.cache_dir, self.bak_dir))
+        attributes = set(get_memory_cache().invalidate(str(self)))
+        attributes.update(self.cachelocks)
 
-        self.cache.clear()
+        get_store().reset(str(self), attributes)
 
 
 class WorkflowInfo(Info):
@@ -275,8 +391,8 @@ class WorkflowInfo(Info):
     @cached_json('errors')
     def get_errors(self, get_unreported=False):
         """
-        A wrapper for :py:func:`errors_for_workflow` if you happen to have
-        a :py:class:`WorkflowInfo` object already.
+        Get the errors of this workflow from the same cached jobdetail
+        used by :py:meth:`get_explanation`.
 
         :param bool get_unreported: Get the unreported errors from ACDC server
         :returns: a dictionary containing error codes in the following format::
@@ -286,7 +402,7 @@ class WorkflowInfo(Info):
         :rtype: dict
         """
 
-        output = errors_for_workflow(self.workflow, self.url)
+        output = errors_from_jobdetail(self.workflow, self._get_jobdetail())
 
         if get_unreported:
             acdc_server_response = get_json(
@@ -437,7 +553,7 @@ class WorkflowInfo(Info):
 
         site_set = self.get_recovery_info().get(task, {}).get('sites_to_run', [])
         out_list = []
-        all_site_list = site_list()
+        snapshot = sitestatus.get_snapshot()
 
         for site in site_set:
             if site.startswith('T0_') or site.endswith('_MSS') or site.endswith('_Export'):
@@ -445,25 +561,32 @@ class WorkflowInfo(Info):
 
             clean_site = re.sub(r'_(ECHO_)?(Disk)$', '', site)
             if clean_site not in out_list and clean_site and \
-                    clean_site in all_site_list:
+                    snapshot.is_site(clean_site):
                 out_list.append(clean_site)
 
         out_list.sort()
 
         return out_list
 
-    @cached_json('jobdetail')
+    @cached_json('jobdetail', timeout_key='errors')
     def _get_jobdetail(self):
         """
-        Get the jobdetail from the wmstatsserver
+        Get the jobdetail from the wmstatsserver.
+        This is the largest document fetched for a workflow,
+        so the errors, explanations, and logs are all read from this one cache.
+        The steps of this workflow are decoded one at a time as the response arrives,
+        and nothing else in the response is kept.
 
         :returns: The job detail json from the server or cache
         :rtype: dict
         """
 
-        return get_json(self.url,
-                        '/wmstatsserver/data/jobdetail/%s' % self.workflow,
-                        use_cert=True)
+        steps = dict(iter_json(self.url,
+                               '/wmstatsserver/data/jobdetail/%s' % self.workflow,
+                               path=('result', 0, self.workflow),
+                               use_cert=True))
+
+        return {'result': [{self.workflow: steps}]} if steps else {}
 
     def get_explanation(self, errorcode, step=''):
         """
@@ -477,8 +600,8 @@ class WorkflowInfo(Info):
 
         if self.explanations is None:
             self.explanations = defaultdict(lambda: defaultdict(lambda: []))
-            result = self._get_jobdetail()
-            for stepname, stepdata in result['result'][0].get(self.workflow, {}).items():
+            result = self._get_jobdetail().get('result') or [{}]
+            for stepname, stepdata in result[0].get(self.workflow, {}).items():
                 # Get the errors from both 'jobfailed' and 'submitfailed' details
                 for error, site in [(error, site) for status in ['jobfailed', 'submitfailed'] \
                                         for error, site in stepdata.get(status, {}).items()]:
@@ -558,6 +681,28 @@ class PrepIDInfo(Info):
 
         return result['result'][0]
 
+    def prime_workflows(self, get_workflow=None):
+        """
+        Fills the ``workflow_params`` cache of each workflow in this Prep ID
+        from the details of :py:meth:`get_requests`,
+        so that they do not have to be fetched one at a time.
+
+        :param func get_workflow: Function that returns a WorkflowInfo from a name.
+                                  Defaults to making a new WorkflowInfo.
+        :returns: The names of the workflows
+        :rtype: list
+        """
+
+        get_workflow = get_workflow or WorkflowInfo
+        requests = self.get_requests()
+
+        for workflow, params in requests.items():
+            info = get_workflow(workflow)
+            if not info.is_cached('workflow_params'):
+                info.set_cache('workflow_params', params)
+
+        return list(requests)
+
     def get_workflows_requesttime(self):
         """
         :returns: A list of tuples containing (workflow name, timestamp of request)
@@ -14,11 +14,9 @@ import json
 import time
 import datetime
 import threading
-import sqlite3
 
 import cherrypy
 
-from cmstoolbox import sitereadiness
 from cmstoolbox import checkexists
 
 
@@ -33,6 +31,10 @@ from workflowwebtools import clusterworkflows
 from workflowwebtools import classifyerrors
 from workflowwebtools import actionshistorylink
 from workflowwebtools import errorutils
+from workflowwebtools import fetchpipeline
+from workflowwebtools import infocache
+from workflowwebtools import sitestatus
+from workflowwebtools import keylocks
 from workflowwebtools.web.templates import render
 from workflowwebtools.predict import evaluate
 
@@ -47,8 +49,14 @@ class WorkflowTools(object):
     def __init__(self):
         self.lock = threading.Lock()
         self.wflock = threading.Lock()
-        self.readinesslock = threading.Lock()
-        self.seeworkflowlock = threading.Lock()
+        # Requests for the same workflow wait for each other, different workflows do not
+        self.workflowlocks = keylocks.KeyedLocks()
+        sitestatus.start_refresher()
+        # Connect to the actions database and create its indexes before the first request
+        manageactions.get_actions_collection()
+        # Build the first shared generation of errors before any page asks for it
+        globalerrors.get_global_info()
+        globalerrors.start_refresher()
         self.cluster()
         self.update()
 
@@ -98,20 +106,9 @@ class WorkflowTools(object):
                 [info.get_prep_id() for info in self.workflows.values()]
             }
 
-            self.update_statuses()
-
         finally:
             self.lock.release()
 
-
-    def update_statuses(self):
-        coll = manageactions.get_actions_collection()
-        self.site_statuses = None
-        self.statuses = {
-            record['workflow']: record['acted']
-            for record in coll.find()
-            }
-
     @cherrypy.expose
     def index(self):
         """
@@ -161,10 +158,10 @@ class WorkflowTools(object):
         return evaluate.predict(self.get(workflow))
 
     def get_status(self, workflow):
-        status = self.statuses.get(workflow)
-        if status is None:
+        record = manageactions.get_action_records().get(workflow)
+        if record is None or record.get('acted') is None:
             return "none"
-        return "acted" if status else "pending"
+        return "acted" if record['acted'] else "pending"
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
@@ -220,7 +217,6 @@ class WorkflowTools(object):
     def submit2(self):
         input_json = cherrypy.request.json
         res = manageactions.submit2(cherrypy.request.login, input_json['documents'])
-        self.update_statuses()
         return {'message': 'Done, status: {0}'.format(str(res))}
 
 
@@ -255,6 +251,12 @@ class WorkflowTools(object):
         Clicking anywhere else in the workflow box
         will cause it to expand to show errors for each step.
 
+        The rendered page is shared by every user until the errors are refreshed,
+        an action is submitted, or the ``page_cache: ttl`` passes.
+        A ``ttl`` of 0 turns the shared page off.
+        The page is sent with an ETag, so a browser that already has the page
+        for the same errors and actions gets an empty ``304 Not Modified`` response.
+
         :param str pievar: The variable that the pie charts are split into.
                            Valid values are:
 
@@ -266,33 +268,57 @@ class WorkflowTools(object):
         :rtype: str
         """
 
-        # For some reasons, we occasionally have to refresh this global errors page
+        info = globalerrors.check_session(cherrypy.session, True)
+
+        # The page only changes with the errors or the actions
+        page_cache = infocache.get_page_cache()
+        key = None
+        if info.generation is not None:
+            key = (int(info.timestamp), info.generation, pievar,
+                   manageactions.actions_version())
+            etag = '"%s"' % '-'.join(str(part) for part in key)
+
+            cherrypy.response.headers['ETag'] = etag
+            cherrypy.response.headers['Cache-Control'] = 'private, no-cache'
+
+            if etag in [tag.strip() for tag in
+                        cherrypy.request.headers.get('If-None-Match', '').split(',')]:
+                cherrypy.response.status = 304
+                return ''
+
+            if page_cache.ttl > 0:
+                page = page_cache.get(('globalerror', key))
+                if page is not None:
+                    return page
 
-        errors = globalerrors.get_errors(pievar, cherrypy.session)
         if pievar != 'stepname':
 
+            # Get the parameters of any workflows not cached yet in one request
+            fetchpipeline.get_fetcher().load_parameters(info.return_workflows(),
+                                                        info.get_workflow)
+
             # This pulls out the timestamp from the workflow parameters
             timestamp = lambda wkf: time.mktime(
                 datetime.datetime(
-                    *(globalerrors.check_session(cherrypy.session).\
-                          get_workflow(wkf).get_workflow_parameters()['RequestDate'])).timetuple()
+                    *(info.get_workflow(wkf).get_workflow_parameters()['RequestDate'])).timetuple()
                 )
 
-            errors = globalerrors.group_errors(
-                globalerrors.group_errors(errors, lambda subtask: subtask.split('/')[1],
-                                          timestamp=timestamp),
-                lambda workflow: globalerrors.check_session(cherrypy.session).\
-                    get_workflow(workflow).get_prep_id()
-                )
+            # Steps are rolled up into workflows, and workflows into Prep IDs
+            errors = globalerrors.rollup_errors(pievar, [
+                (lambda subtask: subtask.split('/')[1], {'timestamp': timestamp}),
+                (lambda workflow: info.get_workflow(workflow).get_prep_id(), {})
+                ], cherrypy.session)
+
+        else:
+            errors = globalerrors.get_errors(pievar, cherrypy.session)
 
         # Get the names of the columns
-        cols = globalerrors.check_session(cherrypy.session).\
-            get_allmap()[globalerrors.get_row_col_names(pievar)[1]]
+        cols = info.get_allmap()[globalerrors.get_row_col_names(pievar)[1]]
 
         get_names = lambda x: [globalerrors.TITLEMAP[name]
                                for name in globalerrors.get_row_col_names(x)]
 
-        template = lambda: render(
+        page = render(
             'globalerror.html',
             errors=errors,
             decoder=json.dumps,
@@ -300,16 +326,14 @@ class WorkflowTools(object):
             pievar=pievar,
             acted_workflows=manageactions.get_acted_workflows(
                 serverconfig.get_history_length()),
-            readiness=globalerrors.check_session(cherrypy.session).readiness,
+            readiness=info.readiness,
             get_names=get_names
             )
 
-        try:
-            return template()
-        # I don't remember what kind of exception this throws...
-        except Exception: # pylint: disable=broad-except
-            time.sleep(1)
-            return template()
+        if key is not None and page_cache.ttl > 0:
+            page_cache.set(('globalerror', key), page, len(page))
+
+        return page
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
@@ -412,30 +436,19 @@ class WorkflowTools(object):
         :returns: the error tables page for a given workflow
         :rtype: str
         :raises: 404 if a workflow doesn't seem to be in assistance anymore
-                 Resets personal cache in the meanwhile, just in case
+                 Asks for fresh error information in the meanwhile, just in case
         """
 
-        self.seeworkflowlock.acquire()
-
-        output = ''
-
-        try:
+        with self.workflowlocks.hold(workflow):
             if workflow not in \
                     globalerrors.check_session(
                             cherrypy.session, can_refresh=True).return_workflows():
-                WorkflowTools.RESET_LOCK.acquire()
-                info = globalerrors.check_session(cherrypy.session)
-                if info:
-                    info.teardown()
-                    info.setup()
-                WorkflowTools.RESET_LOCK.release()
-
+                globalerrors.request_refresh()
                 raise cherrypy.HTTPError(404)
 
             workflowdata = globalerrors.see_workflow(workflow, cherrypy.session)
 
-            drain_statuses = {sitename: drain for sitename, _, drain in \
-                                  sitereadiness.i_site_readiness()}
+            drain_statuses = sitestatus.get_snapshot().drain
 
             output = render(
                 'workflowtables.html',
@@ -447,8 +460,6 @@ class WorkflowTools(object):
                 drain_statuses=drain_statuses,
                 last_submitted=manageactions.get_datetime_submitted(workflow)
                 )
-        finally:
-            self.seeworkflowlock.release()
 
         return output
 
@@ -473,8 +484,7 @@ class WorkflowTools(object):
         :returns: An object (dictionary) of drain statuses of sites
         :rtype: JSON
         """
-        return {sitename: drain for sitename, _, drain in \
-                    sitereadiness.i_site_readiness()}
+        return sitestatus.get_snapshot().drain
 
 
     @cherrypy.expose
@@ -485,23 +495,15 @@ class WorkflowTools(object):
         :rtype: JSON
         """
 
-        self.readinesslock.acquire()
-
-        try:
-            if self.site_statuses is None:
-                self.site_statuses = [
-                    {
-                        'site': site,
-                        'status': status,
-                        'drain': drain
-                    }
-                    for site, status, drain in sitereadiness.i_site_readiness() \
-                    if not site.startswith('T3')
-                ]
-        finally:
-            self.readinesslock.release()
-
-        return self.site_statuses
+        return [
+            {
+                'site': site,
+                'status': status,
+                'drain': drain
+            }
+            for site, status, drain in sitestatus.i_site_readiness() \
+            if not site.startswith('T3')
+        ]
 
 
     @cherrypy.expose
@@ -542,19 +544,14 @@ class WorkflowTools(object):
         if serverconfig.config_dict()['cluster'].get('skip'):
             return output
 
-        self.seeworkflowlock.acquire()
-
-        try:
+        with self.workflowlocks.hold(workflow):
             if workflow in \
                     globalerrors.check_session(cherrypy.session,
                                                can_refresh=True).return_workflows():
 
-                clusterworkflows.CLUSTER_LOCK.acquire()
-
-                similar_wfs = clusterworkflows.\
-                    get_clustered_group(workflow, self.clusterer, cherrypy.session)
-
-                clusterworkflows.CLUSTER_LOCK.release()
+                with clusterworkflows.CLUSTER_LOCK:
+                    similar_wfs = clusterworkflows.\
+                        get_clustered_group(workflow, self.clusterer, cherrypy.session)
 
                 acted = [
                     wf for wf in manageactions.get_acted_workflows(
@@ -563,8 +560,6 @@ class WorkflowTools(object):
 
                 output = {'similar': sorted(list(similar_wfs)),
                           'acted': acted}
-        finally:
-            self.seeworkflowlock.release()
 
         return output
 
@@ -584,10 +579,7 @@ class WorkflowTools(object):
         :rtype: JSON
         """
 
-        output = {}
-        self.seeworkflowlock.acquire()
-
-        try:
+        with self.workflowlocks.hold(workflow):
             max_error = classifyerrors.get_max_errorcode(self.get(workflow))
             main_error_class = classifyerrors.classifyerror(max_error, self.get(workflow))
 
@@ -598,9 +590,6 @@ class WorkflowTools(object):
                 'params': main_error_class['params_string']
             }
 
-        finally:
-            self.seeworkflowlock.release()
-
         return output
 
 
@@ -660,9 +649,10 @@ class WorkflowTools(object):
 
         output = ''
 
-        self.seeworkflowlock.acquire()
-        try:
+        # Every workflow in the submission is locked, in sorted order, before any is changed
+        locked = workflows if isinstance(workflows, list) else [workflows]
 
+        with self.workflowlocks.hold(*locked):
             workflows, reasons, params = manageactions.\
                 submitaction(cherrypy.request.login, workflows, action, cherrypy.session,
                              **kwargs)
@@ -684,8 +674,7 @@ class WorkflowTools(object):
                                 get_workflow(workflow).site_to_run(subtask)
 
             if blank_sites_subtask:
-                drain_statuses = {sitename: drain for sitename, _, drain in \
-                                      sitereadiness.i_site_readiness()}
+                drain_statuses = sitestatus.get_snapshot().drain
                 output = render('picksites.html',
                                 tasks=blank_sites_subtask,
                                 statuses=drain_statuses,
@@ -699,9 +688,6 @@ class WorkflowTools(object):
                                 params=params,
                                 user=cherrypy.request.login)
 
-        finally:
-            self.seeworkflowlock.release()
-
         return output
 
 
@@ -904,7 +890,8 @@ class WorkflowTools(object):
         The function is only accessible to someone with a verified account.
 
         Navigating to ``https://localhost:8080/resetcache``
-        resets the error info for the user's session.
+        asks for the error info shared by all sessions to be rebuilt in the background,
+        so the page returns without waiting for it.
         It also clears out cached JSON files on the server.
         Under normal operation, this cache is only refreshed every half hour.
 
@@ -930,13 +917,40 @@ class WorkflowTools(object):
                 for pid in prepids:
                     info.prepidinfos[pid].reset()
 
-            info.teardown()
-            info.setup()
+            globalerrors.request_refresh()
 
         WorkflowTools.RESET_LOCK.release()
 
         return render('complete.html')
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def errorinfostatus(self):
+        """
+        Located at ``https://localhost:8080/errorinfostatus``,
+        this shows which generation of the error information is being served,
+        how old it is, and whether a new one is being built.
+        See :py:func:`globalerrors.refresh_status` for the keys.
+
+        :returns: Status of the shared error information
+        :rtype: JSON
+        """
+        return globalerrors.refresh_status()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def cachestatus(self):
+        """
+        Located at ``https://localhost:8080/cachestatus``,
+        this shows the hits, misses, and evictions of the workflow information
+        held in memory by this server.
+        See :py:meth:`infocache.MemoryCache.stats` for the keys.
+
+        :returns: Counters of the memory cache
+        :rtype: JSON
+        """
+        return infocache.get_memory_cache().stats()
+
     @cherrypy.expose
     def listpage(self, errorcode='', sitename='', workflow=''):
         """
@@ -960,12 +974,7 @@ class WorkflowTools(object):
             manageactions.get_acted_workflows(
                 serverconfig.get_history_length())
 
-        # Retry after ProgrammingError
-        try:
-            info = listpage.listworkflows(errorcode, sitename, workflow, cherrypy.session)
-        except sqlite3.ProgrammingError:
-            time.sleep(5)
-            return self.listpage(errorcode, sitename, workflow)
+        info = listpage.listworkflows(errorcode, sitename, workflow, cherrypy.session)
 
         return render('listworkflows.html',
                       workflow=workflow,
@@ -1044,8 +1053,6 @@ class WorkflowTools(object):
                     if not dry:
                         manageactions.submit2(user, [params])
                     submitted.append(workflow)
-
-            self.update_statuses()
         
         if len(submitted):
             unified = "https://cms-unified.web.cern.ch/cms-unified/report/"